@@ -0,0 +1,6 @@
+"""Kept so that `python bench.py` still works, see `python -m cleanroom bench`"""
+
+from cleanroom.bench import main
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,51 @@
-from .extract import get_raw
-from .models import Sample
-from .transform import get_waves
+import importlib
+
+# The public names and the modules they come from. They are only imported on
+# first access, so that `import cleanroom` stays cheap and e.g. mne_lsl,
+# scipy and pygatt are only loaded by the code paths that use them.
+_EXPORTS = {
+    "get_raw": "extract",
+    "Sample": "models",
+    "get_waves": "transform",
+    "get_features": "transform",
+    "FeatureEngine": "transform",
+    "Recorder": "record",
+    "Recording": "record",
+    "get_replay": "replay",
+    "get_synthetic": "replay",
+    "get_lsl": "inlet",
+    "get_aggregated": "inlet",
+    "Inlet": "inlet",
+    "Aggregator": "inlet",
+    "Resolver": "resolver",
+    "get_resolver": "resolver",
+    "ArtifactDetector": "artifacts",
+    "SignalQuality": "quality",
+    "compute_features": "offline",
+    "FeatureExecutor": "executor",
+    "Aligner": "resample",
+    "Resampler": "resample",
+    "get_layout": "presets",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module("." + _EXPORTS[name], __name__), name)
+    else:
+        # Submodules, e.g. `cleanroom.transform`
+        try:
+            value = importlib.import_module("." + name, __name__)
+        except ModuleNotFoundError as e:
+            if e.name != __name__ + "." + name:
+                raise
+            raise AttributeError("module %r has no attribute %r" % (__name__, name)) from None
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,99 @@
+"""
+Artifact detection for raw EEG blocks.
+
+Everything is computed over all channels at once with a handful of numpy
+reductions, so a window can be flagged (or skipped) before any FFT is run on
+it. Channels are in `get_waves` order: TP9, AF7, AF8, TP10.
+"""
+
+import numpy as np
+
+from .models import Artifact
+
+# The decoded range of the 12 bit samples, see `kernels.decode_eeg`
+SATURATION_LOW = 0.48828125 * (0 - 2048)
+SATURATION_HIGH = 0.48828125 * (4095 - 2048)
+
+FRONTAL_CHANNELS = [1, 2]  # AF7, AF8
+TEMPORAL_CHANNELS = [0, 3]  # TP9, TP10
+
+
+def _blink_template(sfreq, duration=0.3):
+    """A blink shaped bump, zero mean and unit norm"""
+    template = np.hanning(int(sfreq * duration))
+    template -= template.mean()
+    return template / np.linalg.norm(template)
+
+
+class ArtifactDetector:
+    """Flags blocks contaminated by saturation, large amplitudes, blinks or
+    jaw clenches"""
+
+    def __init__(self, sfreq=256, amplitude=500.0, saturation=1,
+                 blink_amplitude=100.0, blink_correlation=0.8, emg=30.0):
+        """
+        sfreq: Sampling frequency.
+        amplitude: Maximum absolute deviation from the block mean, in uV.
+        saturation: Number of samples at the ADC limits that flag a channel.
+        blink_amplitude: Minimum peak-to-peak frontal amplitude of a blink,
+            in uV.
+        blink_correlation: Minimum normalized correlation between the
+            frontal channels and a blink template.
+        emg: Maximum RMS sample-to-sample difference on the temporal
+            channels, in uV, above which muscle activity is flagged.
+        """
+
+        self.amplitude = amplitude
+        self.saturation = saturation
+        self.blink_amplitude = blink_amplitude
+        self.blink_correlation = blink_correlation
+        self.emg = emg
+        self.template = _blink_template(sfreq)
+
+    def detect(self, data, timestamp):
+        """
+        Checks a block for artifacts.
+
+        data: array of shape [samples, channels] in microvolts.
+        timestamp: The timestamp of the block's last sample.
+
+        Returns an `Artifact`, or None if the block is clean.
+        """
+
+        saturated = np.count_nonzero((data <= SATURATION_LOW) | (data >= SATURATION_HIGH), axis=0)
+        centered = data - data.mean(axis=0)
+        over = np.max(np.abs(centered), axis=0) > self.amplitude
+
+        slopes = np.diff(data[:, TEMPORAL_CHANNELS], axis=0)
+        jaw = bool(np.sqrt(np.mean(slopes ** 2)) > self.emg) if len(slopes) else False
+
+        blink = self._is_blink(centered[:, FRONTAL_CHANNELS])
+
+        saturated[saturated < self.saturation] = 0
+        if not (saturated.any() or over.any() or blink or jaw):
+            return None
+
+        return Artifact(timestamp, saturated, over, blink, jaw)
+
+    def _is_blink(self, frontal):
+        # Blinks show up with the same polarity on both frontal electrodes,
+        # so average them before matching
+        signal = frontal.mean(axis=1)
+        if np.ptp(signal) < self.blink_amplitude:
+            return False
+
+        n = len(self.template)
+        if len(signal) < n:
+            # Too short to match the template, the amplitude will have to do
+            return True
+
+        # The template is zero mean, so correlating with the raw signal is the
+        # same as with each window centered. Normalize by the centered
+        # window norms, from running sums.
+        correlation = np.correlate(signal, self.template, mode="valid")
+        sums = np.cumsum(np.concatenate(([0.0], signal)))
+        squares = np.cumsum(np.concatenate(([0.0], signal ** 2)))
+        energy = (squares[n:] - squares[:-n]) - (sums[n:] - sums[:-n]) ** 2 / n
+        local_norm = np.sqrt(np.maximum(energy, 1e-12))
+        return bool(np.max(correlation / local_norm) > self.blink_correlation)
+
@@ -0,0 +1,517 @@
+"""
+End-to-end pipeline benchmark.
+
+Drives the real acquisition and processing chain from emulated headsets:
+
+    FakeBackend -> Muse._handle_eeg -> extract queue -> transform.get_waves
+                                    -> LSL outlet      -> web broadcaster
+
+at increasing headset counts and speeds (multiples of the 256 Hz sample
+rate), and reports throughput, per-stage CPU time, p50/p99 latency and RSS as
+JSON, so that results can be compared between versions. The `acquire` stage
+covers decoding and the queue put, and includes the nested `lsl` stage.
+Latency is measured from a wave's last sample being received to its websocket
+flush.
+
+
+    python -m cleanroom bench --headsets 1,2,4 --speeds 1,4,16 --output bench.json
+
+With `--web-listeners`, it instead benchmarks how the web server scales with
+websocket listeners: `cleanroom serve --synthetic` is started with the DSP on its
+background thread and then with `--split`, real websocket clients subscribe to
+the raw and band streams, and the delivered message rate, latency from sample
+to client (at speed 1 only) and the web server process's CPU time are
+reported.
+
+    python -m cleanroom bench --web-listeners 1,16,64 --speeds 1,4 --output web.json
+
+With `--imports`, it measures how long importing the package and its modules
+takes in a fresh interpreter, and which heavy dependencies each one loads.
+
+    python -m cleanroom bench --imports cleanroom,cleanroom.transform,cleanroom.web
+
+With `--packets`, it measures how many microseconds the per-packet kernels
+take on a sample block, a packet of each channel, with each implementation in
+`--kernels`: decoding, dejittering and filtering separately, the three of them
+fused into the one call `Muse` makes, and, if bitstring is installed, the
+decoding as `Muse` did it before the kernels.
+
+    python -m cleanroom bench --packets 100000 --kernels numpy,numba
+"""
+
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from functools import partial
+from multiprocessing import Queue
+from queue import Empty
+
+import numpy as np
+from tornado.websocket import websocket_connect
+
+from cleanroom import design, kernels, web
+from cleanroom.extract import _enqueue_samples, _eeg_outlet
+from cleanroom.fake import FakeBackend
+from cleanroom.muse import Muse
+from cleanroom.transform import get_waves
+
+# Where the package can be imported from, for the subprocesses
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ["acquire", "lsl", "transform", "broadcast"]
+
+
+class StageTimer:
+    """Accumulates the CPU time spent in a pipeline stage"""
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, cpu):
+        with self._lock:
+            self.cpu += cpu
+            self.calls += 1
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(time.thread_time() - start)
+        return timed
+
+
+class NullListener:
+    """Stands in for a websocket connection"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write_message(self, message):
+        self.bytes += len(message)
+
+
+def _rss_kb():
+    # Current RSS where /proc is available, peak RSS otherwise
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _drain(queue, stop):
+    while not stop.is_set():
+        try:
+            yield queue.get(timeout=0.1)
+        except Empty:
+            continue
+
+
+def run(headsets=1, speed=1.0, duration=5.0, listeners=1):
+    """
+    Runs the pipeline for `duration` seconds and returns its measurements.
+
+    headsets: Number of emulated headsets streaming concurrently.
+    speed: Stream speed relative to real time.
+    duration: Seconds to run for.
+    listeners: Number of websocket listeners per stream.
+    """
+
+    timers = {stage: StageTimer() for stage in STAGES}
+    stop = threading.Event()
+    latencies = []
+    pending = []
+    pending_lock = threading.Lock()
+    counts = {"samples": 0, "waves": 0}
+
+    handlers = [web.RawStreamHandler, web.DeltaStreamHandler, web.ThetaStreamHandler,
+                web.AlphaStreamHandler, web.BetaStreamHandler]
+    for handler in handlers:
+        handler.message_queue().clear()
+        handler.listeners().clear()
+        for _ in range(listeners):
+            handler.listeners().add(NullListener())
+
+    muses = []
+    consumers = []
+
+    for i in range(headsets):
+        queue = Queue()
+
+        outlet = _eeg_outlet("bench_%d" % i)
+
+        def push(data, timestamps, outlet):
+            outlet.push_chunk(data.T, timestamps[-1])
+
+        muse = Muse(address="00:55:DA:00:00:%02X" % i,
+                    callback=partial(_enqueue_samples, queue),
+                    callback_eeg=timers["lsl"].wrap(partial(push, outlet=outlet)),
+                    backend=FakeBackend(speed=speed, seed=i))
+        muse._handle_eeg = timers["acquire"].wrap(muse._handle_eeg)
+        muses.append(muse)
+
+        def consume(queue):
+            waves = get_waves(_drain(queue, stop))
+            while True:
+                start = time.thread_time()
+                try:
+                    delta, theta, alpha, beta = next(waves)
+                except StopIteration:
+                    break
+                web.DeltaStreamHandler.enqueue_message(delta.to_json())
+                web.ThetaStreamHandler.enqueue_message(theta.to_json())
+                web.AlphaStreamHandler.enqueue_message(alpha.to_json())
+                web.BetaStreamHandler.enqueue_message(beta.to_json())
+                timers["transform"].add(time.thread_time() - start)
+                with pending_lock:
+                    pending.append(delta.timestamp)
+                    counts["waves"] += 1
+
+        consumers.append(threading.Thread(target=consume, args=(queue,), daemon=True))
+
+    def flush():
+        while not stop.is_set():
+            time.sleep(0.1)
+            start = time.thread_time()
+            web.flush_message_queues()
+            timers["broadcast"].add(time.thread_time() - start)
+            now = time.time()
+            with pending_lock:
+                latencies.extend(now - t for t in pending)
+                pending.clear()
+
+    flusher = threading.Thread(target=flush, daemon=True)
+
+    # Count every sample that makes it through the queue by wrapping the
+    # callback, so that the consumers don't need to
+    def counted(callback):
+        def wrapper(data, timestamps):
+            counts["samples"] += len(timestamps)
+            callback(data, timestamps)
+        return wrapper
+
+    for muse in muses:
+        muse.callback = counted(muse.callback)
+        # Compile or load the kernels now, rather than on the clock
+        muse._init_eeg()
+
+    rss_before = _rss_kb()
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+
+    flusher.start()
+    for consumer in consumers:
+        consumer.start()
+    for muse in muses:
+        muse.connect()
+        muse.start()
+
+    time.sleep(duration)
+
+    for muse in muses:
+        muse.stop()
+        muse.disconnect()
+    stop.set()
+    for thread in consumers + [flusher]:
+        thread.join()
+
+    wall = time.perf_counter() - wall_before
+    cpu = time.process_time() - cpu_before
+    rss = _rss_kb()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "headsets": headsets,
+        "speed": speed,
+        "duration": wall,
+        "listeners": listeners,
+        "samples": counts["samples"],
+        "throughput": counts["samples"] / wall,
+        "expected_throughput": headsets * speed * 256,
+        "waves": counts["waves"],
+        "cpu": cpu,
+        "stage_cpu": {stage: timers[stage].cpu for stage in STAGES},
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        },
+        "rss_kb": rss,
+        "rss_growth_kb": rss - rss_before,
+    }
+
+
+WEB_STREAMS = ["raw", "delta", "theta", "alpha", "beta"]
+
+
+def _process_cpu(pid):
+    # User and system CPU seconds of another process, where /proc is available
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def _listen(port, stream, duration, counts, latencies):
+    conn = await websocket_connect("ws://localhost:%d/stream/%s" % (port, stream))
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            message = await asyncio.wait_for(conn.read_message(), deadline - time.time())
+        except asyncio.TimeoutError:
+            break
+        if message is None:
+            break
+        now = time.time()
+        lines = message.rstrip("\n").split("\n")
+        counts[stream] += len(lines)
+        latencies.append(now - json.loads(lines[-1])["timestamp"])
+    conn.close()
+
+
+async def _listen_all(port, listeners, duration):
+    # Wait for the server to come up
+    for _ in range(100):
+        try:
+            (await websocket_connect("ws://localhost:%d/stream/raw" % port)).close()
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+
+    counts = dict.fromkeys(WEB_STREAMS, 0)
+    latencies = []
+    await asyncio.gather(*[_listen(port, stream, duration, counts, latencies)
+                           for stream in WEB_STREAMS for _ in range(listeners)])
+    return counts, latencies
+
+
+def run_web(listeners=1, split=False, speed=1.0, duration=5.0, port=8890):
+    """
+    Runs the web server with `listeners` websocket clients per stream for
+    `duration` seconds and returns its measurements.
+
+    listeners: Number of websocket listeners per stream.
+    split: Whether to run the DSP in its own process, with `--split`.
+    speed: Synthetic stream speed relative to real time.
+    duration: Seconds to listen for.
+    port: Port to run the web server on.
+    """
+
+    args = [sys.executable, "-m", "cleanroom", "serve",
+            "--synthetic", "--speed", str(speed), "-p", str(port)]
+    if split:
+        args.append("--split")
+
+    server = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT)
+    try:
+        # Let the pipeline warm up before measuring
+        time.sleep(2)
+        cpu_before = _process_cpu(server.pid)
+        wall_before = time.perf_counter()
+        counts, latencies = asyncio.run(_listen_all(port, listeners, duration))
+        wall = time.perf_counter() - wall_before
+        cpu_after = _process_cpu(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    # Synthetic timestamps run ahead of the clock when sped up, so latency is
+    # only meaningful in real time
+    latencies = np.array(latencies) * 1000 if speed == 1 else np.zeros(0)
+    return {
+        "mode": "split" if split else "thread",
+        "speed": speed,
+        "duration": wall,
+        "listeners": listeners,
+        "raw_rate": counts["raw"] / listeners / wall,
+        "expected_raw_rate": speed * 256,
+        "messages": sum(counts.values()),
+        "web_cpu": None if cpu_before is None else cpu_after - cpu_before,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        },
+    }
+
+
+HEAVY_MODULES = ["mne_lsl", "scipy", "pygatt", "bitstring", "tornado"]
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in %r if m in sys.modules]]))
+"""
+
+
+def run_imports(module, repeat=5):
+    """
+    Imports `module` in `repeat` fresh interpreters and returns the
+    measurements.
+    """
+
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True,
+                                cwd=ROOT).stdout
+        elapsed, loaded = json.loads(output.strip().splitlines()[-1])
+        times.append(elapsed)
+
+    times = np.array(times) * 1000
+    return {
+        "module": module,
+        "import_ms": {"p50": float(np.percentile(times, 50)), "min": float(times.min())},
+        "loaded": loaded,
+    }
+
+
+def run_packets(backend="auto", packets=100000, channels=4):
+    """
+    Runs the per-packet kernels of `backend` on `packets` sample blocks of
+    random EEG, as `Muse` gets them, and returns the microseconds per block
+    of each.
+
+    channels: Number of EEG channels, so packets per block.
+    """
+
+    backend = kernels.use(backend)
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, (packets, channels, 20), dtype=np.uint8)
+    received = 100 + np.arange(packets) * 12 / 256 + rng.normal(0, 0.005, packets)
+    b, a = design.butter(4, (45, 55), "bandstop", 256)
+
+    samples = np.empty((channels, 12))
+    timestamps = np.empty(12)
+    filtered = np.empty((channels, 12))
+
+    def decode(i, state, zi):
+        kernels.decode_eeg(data[i], samples)
+
+    def dejitter(i, state, zi):
+        kernels.dejitter(state, received[i], 0, timestamps)
+
+    def iir(i, state, zi):
+        kernels.iir(b, a, samples, zi, filtered)
+
+    def fused(i, state, zi):
+        kernels.eeg_packet(data[i], received[i], 0, state, b, a, zi, samples, timestamps, filtered)
+
+    measured = [("decode", decode), ("dejitter", dejitter), ("iir", iir), ("fused", fused)]
+
+    # How `Muse` decoded packets before `kernels.decode_eeg`, to compare with
+    try:
+        import bitstring
+    except ImportError:
+        pass
+    else:
+        def decode_bitstring(i, state, zi):
+            for c in range(channels):
+                res = bitstring.Bits(data[i, c].tobytes()).unpack("uint:16" + ",uint:12" * 12)
+                samples[c] = 0.48828125 * (np.array(res[1:]) - 2048)
+
+        measured.append(("bitstring", decode_bitstring))
+
+    timings = {}
+    for name, kernel in measured:
+        # Warm up, which compiles the kernels with numba
+        kernel(0, kernels.dejitter_state(256), np.zeros((channels, len(b) - 1)))
+
+        state = kernels.dejitter_state(256)
+        zi = np.zeros((channels, len(b) - 1))
+        start = time.perf_counter()
+        for i in range(packets):
+            kernel(i, state, zi)
+        timings[name] = (time.perf_counter() - start) / packets * 1e6
+
+    return {
+        "kernels": backend,
+        "packets": packets,
+        "channels": channels,
+        "block_us": timings,
+    }
+
+
+def environment():
+    """Describes the machine and library versions a benchmark ran with"""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "time": time.time(),
+    }
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog="cleanroom bench", description="Benchmark the cleanroom pipeline")
+    parser.add_argument("--headsets", default="1,2,4",
+                        help="Comma separated headset counts. Defaults to `1,2,4`.")
+    parser.add_argument("--speeds", default="1,4,16",
+                        help="Comma separated speeds relative to real time. Defaults to `1,4,16`.")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="Seconds to run each configuration for. Defaults to `5`.")
+    parser.add_argument("--listeners", type=int, default=1,
+                        help="Websocket listeners per stream. Defaults to `1`.")
+    parser.add_argument("--web-listeners", default=None,
+                        help="Comma separated listener counts to benchmark the web server with, instead of the pipeline.")
+    parser.add_argument("--port", type=int, default=8890,
+                        help="Port to run the web server on for --web-listeners. Defaults to `8890`.")
+    parser.add_argument("--imports", default=None,
+                        help="Comma separated modules to measure the import time of, instead of the pipeline.")
+    parser.add_argument("--packets", type=int, default=None,
+                        help="Number of sample blocks to measure the per-packet kernels on, instead of the pipeline.")
+    parser.add_argument("--kernels", default=",".join(kernels.available()),
+                        help="Comma separated kernel implementations for --packets. Defaults to those available.")
+    parser.add_argument("--output", default=None,
+                        help="File to write the JSON results to. Defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    # The pipeline reports dropped packets on stdout, keep it clean for JSON
+    results = []
+    with redirect_stdout(sys.stderr):
+        if args.imports:
+            for module in args.imports.split(","):
+                results.append(run_imports(module))
+
+        if args.web_listeners:
+            for listeners in [int(l) for l in args.web_listeners.split(",")]:
+                for speed in [float(s) for s in args.speeds.split(",")]:
+                    for split in (False, True):
+                        results.append(run_web(listeners, split, speed, args.duration, args.port))
+
+        if args.packets:
+            for backend in args.kernels.split(","):
+                results.append(run_packets(backend, args.packets))
+
+        for headsets in [] if args.web_listeners or args.imports or args.packets else [int(h) for h in args.headsets.split(",")]:
+            for speed in [float(s) for s in args.speeds.split(",")]:
+                results.append(run(headsets, speed, args.duration, args.listeners))
+
+    report = json.dumps({"environment": environment(), "results": results}, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
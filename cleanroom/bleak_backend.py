@@ -0,0 +1,95 @@
+"""
+A pygatt-like backend on top of bleak, for the native Bluetooth stacks of
+Windows and macOS, which pygatt can't use without a BLED112 dongle.
+
+`BleakBackend` runs an asyncio loop on its own thread and exposes the same
+blocking surface as pygatt and `FakeBackend` (`start`, `stop`, `scan`,
+`connect`, `subscribe`, `char_write_handle`, `disconnect`), so `Muse` drives
+it like any other backend. Notifications are handed to the callbacks with the
+handles pygatt reports, so the decoding is shared too.
+"""
+
+import asyncio
+import threading
+
+from .fake import UUID_HANDLES
+
+HANDLE_UUIDS = {handle: uuid for uuid, handle in UUID_HANDLES.items()}
+
+
+class BleakBackend:
+    """Runs bleak on a background event loop"""
+
+    def __init__(self, timeout=30.0):
+        """
+        timeout: Seconds to wait for each BLE operation.
+        """
+
+        self.timeout = timeout
+        self.loop = None
+        self._thread = None
+
+    def start(self):
+        # bleak is only needed on this backend, so only import it here
+        import bleak  # noqa: F401
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="bleak")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def run(self, coroutine, timeout=None):
+        """Runs a coroutine on the loop and waits for its result"""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        return future.result(self.timeout if timeout is None else timeout)
+
+    def scan(self, timeout=10, **kwargs):
+        from bleak import BleakScanner
+
+        devices = self.run(BleakScanner.discover(timeout=timeout), timeout + self.timeout)
+        return [{"name": device.name, "address": device.address} for device in devices]
+
+    def connect(self, address, **kwargs):
+        from bleak import BleakClient
+
+        client = BleakClient(address)
+        self.run(client.connect())
+        return BleakDevice(self, client)
+
+
+class BleakDevice:
+    """A headset connected through `BleakBackend`"""
+
+    def __init__(self, backend, client):
+        self.backend = backend
+        self.client = client
+
+    def subscribe(self, uuid, callback=None, **kwargs):
+        handle = UUID_HANDLES[uuid]
+
+        def notify(characteristic, data):
+            callback(handle, data)
+
+        self.backend.run(self.client.start_notify(uuid, notify))
+
+    def char_write_handle(self, handle, value, wait_for_response=False):
+        # bleak's handles differ between platforms, the UUIDs don't
+        write = self.client.write_gatt_char(HANDLE_UUIDS[handle], bytes(value),
+                                            response=wait_for_response)
+        if wait_for_response:
+            self.backend.run(write)
+        else:
+            # Like pygatt, don't wait for the loop, which may be busy handing
+            # a notification to a callback that waits on the writer
+            asyncio.run_coroutine_threadsafe(write, self.backend.loop)
+
+    def disconnect(self):
+        self.backend.run(self.client.disconnect())
@@ -0,0 +1,240 @@
+"""
+The `cleanroom` command line, one entry point for everything the package
+does:
+
+    python -m cleanroom stream -a 00:55:DA:BB:86:C9
+    python -m cleanroom record -a 00:55:DA:BB:86:C9 session.rec
+    python -m cleanroom replay session.rec
+    python -m cleanroom serve --synthetic
+    python -m cleanroom bench --headsets 1,2
+    python -m cleanroom scan -b gatt
+
+Every subcommand that talks to a headset takes the same options and goes
+through `get_raw`, so connecting, decoding, dejittering and the LSL outlets
+are the same code whichever way a session is started. Their defaults all come
+from `config`, and `--config session.toml` overrides them; options given on
+the command line override both.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser, ArgumentTypeError
+
+from . import config, presets
+from .config import BACKENDS
+
+
+def add_config_argument(parser):
+    """Adds `--config`, and makes the configuration's defaults the parser's"""
+    parser.add_argument("-c", "--config",
+                        dest="config", default=None,
+                        help="TOML file of settings, see `cleanroom.config`. Options given here override it.")
+    parser.set_defaults(**config.defaults().options())
+
+
+def parse_args(parser, argv=None):
+    """
+    Parses a command line. If it names a `--config` file, the file's
+    settings become the defaults of the options it doesn't give, so
+    it's parsed twice.
+    """
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        try:
+            parser.set_defaults(**config.load(args.config).options())
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    return parser.parse_args(argv)
+
+
+def preset(value):
+    """Parses a `--preset`, see `presets.normalize`"""
+    try:
+        return presets.normalize(value)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def add_headset_arguments(parser):
+    """Adds the options that pick and configure a headset to a parser"""
+    parser.add_argument("-a", "--address",
+                        dest="address", default=None,
+                        help="Device MAC address. Defaults to the first Muse found.")
+    parser.add_argument("-n", "--name",
+                        dest="name", default=None,
+                        help="Name of the device.")
+    parser.add_argument("-b", "--backend",
+                        dest="backend", choices=BACKENDS,
+                        help="BLE backend to use: `gatt` for the computer's bluetooth on Linux, `bgapi` for a BLED112 dongle, `bleak` for Windows and macOS, or `fake` for an emulated headset. Defaults to `bgapi`.")
+    parser.add_argument("-i", "--interface",
+                        dest="interface", default=None,
+                        help="The interface to use, `hci0` for gatt or a com port for bgapi.")
+    parser.add_argument("--preset",
+                        dest="preset", type=preset, default=None,
+                        help="Headset preset to select, e.g. `p50`. It decides the EEG channels that are streamed: `p20` adds AUX to the 4 scalp channels. Defaults to the headset's own.")
+    parser.add_argument("--acc",
+                        dest="acc", action="store_true", default=False,
+                        help="Stream the accelerometer.")
+    parser.add_argument("--gyro",
+                        dest="gyro", action="store_true", default=False,
+                        help="Stream the gyroscope.")
+    parser.add_argument("--ppg",
+                        dest="ppg", action="store_true", default=False,
+                        help="Stream the PPG sensors.")
+
+
+def headset_kwargs(args):
+    """Gets the `get_raw` keyword arguments of the headset options"""
+    return {
+        "address": args.address,
+        "name": args.name,
+        "backend": args.backend,
+        "interface": args.interface,
+        "preset": args.preset,
+        "accelero": args.acc,
+        "giro": args.gyro,
+        "ppg": args.ppg,
+    }
+
+
+def stream(args, record=None):
+    """Streams a headset to LSL, reconnecting when it drops"""
+    from .extract import get_raw
+
+    last_battery = [0.0]
+
+    def on_telemetry(telemetry):
+        if time.monotonic() - last_battery[0] >= 60:
+            last_battery[0] = time.monotonic()
+            print("Battery: %.0f%%" % telemetry.battery)
+
+    attempts = 0
+    while True:
+        received = False
+        for _ in get_raw(timeout=args.timeout, record=record, on_telemetry=on_telemetry,
+                         lsl_chunk_size=args.lsl_chunk_size, **headset_kwargs(args)):
+            received = True
+
+        # Only count the attempts that never got going
+        attempts = 0 if received else attempts + 1
+        if attempts > args.reconnect:
+            break
+        print("\nAttempting to reconnect ... (Attempt %d/%d)\n" % (attempts + 1, args.reconnect + 1))
+        time.sleep(0.25)
+
+
+def replay(args):
+    """Publishes a recording on an LSL outlet, as if it were a headset"""
+    import mne_lsl.lsl
+    import numpy as np
+    from .extract import _eeg_outlet
+    from .record import Recording
+    from .replay import get_replay
+
+    # The outlet has the channels that were recorded
+    recording = Recording(args.path)
+    outlet = _eeg_outlet(args.source_id, layout=presets.layout_for_channels(recording.n_channels, recording.sfreq))
+    offset = None
+
+    for sample in get_replay(args.path, speed=args.speed or None, start=args.start, stop=args.stop):
+        # Stamp the samples with the current clock, as consumers expect
+        if offset is None:
+            offset = mne_lsl.lsl.local_clock() - sample.timestamp
+        outlet.push_sample(sample.data.astype(np.float32), sample.timestamp + offset)
+
+
+def scan(args):
+    """Lists the nearby Muse headsets"""
+    from .muse import Muse
+
+    muse = Muse(backend=args.backend, interface=args.interface)
+    for device in muse.scan(timeout=args.timeout):
+        if args.all or (device["name"] and "Muse" in device["name"]):
+            print("%s\t%s" % (device["address"], device["name"]))
+
+
+def serve(argv):
+    from .web import main
+    main(argv)
+
+
+def bench(argv):
+    from .bench import main
+    main(argv)
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog="cleanroom", description="Stream, record, serve and benchmark Muse EEG")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    for name, help in (("stream", "Stream a headset to LSL."),
+                       ("record", "Stream a headset to LSL and record it to a file.")):
+        command = commands.add_parser(name, help=help)
+        add_headset_arguments(command)
+        if name == "record":
+            command.add_argument("path", help="Path of the file to record to, appended to if it exists.")
+        command.add_argument("--reconnect", type=int, default=3,
+                             help="Number of times to try reconnecting without receiving any data. Defaults to `3`.")
+        command.add_argument("--timeout", type=float,
+                             help="Seconds without data after which the headset is considered gone. Defaults to `30`.")
+        add_config_argument(command)
+
+    command = commands.add_parser("replay", help="Play a recording back on LSL.")
+    command.add_argument("path", help="Path of the recording.")
+    command.add_argument("--speed", type=float, default=1.0,
+                         help="Speed relative to real time, 0 for as fast as possible. Defaults to `1`.")
+    command.add_argument("--start", type=float, default=None,
+                         help="Timestamp to start playing from. Defaults to the beginning.")
+    command.add_argument("--stop", type=float, default=None,
+                         help="Timestamp to stop playing at. Defaults to the end.")
+    command.add_argument("--source-id", dest="source_id", default="replay",
+                         help="The outlet's source ID is `Muse_<source-id>`. Defaults to `replay`.")
+
+    command = commands.add_parser("scan", help="List the nearby Muse headsets.")
+    command.add_argument("-b", "--backend", choices=BACKENDS, default="bgapi",
+                         help="BLE backend to use. Defaults to `bgapi`.")
+    command.add_argument("-i", "--interface", default=None,
+                         help="The interface to use, `hci0` for gatt or a com port for bgapi.")
+    command.add_argument("--timeout", type=float, default=10.5,
+                         help="Seconds to scan for. Defaults to `10.5`.")
+    command.add_argument("--all", action="store_true", default=False,
+                         help="List every BLE device, not only Muse headsets.")
+
+    # These parse their own options, see `cleanroom serve --help`
+    commands.add_parser("serve", add_help=False, help="Serve the dashboard.")
+    commands.add_parser("bench", add_help=False, help="Benchmark the pipeline.")
+
+    argv = sys.argv[1:] if argv is None else argv
+    args, rest = parser.parse_known_args(argv)
+    if getattr(args, "config", None):
+        # Parse again with the file's settings as defaults, see `parse_args`
+        try:
+            commands.choices[args.command].set_defaults(**config.load(args.config).options())
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        args, rest = parser.parse_known_args(argv)
+
+    if args.command == "serve":
+        return serve(rest)
+    elif args.command == "bench":
+        return bench(rest)
+    elif rest:
+        parser.error("unrecognized arguments: %s" % " ".join(rest))
+
+    try:
+        if args.command == "stream":
+            stream(args, record=args.record)
+        elif args.command == "record":
+            stream(args, record=args.path)
+        elif args.command == "replay":
+            replay(args)
+        elif args.command == "scan":
+            scan(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+Pipeline configuration files.
+
+Everything about a session can be set in a TOML file instead of on the
+command line: where the EEG comes from, how it's filtered, the band edges,
+and the buffer and latency budgets of the outputs. Only the settings that
+differ from the defaults need to be given:
+
+    [source]
+    kind = "headset"
+    address = "00:55:DA:BB:86:C9"
+    preset = "p50"
+
+    [dsp]
+    notch = [45, 55]
+    features = ["peak_alpha", "theta_beta"]
+
+    [bands]
+    alpha = [8, 13]
+
+    [outputs.web]
+    flush_interval = 0.05
+
+`load` checks the whole file up front and reports every problem in it at
+once. `ConfigWatcher` reloads it when it changes, so that the DSP settings
+can be tuned while streaming, without reconnecting the headset. YAML files
+work too, if PyYAML is installed.
+"""
+
+import logging
+import os
+import threading
+
+from .presets import normalize
+from .transform import BAND_EDGES, BANDS, FEATURES, NOTCH, SAMPLING_FREQUENCY
+
+BACKENDS = ["gatt", "bgapi", "bleak", "fake"]
+
+# The settings that take effect without restarting, as (section, key), with
+# None for a whole section
+RELOADABLE = {("dsp", "features"), ("dsp", "notch"), ("dsp", "notch_order"),
+              ("dsp", "artifacts"), ("bands", None)}
+
+
+def _string(value):
+    if not isinstance(value, str):
+        raise(ValueError("must be a string"))
+    return value
+
+
+def _bool(value):
+    if not isinstance(value, bool):
+        raise(ValueError("must be true or false"))
+    return value
+
+
+def _number(minimum=None, maximum=None, integer=False):
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+            raise(ValueError("must be an integer" if integer else "must be a number"))
+        if minimum is not None and value < minimum:
+            raise(ValueError("must be at least {}".format(minimum)))
+        if maximum is not None and value > maximum:
+            raise(ValueError("must be at most {}".format(maximum)))
+        return value if integer else float(value)
+    return check
+
+
+def _choice(*choices):
+    def check(value):
+        if value not in choices:
+            raise(ValueError("must be one of {}".format(", ".join(choices))))
+        return value
+    return check
+
+
+def _pair(value):
+    if (not isinstance(value, (list, tuple)) or len(value) != 2
+            or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)):
+        raise(ValueError("must be a [low, high] pair of frequencies"))
+    return float(value[0]), float(value[1])
+
+
+def _range(value):
+    low, high = _pair(value)
+    if not 0 <= low < high <= SAMPLING_FREQUENCY / 2:
+        raise(ValueError("must have 0 <= low < high <= {}".format(SAMPLING_FREQUENCY / 2)))
+    return low, high
+
+
+def _preset(value):
+    return normalize(_string(value))
+
+
+def _notch(value):
+    if value is False:
+        return None
+    # Filter edges must be strictly inside (0, Nyquist), unlike band edges
+    low, high = _pair(value)
+    if not 0 < low < high < SAMPLING_FREQUENCY / 2:
+        raise(ValueError("must have 0 < low < high < {}".format(SAMPLING_FREQUENCY / 2)))
+    return low, high
+
+
+def _features(value):
+    if not isinstance(value, (list, tuple)) or not all(isinstance(v, str) for v in value):
+        raise(ValueError("must be a list of feature names"))
+    unknown = [name for name in value if name not in FEATURES or name in BANDS]
+    if unknown:
+        raise(ValueError("unknown features {}, must be among {}".format(
+            ", ".join(unknown), ", ".join(name for name in FEATURES if name not in BANDS))))
+    return tuple(value)
+
+
+# Section -> key -> (check, default). The checks return the value, converted
+# to its canonical type, or raise ValueError.
+SCHEMA = {
+    "source": {
+        # Where the EEG comes from: a headset, synthetic data, a recording or
+        # an LSL stream
+        "kind": (_choice("headset", "synthetic", "replay", "lsl"), "headset"),
+        "address": (_string, None),
+        "name": (_string, None),
+        "backend": (_choice(*BACKENDS), "bgapi"),
+        "interface": (_string, None),
+        "preset": (_preset, None),
+        "acc": (_bool, False),
+        "gyro": (_bool, False),
+        "ppg": (_bool, False),
+        # The recording to replay, and the LSL stream to read
+        "path": (_string, None),
+        "stream": (_string, "Muse"),
+        "speed": (_number(minimum=0), 1.0),
+        # Seconds without data after which the source is considered gone
+        "timeout": (_number(minimum=0), 30.0),
+        "record": (_string, None),
+    },
+    "dsp": {
+        # Features on top of the band powers, which are always computed
+        "features": (_features, ()),
+        # The line noise band to filter out, or false
+        "notch": (_notch, tuple(float(f) for f in NOTCH[1])),
+        "notch_order": (_number(minimum=1, maximum=16, integer=True), NOTCH[0]),
+        "artifacts": (_choice("off", "flag", "reject"), "off"),
+        # Samples per window step
+        "chunk_size": (_number(minimum=1, integer=True), SAMPLING_FREQUENCY),
+        "workers": (_number(minimum=0, integer=True), 0),
+        "split": (_bool, False),
+    },
+    "bands": {name: (_range, (float(low), float(high))) for name, low, high in BAND_EDGES},
+    "outputs.web": {
+        "port": (_number(minimum=1, maximum=65535, integer=True), 8888),
+        # Seconds between websocket flushes, the latency budget of the
+        # dashboard
+        "flush_interval": (_number(minimum=0.001), 0.1),
+        # Messages each stream holds between flushes before dropping the
+        # oldest, or 0 for no limit
+        "max_queue": (_number(minimum=0, integer=True), 0),
+        "metrics": (_bool, False),
+    },
+    "outputs.lsl": {
+        # Samples per LSL chunk of the EEG outlet
+        "chunk_size": (_number(minimum=1, integer=True), 6),
+    },
+}
+
+
+class Config:
+    """A validated configuration, as a dict of section name to settings"""
+
+    def __init__(self, sections):
+        self.sections = sections
+
+    def __getitem__(self, section):
+        return self.sections[section]
+
+    def __eq__(self, other):
+        return isinstance(other, Config) and self.sections == other.sections
+
+    def changes(self, other):
+        """Gets the (section, key) of the settings that differ from `other`"""
+        return {(section, key)
+                for section, settings in self.sections.items()
+                for key, value in settings.items()
+                if other.sections[section][key] != value}
+
+    def notch(self):
+        """The notch filter, as the arguments of `design.butter`, or None"""
+        band = self["dsp"]["notch"]
+        if band is None:
+            return None
+        return (self["dsp"]["notch_order"], band, "bandstop", SAMPLING_FREQUENCY)
+
+    def bands(self):
+        """The band edges, like `transform.BAND_EDGES`"""
+        return tuple((name,) + self["bands"][name] for name, _, _ in BAND_EDGES)
+
+    def dsp_params(self):
+        """The `FeatureEngine.configure` parameters, but `artifacts`"""
+        return {
+            "features": BANDS + self["dsp"]["features"],
+            "notch": self.notch(),
+            "bands": self.bands(),
+            "reject": self["dsp"]["artifacts"] == "reject",
+        }
+
+    def options(self):
+        """The settings as the options of `cleanroom serve`, and those of the
+        other commands, e.g. to use as argparse defaults"""
+        source = self["source"]
+        dsp = self["dsp"]
+        web = self["outputs.web"]
+
+        return {
+            "address": source["address"],
+            "name": source["name"],
+            "backend": source["backend"],
+            "interface": source["interface"],
+            "preset": source["preset"],
+            "acc": source["acc"],
+            "gyro": source["gyro"],
+            "ppg": source["ppg"],
+            "synthetic": source["kind"] == "synthetic",
+            "replay": source["path"] if source["kind"] == "replay" else None,
+            "lsl": source["stream"] if source["kind"] == "lsl" else None,
+            "speed": source["speed"],
+            "timeout": source["timeout"],
+            "record": source["record"],
+            "features": list(dsp["features"]),
+            "artifacts": None if dsp["artifacts"] == "off" else dsp["artifacts"],
+            "chunk_size": dsp["chunk_size"],
+            "workers": dsp["workers"],
+            "split": dsp["split"],
+            "notch": self.notch(),
+            "bands": self.bands(),
+            "port": web["port"],
+            "flush_interval": web["flush_interval"],
+            "max_queue": web["max_queue"],
+            "metrics": web["metrics"],
+            "lsl_chunk_size": self["outputs.lsl"]["chunk_size"],
+        }
+
+
+def defaults():
+    """Gets the configuration with every setting at its default"""
+    return parse({})
+
+
+def parse(raw, source="config"):
+    """
+    Validates a configuration and fills in its defaults.
+
+    raw: A dict of the parsed file, e.g. from `tomllib`.
+    source: Where it comes from, for error messages.
+
+    Returns a `Config`, or raises ValueError listing every problem found.
+    """
+
+    errors = []
+    sections = {}
+
+    if not isinstance(raw, dict):
+        raise(ValueError("Invalid {}: must be a table of sections".format(source)))
+
+    known = {name.split(".")[0] for name in SCHEMA}
+    for name in raw:
+        if name not in known:
+            errors.append("unknown section [{}]".format(name))
+
+    for name, schema in SCHEMA.items():
+        # "outputs.web" is the "web" table of the "outputs" one
+        settings = raw
+        for part in name.split("."):
+            settings = settings.get(part, {}) if isinstance(settings, dict) else None
+        if not isinstance(settings, dict):
+            errors.append("[{}] must be a table".format(name))
+            settings = {}
+
+        sections[name] = {}
+        for key in settings:
+            if key not in schema:
+                errors.append("unknown setting {}.{}".format(name, key))
+
+        for key, (check, default) in schema.items():
+            if key not in settings:
+                sections[name][key] = default
+                continue
+            try:
+                sections[name][key] = check(settings[key])
+            except ValueError as e:
+                errors.append("{}.{} {}".format(name, key, e))
+                sections[name][key] = default
+
+    outputs = raw.get("outputs", {})
+    if isinstance(outputs, dict):
+        for key in outputs:
+            if "outputs." + key not in SCHEMA:
+                errors.append("unknown section [outputs.{}]".format(key))
+    else:
+        errors.append("[outputs] must be a table")
+
+    source_settings = sections["source"]
+    if source_settings["kind"] == "replay" and source_settings["path"] is None:
+        errors.append("source.path is needed to replay a recording")
+
+    if errors:
+        raise(ValueError("Invalid {}:\n  {}".format(source, "\n  ".join(errors))))
+
+    return Config(sections)
+
+
+def load(path):
+    """Reads and validates a TOML, or YAML, configuration file"""
+
+    with open(path, "rb") as f:
+        if path.endswith((".yaml", ".yml")):
+            # PyYAML is only needed for YAML files
+            import yaml
+            try:
+                raw = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise(ValueError("Invalid {}: {}".format(path, e)))
+        else:
+            try:
+                import tomllib
+            except ImportError:
+                # Python < 3.11
+                import tomli as tomllib
+            try:
+                raw = tomllib.load(f)
+            except tomllib.TOMLDecodeError as e:
+                raise(ValueError("Invalid {}: {}".format(path, e)))
+
+    return parse(raw, path)
+
+
+class ConfigWatcher:
+    """
+    Reloads a configuration file when it changes, and hands the new
+    configuration on. Invalid files are reported and otherwise ignored, so a
+    typo doesn't stop the stream.
+    """
+
+    def __init__(self, path, on_change, interval=1.0, config=None):
+        """
+        path: Path of the file.
+        on_change: Called with the new `Config` on each change, on the
+            watcher thread. Only the `RELOADABLE` settings are meant to be
+            applied, changes to the others are logged as needing a restart.
+        interval: Seconds between checks of the file.
+        config: The configuration currently in use, defaulting to the file's.
+        """
+
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.config = load(path) if config is None else config
+        self._mtime = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        """Starts watching on a daemon thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="config")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Reloads the file if it changed since the last check"""
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+
+        try:
+            config = load(self.path)
+        except (OSError, ValueError) as e:
+            logging.error("Not reloading the configuration: %s", e)
+            return
+
+        changes = config.changes(self.config)
+        if not changes:
+            return
+
+        restart = sorted("{}.{}".format(section, key) for section, key in changes
+                         if (section, key) not in RELOADABLE and (section, None) not in RELOADABLE)
+        if restart:
+            logging.warning("Restart to apply the changes to %s", ", ".join(restart))
+
+        try:
+            self.on_change(config)
+        except Exception:
+            logging.exception("Not applying the configuration from %s", self.path)
+            return
+
+        logging.info("Reloaded the configuration from %s", self.path)
+        self.config = config
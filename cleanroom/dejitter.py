@@ -0,0 +1,58 @@
+"""
+Timestamp dejittering.
+
+BLE notifications arrive in bursts, so the receive time of a packet is a noisy
+estimate of when its samples were taken. Each stream keeps a recursive least
+squares fit of receive time against sample index, and stamps samples from the
+fit instead. See https://arxiv.org/pdf/1308.3846.pdf.
+"""
+
+import numpy as np
+
+
+class Dejitter:
+    """Regularly spaced timestamps for a stream sampled at `sfreq`"""
+
+    def __init__(self, sfreq):
+        """
+        sfreq: The nominal sampling frequency of the stream.
+        """
+
+        self.sfreq = sfreq
+        self.sample_index = 0
+        self.reg_params = None
+        self._P = 1e-4
+
+    def timestamps(self, n_samples, t_receiver, skipped=0):
+        """
+        Gets the timestamps of a packet's samples.
+
+        n_samples: Number of samples in the packet.
+        t_receiver: When the packet was received.
+        skipped: Number of packets lost since the previous one, so that the
+            sample index stays aligned with the device's.
+        """
+
+        if self.reg_params is None:
+            self.reg_params = np.array([t_receiver, 1.0 / self.sfreq])
+
+        self.sample_index += n_samples * skipped
+        idxs = np.arange(n_samples) + self.sample_index
+        self.sample_index += n_samples
+
+        self._update(idxs[-1], t_receiver)
+        return self.reg_params[1] * idxs + self.reg_params[0]
+
+    def _update(self, t_source, t_receiver):
+        # remove the offset
+        t_receiver = t_receiver - self.reg_params[0]
+
+        # least square estimation
+        P = self._P
+        R = self.reg_params[1]
+        P = P - ((P**2) * (t_source**2)) / (1 - (P * (t_source**2)))
+        R = R + P * t_source * (t_receiver - t_source * R)
+
+        # update parameters
+        self.reg_params[1] = R
+        self._P = P
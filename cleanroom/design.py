@@ -0,0 +1,106 @@
+"""
+Memoized filter and window designs.
+
+Designing a filter or building a window takes far longer than applying it,
+and the same few are needed over and over: per chunk, per headset, and again
+whenever bands or filters are reconfigured. Designs are cached here by their
+parameters, with LRU eviction, and handed out as read-only arrays so that one
+copy can safely be shared by every caller. `cache_info` reports the hits and
+misses of every cache.
+"""
+
+from functools import lru_cache, wraps
+
+import numpy as np
+
+WINDOWS = {
+    "hamming": np.hamming,
+    "hanning": np.hanning,
+    "blackman": np.blackman,
+    "bartlett": np.bartlett,
+}
+
+_caches = {}
+
+
+def _read_only(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, tuple):
+        for item in value:
+            _read_only(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _read_only(item)
+    return value
+
+
+def memoize(maxsize=64):
+    """
+    Caches a design function by its (hashable) arguments, makes the arrays
+    it returns read-only and registers the cache with `cache_info`.
+    """
+
+    def decorator(func):
+        @lru_cache(maxsize=maxsize)
+        def cached(*args):
+            return _read_only(func(*args))
+
+        @wraps(func)
+        def wrapper(*args):
+            return cached(*args)
+
+        wrapper.cache_info = cached.cache_info
+        wrapper.cache_clear = cached.cache_clear
+        _caches["%s.%s" % (func.__module__.rsplit(".", 1)[-1], func.__name__)] = cached
+        return wrapper
+
+    return decorator
+
+
+@memoize()
+def butter(order, edges, btype, fs):
+    """
+    Designs a Butterworth filter.
+
+    order: The order of the filter.
+    edges: The critical frequency, or a tuple of the band edges, in Hz.
+    btype: "lowpass", "highpass", "bandpass" or "bandstop".
+    fs: The sampling frequency.
+
+    Returns a tuple of the (b, a) coefficients.
+    """
+
+    # scipy.signal takes a second to import, so only do it once needed
+    from scipy.signal import butter
+
+    return butter(order, np.asarray(edges) / (fs / 2), btype=btype)
+
+
+@memoize()
+def butter_zi(order, edges, btype, fs):
+    """The initial state of `butter(order, edges, btype, fs)` for a step
+    response, per unit of input"""
+    from scipy.signal import lfilter_zi
+
+    b, a = butter(order, edges, btype, fs)
+    return lfilter_zi(b, a)
+
+
+@memoize()
+def window(name, length):
+    """
+    Builds a window function.
+
+    name: The name of the window, from `WINDOWS`.
+    length: Number of samples.
+    """
+
+    if name not in WINDOWS:
+        raise(ValueError("Unknown window: {}".format(name)))
+    return WINDOWS[name](length)
+
+
+def cache_info():
+    """Gets the `functools` cache info of every design cache, by name"""
+    return {name: cached.cache_info() for name, cached in _caches.items()}
@@ -0,0 +1,127 @@
+"""
+Feature computation for several headsets on a pool of processes.
+
+Each headset has a `FeatureEngine`, which lives in one of the worker
+processes for as long as the headset is registered: headsets are spread over
+the workers as they're added, and every chunk of a headset goes to its
+worker. Only the chunks and the results cross between processes, not the
+engine, and as a worker runs its tasks one at a time, in the order they were
+submitted, the chunks of a headset are processed in order. The headsets on
+different workers run in parallel, so DSP scales with the number of cores
+independently of whichever thread feeds the executor and consumes results. A
+single headset only ever uses one worker, which takes its DSP off the
+feeding process but can't make it any faster.
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# The engines of the headsets on this worker process, by key
+_engines = {}
+
+
+def _add(key, engine):
+    _engines[key] = engine
+
+
+def _remove(key):
+    _engines.pop(key, None)
+
+
+def _configure(key, params):
+    _engines[key].configure(**params)
+
+
+def _process(key, timestamps, data):
+    return _engines[key].process(timestamps, data)
+
+
+class FeatureExecutor:
+    """Runs per-headset `FeatureEngine`s on a pool of worker processes"""
+
+    def __init__(self, workers=None):
+        """
+        workers: Number of worker processes, defaulting to the number of
+            cores. Only as many as there are headsets are started.
+        """
+
+        self.workers = workers or os.cpu_count() or 1
+        # A single process executor per worker, so that each keeps its
+        # engines and runs their tasks in order
+        self._pools = []
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        return self._pools[self._keys[key]]
+
+    def add(self, key, engine):
+        """Registers the `FeatureEngine` of a headset under `key`, and sends
+        it to the worker with the fewest headsets"""
+        with self._lock:
+            if key in self._keys:
+                self._pool(key).submit(_remove, key)
+                del self._keys[key]
+
+            load = [0] * len(self._pools)
+            for index in self._keys.values():
+                load[index] += 1
+
+            if len(self._pools) < self.workers and (not load or min(load) > 0):
+                self._pools.append(ProcessPoolExecutor(1))
+                load.append(0)
+
+            index = load.index(min(load))
+            self._keys[key] = index
+            self._pools[index].submit(_add, key, engine)
+
+    def remove(self, key):
+        """Forgets a headset. Chunks already submitted still complete."""
+        with self._lock:
+            if key in self._keys:
+                self._pool(key).submit(_remove, key)
+                del self._keys[key]
+
+    def configure(self, key, **params):
+        """
+        Changes the parameters of a headset's engine from its next chunk on,
+        see `FeatureEngine.configure`. Raises ValueError on invalid
+        parameters, which are checked before they're sent to the worker.
+        """
+
+        # Check them on a throwaway engine, as the worker's can't report back
+        # but through the next chunk
+        from .transform import FeatureEngine
+        FeatureEngine().configure(**params)
+
+        with self._lock:
+            self._pool(key).submit(_configure, key, params)
+
+    def submit(self, key, timestamps, data):
+        """
+        Queues a chunk of a headset's samples.
+
+        key: The key the headset's engine was added under.
+        timestamps: array of the samples' timestamps.
+        data: array of shape [samples, channels].
+
+        Returns a `concurrent.futures.Future` of the (features, quality,
+        artifact) tuple `FeatureEngine.process` returns.
+        """
+
+        with self._lock:
+            return self._pool(key).submit(_process, key, timestamps, data)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pools, self._pools = self._pools, []
+            self._keys.clear()
+        for pool in pools:
+            pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
@@ -1,11 +1,17 @@
 from .muse import Muse
-from .models import Sample
+from . import metrics
+from .models import Gap, Sample, SensorData, Telemetry
+from .presets import EEG_CHANNELS, get_layout
+from .record import Recorder
+from .scheduler import DeviceTasks, Scheduler
 import time
+import threading
 from multiprocessing import Process, Queue
 
 from queue import Empty
 from functools import partial
 import mne_lsl.lsl
+import numpy as np
 
 
 def play_sound():
@@ -14,44 +20,170 @@ def play_sound():
         time.sleep(1)
 
 
-def _target(queue, address=None, backend=None, interface=None, name=None):
+def _enqueue_samples(queue, data, timestamps, stamps=None):
+    """
+    Splits a block into `Sample`s and puts them on the queue. The block's
+    instrumentation stamps, if any, are carried by its last sample.
+    """
+    for i in range(11):
+        queue.put(Sample(timestamps[i], data[:, i]))
+
+    if stamps is not None:
+        stamps = stamps + (metrics.stamp(),)
+    queue.put(Sample(timestamps[11], data[:, 11], stamps))
+
+
+def _observe(sample, queue):
+    """Records the acquisition metrics of a sample taken off the queue"""
+    metrics.counter("cleanroom_samples", "EEG samples received").inc()
+
+    stamps = sample.stamps
+    if stamps is None:
+        return
+
+    first_received, received, decoded, dejittered, queued = stamps
+    metrics.stage("receive").observe(received - first_received)
+    metrics.stage("decode").observe(decoded - received)
+    metrics.stage("dejitter").observe(dejittered - decoded)
+    metrics.stage("queue").observe(metrics.stamp() - queued)
+    metrics.counter("cleanroom_packets", "EEG packets received").inc()
+
+    try:
+        metrics.gauge("cleanroom_queue_depth", "Items waiting in a queue",
+                      {"queue": "acquisition"}).set(queue.qsize())
+    except NotImplementedError:
+        # `qsize` isn't available on macOS
+        pass
+
+
+# LSL metadata of the auxiliary sensors: rate, channel names and units
+SENSORS = {
+    "acc": ("ACC", 52, ["X", "Y", "Z"], "g"),
+    "gyro": ("GYRO", 52, ["X", "Y", "Z"], "dps"),
+    "ppg": ("PPG", 64, ["PPG1", "PPG2", "PPG3"], "mmHg"),
+}
+
+
+def _sensor_outlet(sensor, address):
+    """Creates the LSL outlet of an auxiliary sensor"""
+    stype, sfreq, names, unit = SENSORS[sensor]
+    info = mne_lsl.lsl.StreamInfo(
+        "Muse",
+        stype=stype,
+        n_channels=len(names),
+        sfreq=sfreq,
+        dtype="float32",
+        source_id=f"Muse_{address}_{sensor}",
+    )
+    info.desc.append_child_value("manufacturer", "Muse")
+    info.set_channel_names(names)
+    info.set_channel_types(["misc"] * len(names))
+    info.set_channel_units(unit)
+    return mne_lsl.lsl.StreamOutlet(info)
+
+
+def _eeg_outlet(address, chunk_size=6, layout=None):
+    """Creates the LSL outlet of a headset's EEG, or of a recording's, with
+    the channels of `layout`, a `presets.Layout`"""
+    layout = layout or get_layout()
+    info = mne_lsl.lsl.StreamInfo(
+        "Muse",
+        stype="EEG",
+        n_channels=layout.n_channels,
+        sfreq=layout.sfreq,
+        dtype="float32",
+        source_id=f"Muse_{address}",
+    )
+    info.desc.append_child_value("manufacturer", "Muse")
+    if layout.preset is not None:
+        info.desc.append_child_value("preset", layout.preset)
+    info.set_channel_names(list(layout.channels))
+    info.set_channel_types(["eeg" if name in EEG_CHANNELS else "misc" for name in layout.channels])
+    info.set_channel_units("microvolts")
+    return mne_lsl.lsl.StreamOutlet(info, chunk_size=chunk_size)
+
+
+def _target(queue, address=None, backend=None, interface=None, name=None,
+            record=None, accelero=False, giro=False, ppg=False, preset=None,
+            disable_light=False, stall_timeout=10, lsl_chunk_size=6):
     def add_to_queue(data, timestamps):
-        for i in range(12):
-            queue.put(Sample(timestamps[i], data[:, i]))
+        _enqueue_samples(queue, data, timestamps, muse.stamps)
 
     try:
-        
-        ##################################################
+        # Only the channels the preset streams are decoded, sent and stored
+        layout = get_layout(preset)
+        eeg_outlet = _eeg_outlet(address, lsl_chunk_size, layout)
 
-       
-        eeg_info = mne_lsl.lsl.StreamInfo(
+        # Telemetry arrives a few times a second, so it gets its own
+        # irregular rate stream rather than riding along with the EEG
+        telemetry_info = mne_lsl.lsl.StreamInfo(
             "Muse",
-            stype="EEG",
-            n_channels=5,
-            sfreq=256,
+            stype="Telemetry",
+            n_channels=4,
+            sfreq=0,
             dtype="float32",
-            source_id=f"Muse_{address}",
+            source_id=f"Muse_{address}_telemetry",
         )
-        eeg_info.desc.append_child_value("manufacturer", "Muse")
-        eeg_info.set_channel_names(["TP9", "AF7", "AF8", "TP10", "AUX"])
-        eeg_info.set_channel_types(["eeg"] * 5)
-        eeg_info.set_channel_units("microvolts")
+        telemetry_info.desc.append_child_value("manufacturer", "Muse")
+        telemetry_info.set_channel_names(["battery", "fuel_gauge", "adc_volt", "temperature"])
+        telemetry_info.set_channel_types(["misc"] * 4)
+        telemetry_info.set_channel_units(["percent", "millivolts", "millivolts", "celsius"])
+
+        telemetry_outlet = mne_lsl.lsl.StreamOutlet(telemetry_info)
 
-        eeg_outlet = mne_lsl.lsl.StreamOutlet(eeg_info, chunk_size=6)
+        # Optionally record the session to disk, next to the LSL outlet
+        recorder = Recorder(record, n_channels=layout.n_channels, sfreq=layout.sfreq) if record else None
 
         def push(data, timestamps, outlet):
             outlet.push_chunk(data.T, timestamps[-1])
+            if recorder is not None:
+                recorder.record_eeg(data, timestamps)
+
+        def on_gap(tm, last_tm):
+            queue.put(Gap(time.time(), tm, last_tm))
+            if recorder is not None:
+                recorder.record_gap(tm, last_tm)
+
+        def on_telemetry(telemetry):
+            telemetry_outlet.push_sample(np.array(telemetry.values, dtype=np.float32), telemetry.timestamp)
+            queue.put(telemetry)
+            if recorder is not None:
+                recorder.record_telemetry(telemetry.values)
 
         push_eeg = partial(push, outlet=eeg_outlet)
 
+        # Each enabled auxiliary sensor gets its own outlet and its own queue
+        # items, away from the EEG path
+        def push_sensor(data, timestamps, outlet, sensor):
+            outlet.push_chunk(np.ascontiguousarray(data.T, dtype=np.float32), timestamps[-1])
+            queue.put(SensorData(sensor, timestamps, data.copy()))
+
+        sensor_callbacks = {}
+        for sensor, enabled in (("acc", accelero), ("gyro", giro), ("ppg", ppg)):
+            if enabled:
+                sensor_callbacks[sensor] = partial(push_sensor, outlet=_sensor_outlet(sensor, address), sensor=sensor)
+
         ##################################################
         muse = Muse(
             address=address,
             callback=add_to_queue,
             callback_eeg=push_eeg,
+            callback_gap=on_gap,
+            callback_telemetry=on_telemetry,
+            callback_acc=sensor_callbacks.get("acc"),
+            callback_gyro=sensor_callbacks.get("gyro"),
+            callback_ppg=sensor_callbacks.get("ppg"),
+            accelero=accelero,
+            giro=giro,
+            ppg=ppg,
             backend=backend,
             interface=interface,
-            name=name
+            name=name,
+            preset=preset,
+            disable_light=disable_light,
+            # Stamp the samples in the LSL clock, which is what LSL
+            # consumers synchronize streams with
+            time_func=mne_lsl.lsl.local_clock,
         )
 
         connect = muse.connect()
@@ -63,16 +195,28 @@ def _target(queue, address=None, backend=None, interface=None, name=None):
         print('Streaming ...', initial_time )
         play_sound()
 
+        # Keep-alive, status polling and the stall watchdog all run on the
+        # scheduler's thread, leaving this one to wait for a stall
+        stalled = threading.Event()
+        scheduler = Scheduler()
+        tasks = DeviceTasks(scheduler, muse, stall_timeout=stall_timeout,
+                            on_stall=lambda muse: stalled.set())
+        scheduler.start()
+
         try:
-            while True:
-                time.sleep(1)
+            stalled.wait()
+            print("No data received for %d seconds. Disconnecting..." % stall_timeout)
         except KeyboardInterrupt:
             print()
             print('Start Time__', initial_time, "__End time __", time.strftime("%H:%M:%S", time.localtime(time.time())) )
             print()
         finally:
+            tasks.cancel()
+            scheduler.stop()
             muse.stop()
             muse.disconnect()
+            if recorder is not None:
+                recorder.close()
             print("Disconnected ")
             play_sound()
             print('Start Time__', initial_time, "__End time __", time.strftime("%H:%M:%S", time.localtime(time.time())) )
@@ -82,7 +226,22 @@ def _target(queue, address=None, backend=None, interface=None, name=None):
         print(f"An error occurred: {e}", '___ 75 ___')
         print()
 
-def get_raw(timeout=30, **kwargs):
+def get_raw(timeout=30, on_telemetry=None, on_sensor=None, **kwargs):
+    """
+    Connects to a headset in a separate process, and yields its EEG
+    `Sample`s.
+
+    timeout: Seconds without data after which the stream stops.
+    on_telemetry: Called with each `Telemetry` reading, on the consuming
+        thread.
+    on_sensor: Called with each `SensorData` block of the accelerometer,
+        gyroscope or PPG, on the consuming thread.
+    kwargs: Passed on to `Muse`, along with `record`, the path of a file to
+        record the session to, `accelero`, `giro` and `ppg` to enable the
+        auxiliary sensors, `preset` and `disable_light`, and `lsl_chunk_size`,
+        the number of samples per chunk of the EEG outlet.
+    """
+
     q = Queue()
     p = Process(target=_target, args=(q,), kwargs=kwargs)
     p.daemon = True
@@ -94,7 +253,20 @@ def get_raw(timeout=30, **kwargs):
                 item = q.get(timeout=timeout)
                 if isinstance(item, Exception):
                     raise item
+                elif isinstance(item, Telemetry):
+                    if metrics.ENABLED:
+                        metrics.gauge("cleanroom_battery_percent", "Headset battery charge").set(item.battery)
+                    if on_telemetry:
+                        on_telemetry(item)
+                elif isinstance(item, SensorData):
+                    if on_sensor:
+                        on_sensor(item)
+                elif isinstance(item, Gap):
+                    if metrics.ENABLED:
+                        metrics.counter("cleanroom_dropped_packets", "EEG packets lost").inc(item.missing)
                 else:
+                    if metrics.ENABLED:
+                        _observe(item, q)
                     yield item
             except Empty:
                 print("Queue is empty, stopping the stream.")
@@ -0,0 +1,276 @@
+"""
+An in-process stand-in for a pygatt backend that emulates a Muse headset.
+
+`FakeBackend` implements the parts of the pygatt backend/device surface that
+`Muse` uses (`start`, `stop`, `scan`, `connect`, `subscribe`,
+`char_write_handle`, `disconnect`), answers the control commands, and emits
+correctly encoded 20-byte EEG and telemetry notifications at 256 Hz, along
+with accelerometer, gyroscope and PPG notifications at their own rates, from
+synthetic data on its own thread, the same way pygatt delivers notifications.
+"""
+
+import json
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .replay import synthesize
+
+# Characteristic UUIDs and the handles their notifications arrive on
+UUID_HANDLES = {
+    "273e0001-4c4d-454d-96be-f03bac821358": 14,  # control
+    "273e0003-4c4d-454d-96be-f03bac821358": 32,  # TP9
+    "273e0004-4c4d-454d-96be-f03bac821358": 35,  # AF7
+    "273e0005-4c4d-454d-96be-f03bac821358": 38,  # AF8
+    "273e0006-4c4d-454d-96be-f03bac821358": 41,  # TP10
+    "273e0007-4c4d-454d-96be-f03bac821358": 44,  # AUX
+    "273e000b-4c4d-454d-96be-f03bac821358": 26,  # telemetry
+    "273e0009-4c4d-454d-96be-f03bac821358": 20,  # gyroscope
+    "273e000a-4c4d-454d-96be-f03bac821358": 23,  # accelerometer
+    "273e000f-4c4d-454d-96be-f03bac821358": 56,  # PPG ambient
+    "273e0010-4c4d-454d-96be-f03bac821358": 59,  # PPG infrared
+    "273e0011-4c4d-454d-96be-f03bac821358": 62,  # PPG red
+}
+
+# The order the headset sends the EEG channels of a packet in
+EEG_HANDLES = [44, 41, 38, 32, 35]
+CONTROL_HANDLE = 14
+TELEMETRY_HANDLE = 26
+GYRO_HANDLE = 20
+ACC_HANDLE = 23
+PPG_HANDLES = [56, 59, 62]
+COMMAND_HANDLE = 0x000e
+
+
+def encode_eeg(data, counter):
+    """
+    Encodes a block of EEG into Muse notification packets.
+
+    data: array of shape [channels, 12] in microvolts.
+    counter: The 16-bit packet counter.
+
+    Returns an array of shape [channels, 20] of packet bytes.
+    """
+
+    samples = np.clip(np.rint(data / 0.48828125 + 2048), 0, 4095).astype(np.uint16)
+    a = samples[:, 0::2]
+    b = samples[:, 1::2]
+
+    packets = np.empty((samples.shape[0], 20), dtype=np.uint8)
+    packets[:, 0] = (counter >> 8) & 0xFF
+    packets[:, 1] = counter & 0xFF
+    packets[:, 2::3] = a >> 4
+    packets[:, 3::3] = ((a & 0xF) << 4) | (b >> 8)
+    packets[:, 4::3] = b & 0xFF
+    return packets
+
+
+def encode_telemetry(counter, battery, fuel_gauge=3700.0, adc_volt=2800, temperature=30):
+    """Encodes a telemetry notification packet"""
+    packet = struct.pack(">5H", counter & 0xFFFF, int(battery * 512),
+                         int(fuel_gauge / 2.2), int(adc_volt), int(temperature))
+    return packet.ljust(20, b"\x00")
+
+
+def encode_imu(samples, scale, counter):
+    """
+    Encodes 3 accelerometer or gyroscope samples, an array of shape
+    [axes, samples], into a notification packet.
+    """
+    values = np.clip(np.rint(samples.T / scale), -32768, 32767).astype(int)
+    return struct.pack(">H9h", counter & 0xFFFF, *values.reshape(-1))
+
+
+def encode_ppg(samples, counter):
+    """Encodes 6 PPG samples into a notification packet"""
+    packet = bytearray(struct.pack(">H", counter & 0xFFFF))
+    for value in np.clip(samples, 0, 0xFFFFFF).astype(int):
+        packet += int(value).to_bytes(3, "big")
+    return bytes(packet)
+
+
+def encode_control(message):
+    """Splits a control message into 20-byte notification packets"""
+    raw = message.encode("ascii")
+    packets = []
+    for i in range(0, len(raw), 19):
+        chunk = raw[i:i + 19]
+        packets.append((bytes([len(chunk)]) + chunk).ljust(20, b"\x00"))
+    return packets
+
+
+class FakeBackend:
+    """A pygatt-like backend serving a single emulated Muse headset"""
+
+    def __init__(self, address="00:55:DA:00:00:00", name="Muse-FAKE", speed=1.0,
+                 jitter=0.0, reorder=0.0, loss=0.0, battery=80.0, seed=None,
+                 **synthesize_kwargs):
+        """
+        address: The MAC address the headset reports.
+        name: The name the headset advertises.
+        speed: How fast to stream relative to real time (256 Hz), or None for
+            as fast as possible.
+        jitter: Maximum random delay, in seconds, added to each notification.
+        reorder: Probability of swapping two consecutive notifications.
+        loss: Probability of dropping a notification.
+        battery: The battery percentage reported in telemetry.
+        seed: Seed for the random number generator.
+        synthesize_kwargs: Passed on to `synthesize`, e.g. `bands` or `noise`.
+        """
+
+        self.address = address
+        self.name = name
+        self.speed = speed
+        self.jitter = jitter
+        self.reorder = reorder
+        self.loss = loss
+        self.battery = battery
+        self.seed = seed
+        self.synthesize_kwargs = synthesize_kwargs
+        self.devices = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        for device in self.devices:
+            device.disconnect()
+        self.devices = []
+
+    def scan(self, timeout=10, **kwargs):
+        return [{"name": self.name, "address": self.address}]
+
+    def connect(self, address, **kwargs):
+        device = FakeDevice(self, address)
+        self.devices.append(device)
+        return device
+
+
+class FakeDevice:
+    """A connected, emulated Muse headset"""
+
+    def __init__(self, backend, address):
+        self.backend = backend
+        self.address = address
+        self.preset = "21"
+        self.callbacks = {}
+        self.keep_alive_time = time.monotonic()
+        self.rng = np.random.default_rng(backend.seed)
+        self._thread = None
+        self._streaming = threading.Event()
+
+    def subscribe(self, uuid, callback=None, indication=False, wait_for_response=True):
+        self.callbacks[UUID_HANDLES[uuid]] = callback
+
+    def char_write_handle(self, handle, value, wait_for_response=False):
+        if handle != COMMAND_HANDLE:
+            return
+
+        value = bytes(value)
+        command = value[1:value[0]].decode("ascii")
+
+        if command == "d":
+            self._start_streaming()
+        elif command == "h":
+            self._streaming.clear()
+        elif command == "k":
+            self.keep_alive_time = time.monotonic()
+        elif command.startswith("p"):
+            self.preset = command[1:]
+            self._respond({"rc": 0})
+        elif command == "v1":
+            self._respond({"ap": "headset", "sp": "Fake", "tp": "consumer",
+                           "hw": "0.0", "bn": 0, "fw": "0.0.0", "bl": "0.0.0",
+                           "pv": 1, "rc": 0})
+        elif command == "s":
+            self._respond({"hn": self.backend.name, "sn": "0000-0000-0000",
+                           "ma": self.address, "id": "00000000", "bp": int(self.backend.battery),
+                           "ts": 0, "ps": int(self.preset), "rc": 0})
+        else:
+            self._respond({"rc": 0})
+
+    def disconnect(self):
+        self._streaming.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _notify(self, handle, packet):
+        callback = self.callbacks.get(handle)
+        if callback is not None:
+            callback(handle, bytearray(packet))
+
+    def _respond(self, message):
+        for packet in encode_control(json.dumps(message, separators=(",", ":"))):
+            self._notify(CONTROL_HANDLE, packet)
+
+    def _start_streaming(self):
+        if self._streaming.is_set():
+            return
+        self._streaming.set()
+        self._thread = threading.Thread(target=self._stream)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stream(self):
+        backend = self.backend
+        rng = self.rng
+        speed = backend.speed
+        handles = [h for h in EEG_HANDLES if h in self.callbacks]
+        blocks = synthesize(n_channels=5, seed=backend.seed, **backend.synthesize_kwargs)
+
+        period = 12 / 256
+        origin = time.monotonic()
+        counter = 0
+        imu_count = 0
+        ppg_count = 0
+
+        for i, (data, _) in enumerate(blocks):
+            if not self._streaming.is_set():
+                break
+
+            if speed:
+                delay = i * period / speed - (time.monotonic() - origin)
+                if delay > 0:
+                    time.sleep(delay)
+
+            packets = encode_eeg(data, counter)
+            notifications = [(h, packets[(h - 32) // 3]) for h in handles]
+
+            # Roughly once a second of stream time, report telemetry
+            if i % 21 == 0:
+                notifications.append((TELEMETRY_HANDLE, encode_telemetry(i // 21, backend.battery)))
+
+            # The other sensors run at their own rates, so emit however many of
+            # their packets are due by the end of this block
+            now = (i + 1) * period
+            while imu_count * 3 / 52 < now:
+                t = (imu_count * 3 + np.arange(3)) / 52
+                motion = np.stack([np.sin(t), np.cos(t), np.full(3, 1.0)])
+                if ACC_HANDLE in self.callbacks:
+                    notifications.append((ACC_HANDLE, encode_imu(motion, 0.0000610352, imu_count)))
+                if GYRO_HANDLE in self.callbacks:
+                    notifications.append((GYRO_HANDLE, encode_imu(motion * 10, 0.0074768, imu_count)))
+                imu_count += 1
+            while ppg_count * 6 / 64 < now:
+                t = (ppg_count * 6 + np.arange(6)) / 64
+                pulse = 100000 + 20000 * np.sin(2 * np.pi * 1.2 * t)
+                for handle in PPG_HANDLES:
+                    if handle in self.callbacks:
+                        notifications.append((handle, encode_ppg(pulse, ppg_count)))
+                ppg_count += 1
+
+            if backend.reorder and len(notifications) > 1 and rng.random() < backend.reorder:
+                j = rng.integers(len(notifications) - 1)
+                notifications[j], notifications[j + 1] = notifications[j + 1], notifications[j]
+
+            for handle, packet in notifications:
+                if backend.loss and rng.random() < backend.loss:
+                    continue
+                if backend.jitter:
+                    time.sleep(rng.uniform(0, backend.jitter))
+                self._notify(handle, packet)
+
+            counter = (counter + 1) & 0xFFFF
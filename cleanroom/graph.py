@@ -0,0 +1,357 @@
+"""
+The DSP stage as a small graph of nodes.
+
+Each node reads named values from a frame, a dict that starts out holding the
+new chunk of samples, and adds its own outputs to it:
+
+    Filter   chunk -> filtered
+    Window   filtered (or chunk) -> window
+    Spectrum window -> nfft, psd
+    Bands    nfft -> band_indices
+    Features nfft, psd, band_indices -> features
+
+A `FeatureEngine` runs one graph per headset. A new graph can be swapped in
+while streaming: it takes over the state of the nodes it replaces where that
+state still fits, e.g. the filter state when the filter is the same and the
+window's samples even if its length changes, so the features carry on without
+a gap or a filter transient. Graphs are described by JSON-able specs, so they
+can be sent over HTTP or between processes.
+"""
+
+import numpy as np
+
+from . import design
+from .transform import (BAND_EDGES, BANDS, FEATURES, NOTCH, RATIOS, SAMPLING_FREQUENCY,
+                        _band_indices, _features_from_bands, _spectrum)
+
+# The longest window, in samples, so that a spec can't ask for more memory
+# than the DSP has
+MAX_WINDOW = 16 * SAMPLING_FREQUENCY
+
+
+class Node:
+    """A stage of the graph"""
+
+    # The type of the node in specs
+    type = None
+    # The values the node reads from the frame, and adds to it
+    inputs = ()
+    outputs = ()
+    # Whether the node keeps state between chunks, which has to be updated
+    # even when the features of a chunk aren't needed
+    stateful = False
+
+    def process(self, frame):
+        raise(NotImplementedError)
+
+    def adopt(self, other):
+        """Takes over the state of `other`, the node this one replaces, where
+        it's compatible"""
+
+    def spec(self):
+        """Describes the node as a JSON-able dict, see `node_from_spec`"""
+        return {"type": self.type}
+
+
+class Filter(Node):
+    """An IIR filter, by default the line noise notch filter"""
+
+    type = "filter"
+    inputs = ("chunk",)
+    outputs = ("filtered",)
+    stateful = True
+
+    def __init__(self, order=NOTCH[0], band=NOTCH[1], btype=NOTCH[2], fs=NOTCH[3]):
+        """
+        order, band, btype, fs: The arguments of `design.butter`.
+        """
+
+        band = tuple(band) if isinstance(band, (list, tuple)) else band
+        if int(order) < 1:
+            raise(ValueError("Filter order must be at least 1"))
+        if btype not in ("lowpass", "highpass", "bandpass", "bandstop"):
+            raise(ValueError("Unknown filter type: {}".format(btype)))
+        if not all(0 < edge < fs / 2 for edge in np.atleast_1d(band)):
+            raise(ValueError("Filter edges must be between 0 and {} Hz".format(fs / 2)))
+
+        self.params = (int(order), band, btype, fs)
+        self.state = None
+
+    def process(self, frame):
+        from scipy.signal import lfilter
+
+        chunk = frame["chunk"]
+        b, a = design.butter(*self.params)
+        if self.state is None:
+            self.state = np.tile(design.butter_zi(*self.params), (chunk.shape[1], 1)).T
+        frame["filtered"], self.state = lfilter(b, a, chunk, axis=0, zi=self.state)
+
+    def adopt(self, other):
+        # The state only means something to the same filter
+        if isinstance(other, Filter) and other.params == self.params:
+            self.state = other.state
+
+    def spec(self):
+        order, band, btype, fs = self.params
+        return {"type": self.type, "order": order, "band": band, "btype": btype, "fs": fs}
+
+
+class Window(Node):
+    """The last `length` samples"""
+
+    type = "window"
+    inputs = ()
+    outputs = ("window",)
+    stateful = True
+
+    def __init__(self, length=SAMPLING_FREQUENCY):
+        """
+        length: Number of samples.
+        """
+
+        self.length = int(length)
+        if not 2 <= self.length <= MAX_WINDOW:
+            raise(ValueError("Windows must be between 2 and {} samples long".format(MAX_WINDOW)))
+        self.buffer = None
+
+    def process(self, frame):
+        new = frame.get("filtered", frame["chunk"])
+        if self.buffer is None:
+            self.buffer = np.zeros((self.length, new.shape[1]))
+
+        buffer = np.concatenate((self.buffer, new), axis=0)
+        self.buffer = frame["window"] = buffer[len(buffer) - self.length:]
+
+    def adopt(self, other):
+        # Keep as many of the latest samples as fit
+        if isinstance(other, Window) and other.buffer is not None:
+            n = min(self.length, other.length)
+            self.buffer = np.zeros((self.length, other.buffer.shape[1]))
+            self.buffer[self.length - n:] = other.buffer[other.length - n:]
+
+    def spec(self):
+        return {"type": self.type, "length": self.length}
+
+
+class Spectrum(Node):
+    """The magnitude spectrum of the window, after a window function"""
+
+    type = "spectrum"
+    inputs = ("window",)
+    outputs = ("nfft", "psd")
+
+    def __init__(self, taper="hamming"):
+        """
+        taper: The window function, from `design.WINDOWS`.
+        """
+
+        if taper not in design.WINDOWS:
+            raise(ValueError("Unknown window function: {}".format(taper)))
+        self.taper = taper
+
+    def process(self, frame):
+        frame["nfft"], frame["psd"] = _spectrum(frame["window"], self.taper)
+
+    def spec(self):
+        return {"type": self.type, "taper": self.taper}
+
+
+class Bands(Node):
+    """The frequencies of the spectrum in each band"""
+
+    type = "bands"
+    inputs = ("nfft",)
+    outputs = ("band_indices",)
+
+    def __init__(self, edges=BAND_EDGES):
+        """
+        edges: The bands, like `BAND_EDGES`, or a dict of name to (low, high).
+        """
+
+        if isinstance(edges, dict):
+            edges = [(name,) + tuple(edge) for name, edge in edges.items()]
+        self.edges = tuple((name, float(low), float(high)) for name, low, high in edges)
+
+        for name, low, high in self.edges:
+            if name not in BANDS:
+                raise(ValueError("Unknown band: {}".format(name)))
+            if not 0 <= low < high:
+                raise(ValueError("Band {} must have 0 <= low < high".format(name)))
+
+    def process(self, frame):
+        frame["band_indices"] = _band_indices(frame["nfft"], self.edges)
+
+    def spec(self):
+        return {"type": self.type, "edges": {name: [low, high] for name, low, high in self.edges}}
+
+
+def _required_bands(name):
+    """Gets the bands a feature is computed from"""
+    if name in BANDS:
+        return {name}
+    elif name.startswith("relative_"):
+        return {name[9:]}
+    elif name in RATIOS:
+        return set(RATIOS[name])
+    elif name == "peak_alpha":
+        return {"alpha"}
+    return set()
+
+
+class Features(Node):
+    """The features, from the spectrum and the bands"""
+
+    type = "features"
+    inputs = ("nfft", "psd", "band_indices")
+    outputs = ("features",)
+
+    def __init__(self, names=BANDS):
+        """
+        names: The names of the features, from `FEATURES`.
+        """
+
+        self.names = tuple(names)
+        unknown = set(self.names) - set(FEATURES)
+        if unknown:
+            raise(ValueError("Unknown features: {}".format(", ".join(sorted(unknown)))))
+
+    def process(self, frame):
+        frame["features"] = _features_from_bands(frame["nfft"], frame["psd"], self.names,
+                                                 frame["band_indices"])
+
+    def spec(self):
+        return {"type": self.type, "names": list(self.names)}
+
+
+NODES = {node.type: node for node in (Filter, Window, Spectrum, Bands, Features)}
+
+
+def node_from_spec(spec):
+    """Builds a node from its spec, e.g. `{"type": "window", "length": 512}`"""
+    if not isinstance(spec, dict) or spec.get("type") not in NODES:
+        raise(ValueError("Node specs need a type among {}".format(", ".join(NODES))))
+
+    params = {key: value for key, value in spec.items() if key != "type"}
+    try:
+        return NODES[spec["type"]](**params)
+    except (TypeError, OverflowError) as e:
+        # e.g. a parameter of the wrong type, or an infinite window
+        raise(ValueError("Invalid {} node: {}".format(spec["type"], e)))
+
+
+class Graph:
+    """The nodes of the DSP stage, run in order on each chunk"""
+
+    def __init__(self, nodes):
+        """
+        nodes: The nodes, each after the ones it reads from. Raises
+            ValueError if they can't be run in that order.
+        """
+
+        self.nodes = list(nodes)
+
+        # The spectrum's frequencies are those of the stream's rate
+        for node in self.nodes:
+            if isinstance(node, Filter) and node.params[3] != SAMPLING_FREQUENCY:
+                raise(ValueError("Filters must be designed for the stream's {} Hz".format(SAMPLING_FREQUENCY)))
+
+        available = {"chunk"}
+        for node in self.nodes:
+            missing = set(node.inputs) - available
+            if missing:
+                raise(ValueError("The {} node needs {} first".format(node.type, ", ".join(sorted(missing)))))
+            available.update(node.outputs)
+
+        bands = {name for node in self.nodes if isinstance(node, Bands) for name, _, _ in node.edges}
+        for node in self.nodes:
+            if isinstance(node, Features):
+                for name in node.names:
+                    missing = _required_bands(name) - bands
+                    if missing:
+                        raise(ValueError("The {} feature needs the {} band".format(name, ", ".join(sorted(missing)))))
+
+    def process(self, chunk, complete=True):
+        """
+        Runs the graph on a chunk of samples.
+
+        chunk: array of shape [samples, channels].
+        complete: Whether to run every node, or only the stateful ones, e.g.
+            to keep the filter and window going through a rejected chunk.
+
+        Returns the frame, a dict of the values the nodes computed.
+        """
+
+        frame = {"chunk": chunk}
+        for node in self.nodes:
+            if complete or node.stateful:
+                node.process(frame)
+        return frame
+
+    def adopt(self, other):
+        """Takes over the state of `other`, the graph this one replaces. Each
+        node adopts the state of the first node of the same type."""
+        for node in self.nodes:
+            for previous in other.nodes:
+                if previous.type == node.type:
+                    node.adopt(previous)
+                    break
+
+    def settings(self):
+        """Gets the `build_graph` arguments of the graph, taking the defaults
+        for the nodes it doesn't have"""
+        settings = {"notch": None}
+        for node in self.nodes:
+            if isinstance(node, Filter):
+                settings["notch"] = node.params
+            elif isinstance(node, Window):
+                settings["window"] = node.length
+            elif isinstance(node, Bands):
+                settings["bands"] = node.edges
+            elif isinstance(node, Features):
+                settings["features"] = node.names
+        return settings
+
+    def spec(self):
+        """Describes the graph as a JSON-able dict, see `graph_from_spec`"""
+        return {"nodes": [node.spec() for node in self.nodes]}
+
+
+def graph_from_spec(spec):
+    """
+    Builds a graph from its spec, e.g.
+
+        {"nodes": [{"type": "filter", "order": 4, "band": [45, 55]},
+                   {"type": "window", "length": 512},
+                   {"type": "spectrum"},
+                   {"type": "bands"},
+                   {"type": "features", "names": ["alpha", "peak_alpha"]}]}
+
+    Node parameters that aren't given take their defaults. Raises ValueError
+    if the spec is invalid, or doesn't compute features, which would stop
+    every feature stream.
+    """
+
+    if not isinstance(spec, dict) or not isinstance(spec.get("nodes"), list):
+        raise(ValueError("Graph specs need a list of nodes"))
+    graph = Graph([node_from_spec(node) for node in spec["nodes"]])
+    # Features need the spectrum and the bands before them, see `Graph`
+    if not any(isinstance(node, Features) for node in graph.nodes):
+        raise(ValueError("Graph specs need a features node"))
+    return graph
+
+
+def build_graph(features=BANDS, notch=NOTCH, bands=BAND_EDGES, window=SAMPLING_FREQUENCY):
+    """
+    Builds the usual graph: notch filter, window, spectrum, bands and
+    features.
+
+    features: The names of the features, from `FEATURES`.
+    notch: The arguments of `design.butter` for the line noise filter, or
+        None for no filter.
+    bands: The edges of the bands, like `BAND_EDGES`.
+    window: Number of samples per window.
+    """
+
+    nodes = [] if notch is None else [Filter(*notch)]
+    nodes += [Window(window), Spectrum(), Bands(bands), Features(features)]
+    return Graph(nodes)
@@ -0,0 +1,216 @@
+"""
+Reading EEG from an LSL stream, such as the "Muse" outlet that `get_raw` or
+`cleanroom stream` publish.
+
+This lets one acquisition process feed any number of dashboards and DSP
+processes on the network, instead of each owning a BLE connection. Chunks are
+pulled into buffers allocated once per inlet rather than per pull.
+`Aggregator` reads several streams at once, resampled onto a common time
+grid.
+"""
+
+import time
+
+import numpy as np
+from mne_lsl.lsl import StreamInlet, resolve_streams
+
+from .models import Sample
+from .resample import Aligner
+
+
+class Inlet:
+    """An LSL inlet reading fixed size chunks into preallocated buffers"""
+
+    def __init__(self, name="Muse", stype="EEG", source_id=None, chunk_size=12,
+                 resolve_timeout=10.0, max_buffered=360, processing_flags=None,
+                 info=None):
+        """
+        Resolves a stream and opens an inlet to it.
+
+        name: Name of the stream, or None for any.
+        stype: Type of the stream, or None for any.
+        source_id: Source ID of the stream, e.g. the headset's MAC address for
+            `get_raw`'s outlets, or None for any.
+        chunk_size: Number of samples `read` returns at a time.
+        resolve_timeout: Seconds to wait for the stream to show up.
+        max_buffered: Seconds of data LSL buffers while it isn't read.
+        processing_flags: Passed on to `StreamInlet`, e.g. "clocksync" to
+            map timestamps to this machine's LSL clock.
+        info: The `StreamInfo` of the stream, e.g. from a `Resolver`, to
+            skip resolving it.
+        """
+
+        if info is None:
+            streams = resolve_streams(timeout=resolve_timeout, name=name, stype=stype,
+                                      source_id=source_id)
+            if not streams:
+                raise(ValueError("Can't find LSL stream {}".format(name or stype)))
+            info = streams[0]
+
+        self.info = info
+        self.n_channels = self.info.n_channels
+        self.sfreq = self.info.sfreq
+        self.chunk_size = chunk_size
+
+        self.inlet = StreamInlet(self.info, max_buffered=max_buffered,
+                                 processing_flags=processing_flags)
+        self.inlet.open_stream(timeout=resolve_timeout)
+
+        self.data = np.empty((chunk_size, self.n_channels), dtype=self.info.dtype)
+        self.timestamps = np.empty(chunk_size)
+
+    def read(self, timeout=None):
+        """
+        Reads the next chunk into the inlet's buffers.
+
+        timeout: Seconds to wait for the chunk to fill up, or None to wait
+            forever.
+
+        Returns a tuple of (data, timestamps), where data has the shape
+        [samples, channels]. These are views of the inlet's buffers, so they
+        are only valid until the next call. They hold fewer than
+        `chunk_size` samples if the timeout expired first.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        n = 0
+
+        while n < self.chunk_size:
+            wait = 1.0 if deadline is None else max(0.0, deadline - time.monotonic())
+            # Never pull more than fits, so the chunk is copied exactly once,
+            # out of LSL's own reused buffer and into ours
+            data, timestamps = self.inlet.pull_chunk(timeout=wait, max_samples=self.chunk_size - n)
+            k = len(timestamps)
+            self.data[n:n + k] = data
+            self.timestamps[n:n + k] = timestamps
+            n += k
+
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+        return self.data[:n], self.timestamps[:n]
+
+    def close(self):
+        self.inlet.close_stream()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_lsl(name="Muse", stype="EEG", source_id=None, timeout=30, chunk_size=12, **kwargs):
+    """
+    Yields the `Sample`s of an LSL stream, with the same iterator API as
+    `get_raw`.
+
+    name: Name of the stream, or None for any.
+    stype: Type of the stream, or None for any.
+    source_id: Source ID of the stream, or None for any.
+    timeout: Seconds without data after which the stream stops.
+    chunk_size: Number of samples to pull at a time.
+    kwargs: Passed on to `Inlet`.
+    """
+
+    with Inlet(name, stype, source_id, chunk_size=chunk_size, **kwargs) as inlet:
+        while True:
+            data, timestamps = inlet.read(timeout=timeout)
+            if not len(timestamps):
+                print("No data from the LSL stream, stopping.")
+                break
+
+            # Samples outlive the inlet's buffers, so copy the chunk once
+            data = data.astype(np.float64)
+            for i, timestamp in enumerate(timestamps.tolist()):
+                yield Sample(timestamp, data[i])
+
+
+class Aggregator:
+    """
+    Reads several LSL streams, e.g. one per headset, and resamples them into
+    blocks of shape [devices, channels, samples] on a common time grid.
+    """
+
+    def __init__(self, infos, sfreq=None, chunk_size=12, method="linear",
+                 max_gap=None, max_delay=1.0, **kwargs):
+        """
+        infos: The `StreamInfo`s of the streams, e.g. from
+            `Resolver.streams(prefix="Muse_")`. They must have the same
+            number of channels.
+        sfreq: The frequency of the grid, defaulting to the first stream's.
+        chunk_size: Number of grid points per block.
+        method, max_gap, max_delay: See `Aligner`.
+        kwargs: Passed on to each `Inlet`.
+        """
+
+        if len(set(info.n_channels for info in infos)) > 1:
+            raise(ValueError("Can't aggregate streams with different channel counts"))
+
+        self.infos = list(infos)
+        self.sfreq = sfreq or self.infos[0].sfreq
+        self.chunk_size = chunk_size
+        self.inlets = [Inlet(info=info, chunk_size=max(chunk_size, 64), **kwargs) for info in self.infos]
+        self.aligner = Aligner(len(self.infos), self.infos[0].n_channels, self.sfreq,
+                               method=method, max_gap=max_gap, max_delay=max_delay)
+
+    def _pull(self):
+        # Drains whatever each inlet has, without waiting
+        for i, inlet in enumerate(self.inlets):
+            while True:
+                data, timestamps = inlet.read(timeout=0)
+                if not len(timestamps):
+                    break
+                self.aligner.push(i, timestamps, data)
+
+    def read(self, timeout=None):
+        """
+        Reads the next block.
+
+        timeout: Seconds to wait for the block to be ready, or None to wait
+            forever.
+
+        Returns a tuple of (data, timestamps), where data has the shape
+        [devices, channels, samples]. It holds fewer than `chunk_size`
+        samples if the timeout expired first.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            self._pull()
+            n = self.aligner.available()
+            if n >= self.chunk_size or (deadline is not None and time.monotonic() >= deadline):
+                break
+            time.sleep((self.chunk_size - n) / self.sfreq)
+
+        return self.aligner.read(self.chunk_size)
+
+    def close(self):
+        for inlet in self.inlets:
+            inlet.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_aggregated(infos, timeout=30, **kwargs):
+    """
+    Yields the aligned blocks of several LSL streams, as tuples of (data,
+    timestamps) where data has the shape [devices, channels, samples].
+
+    infos: The `StreamInfo`s of the streams.
+    timeout: Seconds without data after which the stream stops.
+    kwargs: Passed on to `Aggregator`.
+    """
+
+    with Aggregator(infos, **kwargs) as aggregator:
+        while True:
+            data, timestamps = aggregator.read(timeout=timeout)
+            if not len(timestamps):
+                print("No data from the LSL streams, stopping.")
+                break
+            yield data, timestamps
@@ -0,0 +1,249 @@
+"""
+Per-packet kernels.
+
+Each EEG packet is a 20-byte notification holding 12 samples of one channel,
+and the work done on a sample block, a packet of each channel, is tiny:
+unpacking 12-bit samples, scaling them to microvolts, updating the
+dejittering fit and running the samples through an IIR filter. With NumPy on
+such small arrays the Python call overhead costs more than the arithmetic, so
+these are written as loops that numba compiles with `njit` when it's
+installed. Without numba, the same functions are implemented with NumPy (and
+scipy's `lfilter`), each handling every channel of a block in one call, so
+nothing else changes.
+
+Both implementations have the same signatures and fill preallocated outputs.
+`use` picks one at runtime. By default it's numba if it imports, unless the
+`CLEANROOM_KERNELS` environment variable, read when this module is imported,
+says otherwise. numba is only imported once a kernel is first called, so
+importing this module stays cheap.
+
+    # Unpacks the uint8 [channels, 20] array of a block's packets into
+    # [channels, 12] microvolt samples, and returns the packet counter of
+    # the last
+    tm = kernels.decode_eeg(packets, samples)
+
+    # Updates the fit of a stream's `dejitter_state` with a block received
+    # at `t_receiver`, `skipped` blocks after the previous one, and gets a
+    # timestamp per sample
+    kernels.dejitter(state, t_receiver, skipped, timestamps)
+
+    # Filters each channel of samples with the (b, a) coefficients of e.g.
+    # `design.butter`, carrying its row of the [channels, len(b) - 1] state
+    # `zi` over from one call to the next
+    kernels.iir(b, a, samples, zi, filtered)
+
+    # All three in one call
+    tm = kernels.eeg_packet(packets, t_receiver, skipped, state, b, a, zi,
+                            samples, timestamps, filtered)
+
+Call them as attributes of the module, as `use` replaces them.
+"""
+
+import os
+
+import numpy as np
+
+BACKENDS = ("auto", "numpy", "numba")
+
+# 12 bits on a 2 mVpp range, centered on 2048
+EEG_SCALE = 0.48828125
+EEG_OFFSET = 2048
+
+# The implementation in use, set by `use`
+BACKEND = None
+
+# The implementation the first call selects, unless `use` is called before
+_DEFAULT = os.environ.get("CLEANROOM_KERNELS") or "auto"
+
+
+def dejitter_state(sfreq):
+    """
+    Gets the initial state of `dejitter` for a stream sampled at `sfreq`: an
+    array of the fit's offset (NaN until the first packet), sample period
+    and covariance, and the index of the next sample.
+    """
+    return np.array([np.nan, 1.0 / sfreq, 1e-4, 0.0])
+
+
+# The loops that numba compiles
+
+def _decode_eeg_loops(packets, out):
+    for c in range(packets.shape[0]):
+        for i in range(6):
+            b0 = np.int64(packets[c, 2 + 3 * i])
+            b1 = np.int64(packets[c, 3 + 3 * i])
+            b2 = np.int64(packets[c, 4 + 3 * i])
+            out[c, 2 * i] = (((b0 << 4) | (b1 >> 4)) - EEG_OFFSET) * EEG_SCALE
+            out[c, 2 * i + 1] = ((((b1 & 0xF) << 8) | b2) - EEG_OFFSET) * EEG_SCALE
+    last = packets.shape[0] - 1
+    return (np.int64(packets[last, 0]) << 8) | np.int64(packets[last, 1])
+
+
+def _dejitter_loops(state, t_receiver, skipped, out):
+    n = out.shape[0]
+    if np.isnan(state[0]):
+        state[0] = t_receiver
+
+    state[3] += n * skipped
+    t_source = state[3] + n - 1
+
+    # Recursive least squares fit of the receive time against the sample
+    # index, see `dejitter.Dejitter`
+    P = state[2]
+    R = state[1]
+    P = P - ((P ** 2) * (t_source ** 2)) / (1 - (P * (t_source ** 2)))
+    R = R + P * t_source * ((t_receiver - state[0]) - t_source * R)
+    state[1] = R
+    state[2] = P
+
+    for i in range(n):
+        out[i] = R * (state[3] + i) + state[0]
+    state[3] += n
+
+
+def _iir_loops(b, a, x, zi, out):
+    # Direct form II transposed, like `scipy.signal.lfilter`, with a[0] == 1,
+    # along each row
+    n = b.shape[0]
+    for c in range(x.shape[0]):
+        if n == 1:
+            for i in range(x.shape[1]):
+                out[c, i] = b[0] * x[c, i]
+            continue
+        for i in range(x.shape[1]):
+            xi = x[c, i]
+            yi = b[0] * xi + zi[c, 0]
+            for k in range(1, n - 1):
+                zi[c, k - 1] = b[k] * xi + zi[c, k] - a[k] * yi
+            zi[c, n - 2] = b[n - 1] * xi - a[n - 1] * yi
+            out[c, i] = yi
+
+
+# The NumPy implementations
+
+def _decode_eeg_numpy(packets, out):
+    # Every channel at once, rather than a call per channel
+    triplets = np.asarray(packets, dtype=np.int64)[:, 2:20].reshape(-1, 6, 3)
+    out[:, 0::2] = (triplets[:, :, 0] << 4) | (triplets[:, :, 1] >> 4)
+    out[:, 1::2] = ((triplets[:, :, 1] & 0xF) << 8) | triplets[:, :, 2]
+    out -= EEG_OFFSET
+    out *= EEG_SCALE
+    return (int(packets[-1, 0]) << 8) | int(packets[-1, 1])
+
+
+def _dejitter_numpy(state, t_receiver, skipped, out):
+    n = len(out)
+    if np.isnan(state[0]):
+        state[0] = t_receiver
+
+    state[3] += n * skipped
+    idxs = np.arange(n) + state[3]
+    state[3] += n
+
+    t_source = idxs[-1]
+    P = state[2]
+    R = state[1]
+    P = P - ((P ** 2) * (t_source ** 2)) / (1 - (P * (t_source ** 2)))
+    R = R + P * t_source * ((t_receiver - state[0]) - t_source * R)
+    state[1] = R
+    state[2] = P
+
+    out[:] = R * idxs + state[0]
+
+
+def _iir_numpy(b, a, x, zi, out):
+    if len(b) == 1:
+        # No filter, which lfilter would take as long to apply as any
+        np.multiply(x, b[0] / a[0], out=out)
+        return
+
+    # scipy.signal takes a second to import, so only do it once needed
+    from scipy.signal import lfilter
+
+    out[...], zi[...] = lfilter(b, a, x, axis=-1, zi=zi)
+
+
+def _eeg_packet_numpy(packets, t_receiver, skipped, state, b, a, zi, samples, timestamps, filtered):
+    tm = _decode_eeg_numpy(packets, samples)
+    _dejitter_numpy(state, t_receiver, skipped, timestamps)
+    _iir_numpy(b, a, samples, zi, filtered)
+    return tm
+
+
+def _eeg_packet_loops(packets, t_receiver, skipped, state, b, a, zi, samples, timestamps, filtered):
+    # Calls the compiled kernels, which `_numba_kernels` sets
+    tm = _decode_eeg_numba(packets, samples)
+    _iir_numba(b, a, samples, zi, filtered)
+    _dejitter_numba(state, t_receiver, skipped, timestamps)
+    return tm
+
+
+_decode_eeg_numba = _dejitter_numba = _iir_numba = None
+
+
+def _numba_kernels():
+    global _decode_eeg_numba, _dejitter_numba, _iir_numba
+    import numba
+
+    # Module level functions, unlike closures, can be cached on disk, which
+    # saves compiling them again in every process
+    _decode_eeg_numba = numba.njit(cache=True)(_decode_eeg_loops)
+    _dejitter_numba = numba.njit(cache=True)(_dejitter_loops)
+    _iir_numba = numba.njit(cache=True)(_iir_loops)
+    return (_decode_eeg_numba, _dejitter_numba, _iir_numba,
+            numba.njit(cache=True)(_eeg_packet_loops))
+
+
+def _numpy_kernels():
+    return _decode_eeg_numpy, _dejitter_numpy, _iir_numpy, _eeg_packet_numpy
+
+
+def available():
+    """Gets the implementations that can be used here"""
+    try:
+        import numba  # noqa: F401
+    except ImportError:
+        return ["numpy"]
+    return ["numpy", "numba"]
+
+
+def use(backend="auto"):
+    """
+    Selects the implementation of the kernels of this process.
+
+    backend: "numba", "numpy", or "auto" for numba if it's installed. Raises
+        ImportError for numba if it isn't.
+
+    Returns the implementation now in use.
+    """
+
+    global BACKEND, decode_eeg, dejitter, iir, eeg_packet
+
+    if backend not in BACKENDS:
+        raise(ValueError("Kernels must be one of {}".format(", ".join(BACKENDS))))
+
+    selected = available()[-1] if backend == "auto" else backend
+    if selected == "numba":
+        kernels = _numba_kernels()
+    else:
+        kernels = _numpy_kernels()
+
+    decode_eeg, dejitter, iir, eeg_packet = kernels
+    BACKEND = selected
+    return selected
+
+
+def _selecting(name):
+    # Stands in for a kernel until the first call, which selects them all
+    def first_call(*args):
+        use(_DEFAULT)
+        return globals()[name](*args)
+
+    first_call.__name__ = name
+    return first_call
+
+
+decode_eeg = _selecting("decode_eeg")
+dejitter = _selecting("dejitter")
+iir = _selecting("iir")
+eeg_packet = _selecting("eeg_packet")
@@ -0,0 +1,156 @@
+"""
+Lightweight pipeline instrumentation.
+
+Blocks carry `time.monotonic()` stamps from the moment their first packet is
+received, and each stage observes its latency into a histogram. Everything is
+exposed in the Prometheus text format by `exposition`.
+
+Instrumentation is off unless `enable` is called or the `CLEANROOM_METRICS`
+environment variable is set, which is inherited by the acquisition process.
+Instrumented code checks `metrics.ENABLED` before doing any work, so the
+disabled cost is one attribute lookup per packet.
+
+Metrics are not locked: each histogram and counter is expected to be written
+by a single thread, and a scrape may see a slightly stale value.
+"""
+
+import os
+from bisect import bisect_left
+from time import monotonic
+
+ENABLED = os.environ.get("CLEANROOM_METRICS", "") not in ("", "0")
+
+# Latency buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_registry = {}
+
+
+def enable():
+    """Turns instrumentation on, for this process and any it starts"""
+    global ENABLED
+    ENABLED = True
+    os.environ["CLEANROOM_METRICS"] = "1"
+
+
+def stamp():
+    """The current monotonic time, comparable across processes of a host"""
+    return monotonic()
+
+
+class Counter:
+    """A monotonically increasing count"""
+
+    type = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name + "_total", labels, self.value
+
+
+class Gauge:
+    """A value that can go up and down, optionally computed on each scrape"""
+
+    type = "gauge"
+
+    def __init__(self, func=None):
+        self.value = float("nan")
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.func() if self.func else self.value
+
+
+class Histogram:
+    """A histogram of latencies, in seconds"""
+
+    type = "histogram"
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", repr(bound)),), cumulative
+        cumulative += self.counts[-1]
+        yield name + "_bucket", labels + (("le", "+Inf"),), cumulative
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, cumulative
+
+
+def _get(cls, name, help, labels, **kwargs):
+    family = _registry.setdefault(name, (cls, help, {}))
+    if family[0] is not cls:
+        raise ValueError("Metric %s is already registered as a %s" % (name, family[0].type))
+
+    key = tuple(sorted(labels.items())) if labels else ()
+    metric = family[2].get(key)
+    if metric is None:
+        metric = family[2][key] = cls(**kwargs)
+    return metric
+
+
+def counter(name, help="", labels=None):
+    """Gets (or creates) a counter"""
+    return _get(Counter, name, help, labels)
+
+
+def gauge(name, help="", labels=None, func=None):
+    """Gets (or creates) a gauge. `func` computes its value on each scrape."""
+    metric = _get(Gauge, name, help, labels)
+    if func is not None:
+        metric.func = func
+    return metric
+
+
+def histogram(name, help="", labels=None):
+    """Gets (or creates) a latency histogram"""
+    return _get(Histogram, name, help, labels)
+
+
+def stage(name):
+    """Gets the latency histogram of a pipeline stage"""
+    return histogram("cleanroom_stage_latency_seconds",
+                     "Latency of each pipeline stage", {"stage": name})
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, v) for k, v in labels) + "}"
+
+
+def exposition():
+    """Renders every metric in the Prometheus text format"""
+    lines = []
+
+    for name, (cls, help, metrics) in sorted(_registry.items()):
+        if help:
+            lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, cls.type))
+        for labels, metric in metrics.items():
+            for sample_name, sample_labels, value in metric.samples(name, labels):
+                lines.append("%s%s %s" % (sample_name, _format_labels(sample_labels), value))
+
+    return "\n".join(lines) + "\n"
@@ -6,16 +6,19 @@ import json
 class Sample:
     """A sampling of sensor data at a specific time"""
 
-    def __init__(self, timestamp, data):
+    def __init__(self, timestamp, data, stamps=None):
         """
         Constructs a new sample.
 
         timestamp: A (float) UNIX timestamp of when the sample was collected.
         data: A numpy array of sensor data.
+        stamps: When instrumentation is enabled, the monotonic times the
+            sample's block went through each acquisition stage.
         """
 
         self.timestamp = timestamp
         self.data = data
+        self.stamps = stamps
 
         ##############################
         '''eeg_info = mne_lsl.lsl.StreamInfo(
@@ -44,3 +47,156 @@ class Sample:
 
     def to_json(self):
         return json.dumps(dict(timestamp=self.timestamp, data=self.data.tolist()))
+
+
+class Gap:
+    """Packets that were lost between two received packets"""
+
+    def __init__(self, timestamp, tm, last_tm):
+        """
+        Constructs a new gap.
+
+        timestamp: A (float) UNIX timestamp of when the gap was noticed.
+        tm: The packet counter that was received.
+        last_tm: The packet counter received before it.
+        """
+
+        self.timestamp = timestamp
+        self.tm = tm
+        self.last_tm = last_tm
+
+    @property
+    def missing(self):
+        """The number of packets lost, allowing for the counter wrapping"""
+        return (self.tm - self.last_tm - 1) % 65536
+
+    def to_json(self):
+        return json.dumps(dict(timestamp=self.timestamp, tm=self.tm, last_tm=self.last_tm))
+
+
+class Telemetry:
+    """The headset's battery and other housekeeping data at a specific time"""
+
+    def __init__(self, timestamp, battery, fuel_gauge, adc_volt, temperature):
+        """
+        Constructs a new telemetry reading.
+
+        timestamp: A (float) timestamp of when the reading was received, in
+            the clock of the headset's `Muse.time_func`: LSL clock time
+            (`mne_lsl.lsl.local_clock`) when streaming, so that it lines up
+            with the telemetry outlet.
+        battery: Battery charge, in percent.
+        fuel_gauge: Battery voltage, in millivolts.
+        adc_volt: ADC reference voltage reading.
+        temperature: Temperature reading.
+        """
+
+        self.timestamp = timestamp
+        self.battery = battery
+        self.fuel_gauge = fuel_gauge
+        self.adc_volt = adc_volt
+        self.temperature = temperature
+
+    @property
+    def values(self):
+        """The readings, in LSL channel order"""
+        return [self.battery, self.fuel_gauge, self.adc_volt, self.temperature]
+
+    def to_json(self):
+        return json.dumps(dict(timestamp=self.timestamp, battery=self.battery,
+                               fuel_gauge=self.fuel_gauge, adc_volt=self.adc_volt,
+                               temperature=self.temperature))
+
+
+class SensorData:
+    """A block of samples from the accelerometer, gyroscope or PPG sensors"""
+
+    def __init__(self, sensor, timestamps, data):
+        """
+        Constructs a new block.
+
+        sensor: Which sensor the data comes from: `acc`, `gyro` or `ppg`.
+        timestamps: A numpy array of the (float) UNIX timestamps of the
+            samples.
+        data: A numpy array of shape [channels, samples].
+        """
+
+        self.sensor = sensor
+        self.timestamps = timestamps
+        self.data = data
+
+    def samples(self):
+        """Splits the block into `Sample`s"""
+        return [Sample(t, self.data[:, i]) for i, t in enumerate(self.timestamps)]
+
+
+class Artifact:
+    """The artifacts found in a block of EEG"""
+
+    def __init__(self, timestamp, saturated, amplitude, blink, jaw):
+        """
+        Constructs a new artifact event.
+
+        timestamp: A (float) UNIX timestamp of the block's last sample.
+        saturated: A numpy array of the number of saturated samples per
+            channel.
+        amplitude: A numpy array of booleans, whether each channel exceeded
+            the amplitude threshold.
+        blink: Whether a blink was detected.
+        jaw: Whether a jaw clench was detected.
+        """
+
+        self.timestamp = timestamp
+        self.saturated = saturated
+        self.amplitude = amplitude
+        self.blink = blink
+        self.jaw = jaw
+
+    @property
+    def kinds(self):
+        """The names of the artifacts found"""
+        kinds = []
+        if self.saturated.any():
+            kinds.append("saturation")
+        if self.amplitude.any():
+            kinds.append("amplitude")
+        if self.blink:
+            kinds.append("blink")
+        if self.jaw:
+            kinds.append("jaw")
+        return kinds
+
+    def to_json(self):
+        return json.dumps(dict(timestamp=self.timestamp, kinds=self.kinds,
+                               saturated=self.saturated.tolist(),
+                               amplitude=self.amplitude.tolist(),
+                               blink=self.blink, jaw=self.jaw))
+
+
+class Quality:
+    """The signal quality of each electrode at a specific time"""
+
+    def __init__(self, timestamp, score, std, line_ratio, flat):
+        """
+        Constructs a new quality reading.
+
+        timestamp: A (float) UNIX timestamp of the last sample considered.
+        score: A numpy array of per-channel scores: 1 for good, 0.5 for
+            noisy and 0 for flat or off the skin.
+        std: A numpy array of per-channel rolling standard deviations, in uV.
+        line_ratio: A numpy array of the fraction of per-channel power in the
+            line noise band.
+        flat: A numpy array of booleans, whether each channel is flat.
+        """
+
+        self.timestamp = timestamp
+        self.score = score
+        self.std = std
+        self.line_ratio = line_ratio
+        self.flat = flat
+
+    def to_json(self):
+        # `data` holds the scores, so that quality can be charted like samples
+        return json.dumps(dict(timestamp=self.timestamp, data=self.score.tolist(),
+                               std=self.std.tolist(), line_ratio=self.line_ratio.tolist(),
+                               flat=self.flat.tolist()))
@@ -4,21 +4,57 @@ Low-level Muse headset interaction.
 This module comes from https://github.com/NeuroTechX/bci-workshop/
 """
 
-import bitstring
-import pygatt
 import numpy as np
-from time import time, sleep
+import struct
+import asyncio
+import json
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import time, sleep, monotonic
 import sys
 import platform
 
 from time import localtime, strftime
 
+from . import design, kernels, metrics
+from .fake import FakeBackend
+from .dejitter import Dejitter
+from .models import Telemetry
+from .presets import get_layout
+
+ATTR_STREAM_TOGGLE = '273e0001-4c4d-454d-96be-f03bac821358' # 0x0e
 ATTR_TP9 = '273e0003-4c4d-454d-96be-f03bac821358' # 0x1f-0x21
 ATTR_AF7 = '273e0004-4c4d-454d-96be-f03bac821358' # fp1 0x22-0x24
 ATTR_AF8 = '273e0005-4c4d-454d-96be-f03bac821358' # fp2 0x25-0x27
 ATTR_TP10 = '273e0006-4c4d-454d-96be-f03bac821358' # 0x28-0x2a
+ATTR_AUX = '273e0007-4c4d-454d-96be-f03bac821358' # 0x2b-0x2d
 ATTR_TELEMETRY = "273e000b-4c4d-454d-96be-f03bac821358"
+ATTR_GYRO = '273e0009-4c4d-454d-96be-f03bac821358' # 0x14
+ATTR_ACC = '273e000a-4c4d-454d-96be-f03bac821358' # 0x17
+ATTR_PPG1 = '273e000f-4c4d-454d-96be-f03bac821358' # ambient 0x38
+ATTR_PPG2 = '273e0010-4c4d-454d-96be-f03bac821358' # infrared 0x3b
+ATTR_PPG3 = '273e0011-4c4d-454d-96be-f03bac821358' # red 0x3e
+
+# The characteristic of each EEG channel, see `presets`
+CHANNEL_ATTRS = {'TP9': ATTR_TP9, 'AF7': ATTR_AF7, 'AF8': ATTR_AF8,
+                 'TP10': ATTR_TP10, 'AUX': ATTR_AUX}
+
+ACC_SAMPLING_RATE = 52
+GYRO_SAMPLING_RATE = 52
+PPG_SAMPLING_RATE = 64
+ACC_SCALE = 0.0000610352
+GYRO_SCALE = 0.0074768
+
+# packet counter, then 3 samples of x, y and z
+IMU_DTYPE = np.dtype([('tm', '>u2'), ('samples', '>i2', (3, 3))])
+# packet counter, then 6 samples of 24 bits
+PPG_DTYPE = np.dtype([('tm', '>u2'), ('samples', 'u1', (6, 3))])
 
+TELEMETRY_STRUCT = struct.Struct('>5H')
+
+# Longer than any control response, so a buffer past it has lost its end
+MAX_CONTROL_MESSAGE = 4096
 
 interface = 'COM5' if platform.system() == 'Windows' else '/dev/ttyACM0'
 class Muse():
@@ -27,37 +63,79 @@ class Muse():
     def __init__(self, address=None, 
                  callback=None, 
                  callback_eeg=None,
-                 eeg=True, accelero=False,
-                 giro=False, backend='auto', interface=None, time_func=time,
-                 name=None):
-        """Initialize"""
+                 callback_gap=None,
+                 callback_telemetry=None,
+                 callback_control=None,
+                 callback_acc=None,
+                 callback_gyro=None,
+                 callback_ppg=None,
+                 eeg=True, telemetry=True, control=True, accelero=False,
+                 giro=False, ppg=False, backend='auto', interface=None, time_func=time,
+                 name=None, preset=None, disable_light=False, filter=None):
+        """Initialize
+
+        filter -- the arguments of `design.butter` of a filter to apply to
+        the EEG as it's decoded, or None to leave it raw
+        """
         self.address = address
         self.name = name
         self.callback = callback
         self.callback_eeg = callback_eeg
+        self.callback_gap = callback_gap
+        self.callback_telemetry = callback_telemetry
+        self.stamps = None
+        self.last_packet_time = None
         self.eeg = eeg
+        self.telemetry = telemetry
+        self.callback_control = callback_control
+        self.control = control
+        self._init_control()
+        # The latest telemetry reading
+        self.last_telemetry = None
+        self.callback_acc = callback_acc
+        self.callback_gyro = callback_gyro
+        self.callback_ppg = callback_ppg
         self.accelero = accelero
         self.giro = giro
+        self.ppg = ppg
         self.interface = interface
         self.time_func = time_func
-
-        if backend in ['gatt', 'bgapi']:
-            if backend == 'bgapi':
-                self.backend = 'bgapi'
-            else:
-                self.backend = 'gatt'
+        self.preset = preset
+        self.disable_light = disable_light
+        self.filter = filter
+        # The channels the preset streams, which are the only ones decoded
+        self.layout = get_layout(preset, [sensor for sensor, enabled in
+                                          (('acc', accelero), ('gyro', giro), ('ppg', ppg))
+                                          if enabled])
+
+        if backend in ['gatt', 'bgapi', 'bleak', 'fake']:
+            self.backend = backend
+        elif hasattr(backend, 'connect'):
+            # A backend instance, e.g. a configured `FakeBackend`
+            self.backend = backend
         else:
-            raise(ValueError('Backend must be auto, gatt or bgapi'))
-
-    def connect(self, interface=None, backend='auto'):
-        """Connect to the device"""
+            raise(ValueError('Backend must be auto, gatt, bgapi, bleak or fake'))
 
+    def _create_adapter(self):
         if self.backend == 'gatt':
+            import pygatt
             self.interface = self.interface or 'hci0'
-            self.adapter = pygatt.GATTToolBackend(self.interface)
+            return pygatt.GATTToolBackend(self.interface)
+        elif self.backend == 'bgapi':
+            import pygatt
+            return pygatt.BGAPIBackend(serial_port=self.interface)
+        elif self.backend == 'bleak':
+            from .bleak_backend import BleakBackend
+            return BleakBackend()
+        elif self.backend == 'fake':
+            return FakeBackend()
         else:
-            self.adapter = pygatt.BGAPIBackend(serial_port=self.interface)
+            return self.backend
+
+    def connect(self, interface=None, backend='auto'):
+        """Connect to the device"""
 
+        self.adapter = self._create_adapter()
         self.adapter.start()
 
         if self.address is None:
@@ -72,13 +150,42 @@ class Muse():
         if self.eeg:
             self._subscribe_eeg()
 
+        # subscribes to responses to control commands
+        if self.control:
+            self._subscribe_control()
+
+        # subscribes to battery, temperature, etc
+        if self.telemetry:
+            self._subscribe_telemetry()
+
         # subscribes to Accelerometer
         if self.accelero:
-            raise(NotImplementedError('Accelerometer not implemented'))
+            self._subscribe_acc()
 
         # subscribes to Giroscope
         if self.giro:
-            raise(NotImplementedError('Giroscope not implemented'))
+            self._subscribe_gyro()
+
+        # subscribes to PPG
+        if self.ppg:
+            self._subscribe_ppg()
+
+        # After subscribing to control, so that the answers can't be taken
+        # for those of later requests
+        if self.preset is not None:
+            self.select_preset(self.preset)
+
+        if self.disable_light:
+            self.request("L0")
+
+    def scan(self, timeout=10.5):
+        """List the nearby BLE devices, as dicts of name and address"""
+        adapter = self._create_adapter()
+        adapter.start()
+        try:
+            return adapter.scan(timeout=timeout)
+        finally:
+            adapter.stop()
 
     def find_muse_address(self, name=None):
         """look for ble device with a muse in the name"""
@@ -102,12 +209,84 @@ class Muse():
     def start(self):
         """Start streaming."""
         self._init_sample()
-        self.last_tm = 0
-        self.device.char_write_handle(0x000e, [0x02, 0x64, 0x0a], False)
+        self._init_sensors()
+        self._init_eeg()
+        self.last_tm = None
+        self.last_packet_time = monotonic()
+        self._write_cmd_str("d")
 
     def stop(self):
         """Stop streaming."""
-        self.device.char_write_handle(0x000e, [0x02, 0x68, 0x0a], False)
+        self._write_cmd_str("h")
+
+    def keep_alive(self):
+        """Keep streaming, sending 'k' command"""
+        self._write_cmd_str("k")
+
+    def select_preset(self, preset="p21"):
+        """Select a preset, e.g. "p21" for the 4 EEG channels or "p20" to
+        also stream the AUX channel, see `request`"""
+        preset = str(preset)
+        if not preset.startswith("p"):
+            preset = "p" + preset
+        return self.request(preset)
+
+    def _write_cmd(self, cmd):
+        """Wrapper to write a command to the Muse device.
+        cmd -- list of bytes"""
+        self.device.char_write_handle(0x000e, cmd, False)
+
+    def _write_cmd_str(self, cmd):
+        """Wrapper to encode and write a command string to the Muse device.
+        cmd -- string to send"""
+        self._write_cmd([len(cmd) + 1, *cmd.encode("ascii"), 0x0a])
+
+    def request(self, cmd):
+        """Send a command that the device answers, e.g. 'v1' or 's'.
+
+        Responses come back in the order commands were sent, so each one
+        resolves the oldest outstanding request. Returns a
+        `concurrent.futures.Future` of the parsed JSON response, which can
+        be waited on from any thread.
+        """
+        future = Future()
+        with self._control_lock:
+            # Forget the requests that were cancelled, so that those never
+            # answered don't pile up
+            if any(pending.done() for pending in self._pending):
+                self._pending = deque(pending for pending in self._pending if not pending.done())
+            self._pending.append(future)
+            self._write_cmd_str(cmd)
+        return future
+
+    async def query(self, cmd, timeout=5.0):
+        """Send a command and await its parsed JSON response.
+
+        Raises `asyncio.TimeoutError` if the device doesn't answer in time,
+        and the request is then no longer waiting for a response.
+        """
+        future = self.request(cmd)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Skipped when responses are handed out, see `_handle_control`
+            future.cancel()
+            raise
+
+    def ask_control(self):
+        """Request the device status, see `request`"""
+        return self.request("s")
+
+    def ask_device_info(self):
+        """Request the device firmware and hardware info, see `request`"""
+        return self.request("v1")
+
+    def ask_reset(self):
+        """Undocumented command reset for '*1', see `request`.
+        The message received is a singleton with:
+        "rc": return status, if 0 is OK
+        """
+        return self.request("*1")
 
     def disconnect(self):
         """disconnect."""
@@ -115,40 +294,123 @@ class Muse():
         self.adapter.stop()
 
     def _subscribe_eeg(self):
-        """subscribe to eeg stream."""
-        self.device.subscribe(ATTR_TP9,
-                              callback=self._handle_eeg)
-        self.device.subscribe(ATTR_AF7,
-                              callback=self._handle_eeg)
-        self.device.subscribe(ATTR_AF8,
-                              callback=self._handle_eeg)
-        self.device.subscribe(ATTR_TP10,
-                              callback=self._handle_eeg)
-        
+        """subscribe to the eeg channels of the preset's layout."""
+        for channel in self.layout.channels:
+            self.device.subscribe(CHANNEL_ATTRS[channel],
+                                  callback=self._handle_eeg)
+
+
+    def _init_control(self):
+        """initialize the control message assembly, and the requests waiting
+        for a response"""
+        self._current_msg = bytearray()
+        self._pending = deque()
+        # Re-entrant, as a backend may deliver the response from inside the
+        # write of its command
+        self._control_lock = threading.RLock()
+
+    def _subscribe_control(self):
+        self.device.subscribe(ATTR_STREAM_TOGGLE, callback=self._handle_control)
+
+    def _handle_control(self, handle, packet):
+        """Handle a chunk of a control response.
+
+        Each packet holds its payload length, then up to 19 bytes of a JSON
+        message split over as many packets as needed.
+        """
+
+        if handle != 14:
+            return
+
+        n_incoming = packet[0]
+        self._current_msg += packet[1:1 + n_incoming]
+
+        # Responses are flat JSON objects, so after a lost packet the next
+        # one starts at the next '{'
+        if not self._current_msg.startswith(b"{"):
+            start = self._current_msg.find(b"{")
+            self._current_msg = self._current_msg[start:] if start >= 0 else bytearray()
+
+        if len(self._current_msg) > MAX_CONTROL_MESSAGE:
+            self._current_msg = bytearray()
+            self._answer(error=ValueError("Control response longer than %d bytes" % MAX_CONTROL_MESSAGE))
+            return
+
+        if not self._current_msg.endswith(b"}"):
+            return
+
+        raw, self._current_msg = bytes(self._current_msg), bytearray()
+
+        # The end of the previous response was lost
+        start = raw.rfind(b"{")
+        if start > 0:
+            self._answer(error=ValueError("Truncated control response %r" % raw[:start]))
+            raw = raw[start:]
+
+        try:
+            message = json.loads(raw)
+        except ValueError as e:
+            self._answer(error=ValueError("Malformed control response %r: %s" % (raw, e)))
+            return
+
+        self._answer(message)
+        if self.callback_control:
+            self.callback_control(message)
+
+    def _answer(self, message=None, error=None):
+        """Resolves the oldest outstanding request with a response, or with
+        the error of one that was lost, so that the later requests still get
+        their own"""
+        with self._control_lock:
+            future = None
+            # Requests that timed out or were cancelled are done already
+            while self._pending and future is None:
+                future = self._pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    future = None
+
+        if future is None:
+            if error is not None:
+                print(error)
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(message)
 
     def _subscribe_telemetry(self):
         self.device.subscribe(ATTR_TELEMETRY, callback=self._handle_telemetry)
 
-    def _unpack_eeg_channel(self, packet):
-        """Decode data packet of one eeg channel.
+    def _init_eeg(self):
+        """initialize the dejittering and filter state of the EEG, and the
+        buffers `kernels.eeg_packet` fills"""
+        n = self.layout.n_channels
+        self._dejitter_state = kernels.dejitter_state(self.layout.sfreq)
+        if self.filter is None:
+            self._b, self._a = np.ones(1), np.ones(1)
+            self._zi = np.zeros((n, 0))
+        else:
+            self._b, self._a = design.butter(*self.filter)
+            self._zi = np.tile(design.butter_zi(*self.filter), (n, 1))
+        self._samples = np.zeros((n, 12))
+        self._timestamps = np.zeros(12)
+
+        # Run the kernel once on a copy of the state before streaming, so
+        # that numba compiling it doesn't hold up the first packets and skew
+        # the dejittering
+        kernels.eeg_packet(np.zeros((n, 20), dtype=np.uint8), 0.0, 0,
+                           kernels.dejitter_state(self.layout.sfreq), self._b, self._a,
+                           self._zi.copy(), self._samples, self._timestamps, self._samples.copy())
+
+    def _init_sample(self):
+        """initialize array to store the packets of the layout's channels.
 
         Each packet is encoded with a 16bit timestamp followed by 12 time
         samples with a 12 bit resolution.
         """
-        aa = bitstring.Bits(bytes=packet)
-        pattern = "uint:16,uint:12,uint:12,uint:12,uint:12,uint:12,uint:12, \
-                   uint:12,uint:12,uint:12,uint:12,uint:12,uint:12"
-        res = aa.unpack(pattern)
-        timestamp = res[0]
-        data = res[1:]
-        # 12 bits on a 2 mVpp range
-        data = 0.48828125 * (np.array(data) - 2048)
-        return timestamp, data
-
-    def _init_sample(self):
-        """initialize array to store the samples"""
-        self.timestamps = np.zeros(5)
-        self.data = np.zeros((5, 12))
+        self.timestamps = np.full(self.layout.n_channels, np.nan)
+        self.packets = np.zeros((self.layout.n_channels, 20), dtype=np.uint8)
+        self.data = np.zeros((self.layout.n_channels, 12))
+        self._first_received = None
 
     def _handle_eeg(self, handle, data):
         """Calback for receiving a sample.
@@ -158,24 +420,42 @@ class Muse():
         """
 
         timestamp = self.time_func()
-        index = int((handle - 32) / 3)
-        tm, d = self._unpack_eeg_channel(data)
-
-        if self.last_tm == 0:
-            self.last_tm = tm - 1
+        self.last_packet_time = monotonic()
+        if metrics.ENABLED:
+            received = metrics.stamp()
+            if self._first_received is None:
+                self._first_received = received
 
-        self.data[index] = d
+        index = int((handle - 32) / 3)
+        self.packets[index] = np.frombuffer(data, dtype=np.uint8, count=20)
         self.timestamps[index] = timestamp
         # last data received
         if handle == 35:
-            if tm != self.last_tm + 1:
+            # The counter wraps around every 65536 packets, which isn't a gap
+            tm = (int(data[0]) << 8) | int(data[1])
+            skipped = self._skipped(tm, self.last_tm)
+            if skipped:
                 print("missing sample %d : %d" % (tm, self.last_tm))
+                if self.callback_gap:
+                    self.callback_gap(tm, self.last_tm)
             self.last_tm = tm
-            # affect as timestamps the first timestamps - 12 sample
-            timestamps = np.arange(-12, 0) / 256.
-            timestamps += np.min(self.timestamps[self.timestamps != 0])
-            self.callback(self.data, timestamps)
-            self.callback_eeg(self.data, timestamps)
+
+            # Decode, scale and filter every channel, and stamp the samples
+            # from the fit of the packet's first receive time, keeping the
+            # sample index in step with lost packets, in one call
+            kernels.eeg_packet(self.packets, np.nanmin(self.timestamps), skipped,
+                               self._dejitter_state, self._b, self._a, self._zi,
+                               self._samples, self._timestamps, self.data)
+            timestamps = self._timestamps.copy()
+
+            if metrics.ENABLED:
+                decoded = metrics.stamp()
+                self.stamps = (self._first_received, received, decoded, metrics.stamp())
+
+            if self.callback:
+                self.callback(self.data, timestamps)
+            if self.callback_eeg:
+                self.callback_eeg(self.data, timestamps)
             self._init_sample()
     
 
@@ -185,10 +465,99 @@ class Muse():
         if handle != 26:  # handle 0x1a
             return
 
-        bit_decoder = bitstring.Bits(bytes=packet)
-        pattern = "uint:16,uint:16,uint:16,uint:16,uint:16"  # The rest is 0 padding
-        data = bit_decoder.unpack(pattern)
+        # The packet counter, then 4 readings. The rest is 0 padding
+        _, battery, fuel_gauge, adc_volt, temperature = TELEMETRY_STRUCT.unpack_from(packet)
+
+        self.last_telemetry = Telemetry(self.time_func(), battery / 512,
+                                        fuel_gauge * 2.2, adc_volt, temperature)
+
+        if self.callback_telemetry:
+            self.callback_telemetry(self.last_telemetry)
+
+    def _init_sensors(self):
+        """initialize the state of the accelerometer, gyroscope and PPG
+        streams. Each has its own sampling rate, so its own dejittering."""
+        self.dejitter_acc = Dejitter(ACC_SAMPLING_RATE)
+        self.dejitter_gyro = Dejitter(GYRO_SAMPLING_RATE)
+        self.dejitter_ppg = Dejitter(PPG_SAMPLING_RATE)
+        self.last_tm_acc = None
+        self.last_tm_gyro = None
+        self.last_tm_ppg = None
+        self.timestamps_ppg = np.full(3, np.nan)
+        self.data_ppg = np.zeros((3, 6))
+
+    def _subscribe_acc(self):
+        self.device.subscribe(ATTR_ACC, callback=self._handle_acc)
 
-        battery = data[1] / 512
+    def _subscribe_gyro(self):
+        self.device.subscribe(ATTR_GYRO, callback=self._handle_gyro)
 
-        print("Battery __", battery, localtime(time()), '________________')
+    def _subscribe_ppg(self):
+        self.device.subscribe(ATTR_PPG1, callback=self._handle_ppg)
+        self.device.subscribe(ATTR_PPG2, callback=self._handle_ppg)
+        self.device.subscribe(ATTR_PPG3, callback=self._handle_ppg)
+
+    @staticmethod
+    def _unpack_imu_channel(packet, scale):
+        """Decode a packet of 3 accelerometer or gyroscope samples.
+
+        Returns the packet counter, and the samples as an array of shape
+        [axes, samples].
+        """
+        decoded = np.frombuffer(bytes(packet), dtype=IMU_DTYPE, count=1)[0]
+        return int(decoded['tm']), decoded['samples'].T * scale
+
+    @staticmethod
+    def _unpack_ppg_channel(packet):
+        """Decode a packet of 6 24-bit PPG samples."""
+        decoded = np.frombuffer(bytes(packet), dtype=PPG_DTYPE, count=1)[0]
+        b = decoded['samples'].astype(np.uint32)
+        return int(decoded['tm']), (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+
+    @staticmethod
+    def _skipped(tm, last_tm):
+        """Number of packets lost between two packet counters"""
+        if last_tm is None:
+            return 0
+        return (tm - last_tm - 1) % 65536
+
+    def _handle_imu(self, packet, scale, dejitter, last_tm, callback):
+        timestamp = self.time_func()
+        tm, samples = self._unpack_imu_channel(packet, scale)
+        timestamps = dejitter.timestamps(3, timestamp, self._skipped(tm, last_tm))
+        if callback:
+            callback(samples, timestamps)
+        return tm
+
+    def _handle_acc(self, handle, packet):
+        """Callback for receiving accelerometer samples, in g"""
+        self.last_tm_acc = self._handle_imu(packet, ACC_SCALE, self.dejitter_acc,
+                                            self.last_tm_acc, self.callback_acc)
+
+    def _handle_gyro(self, handle, packet):
+        """Callback for receiving gyroscope samples, in degrees per second"""
+        self.last_tm_gyro = self._handle_imu(packet, GYRO_SCALE, self.dejitter_gyro,
+                                             self.last_tm_gyro, self.callback_gyro)
+
+    def _handle_ppg(self, handle, packet):
+        """Callback for receiving PPG samples.
+
+        samples are received in this order : 56, 59, 62
+        wait until we get 62 and call the data callback
+        """
+
+        timestamp = self.time_func()
+        index = int((handle - 56) / 3)
+        tm, d = self._unpack_ppg_channel(packet)
+
+        self.data_ppg[index] = d
+        self.timestamps_ppg[index] = timestamp
+
+        if handle == 62:
+            timestamps = self.dejitter_ppg.timestamps(
+                6, np.nanmin(self.timestamps_ppg), self._skipped(tm, self.last_tm_ppg))
+            self.last_tm_ppg = tm
+            if self.callback_ppg:
+                self.callback_ppg(self.data_ppg, timestamps)
+            self.timestamps_ppg = np.full(3, np.nan)
+            self.data_ppg = np.zeros((3, 6))
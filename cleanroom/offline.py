@@ -0,0 +1,169 @@
+"""
+Offline feature computation over whole sessions.
+
+Where `get_features` consumes a live iterator one window at a time, this
+works through a session a chunk of windows at a time: each chunk's samples are
+notch filtered, carrying the filter state over from the previous chunk, cut
+into sliding windows with a strided view (no copy), and the windows are
+transformed with one batched `rfft`. Recordings are read piece by piece from
+their memory map, so memory use doesn't grow with the length of the session.
+The results match what `get_features` yields for the same samples.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+from . import design
+from .record import Recording
+from .transform import (BAND_EDGES, BANDS, CHANNEL_INDICES, FEATURES, NOTCH,
+                        SAMPLING_FREQUENCY, _features_from_spectrum, _nextpow2)
+
+
+def _pieces(data, timestamps, size):
+    """Yields a session as (data, timestamps) pieces of about `size`
+    samples, the timestamps being None if they aren't known"""
+    if isinstance(data, Recording):
+        for piece, piece_timestamps in data.iter_eeg(chunk=max(1, size // data.block_size)):
+            yield piece[:, CHANNEL_INDICES], piece_timestamps
+        return
+
+    for i in range(0, len(data), size):
+        yield data[i:i + size], None if timestamps is None else np.asarray(timestamps[i:i + size])
+
+
+def _segments(pieces, window, step, chunk, notch):
+    """
+    Notch filters the pieces of a session, starting from the same state as
+    `get_features`, and cuts them into segments of up to `chunk` windows.
+
+    Yields tuples of (segment, times), times holding the timestamp (or index)
+    of the last sample of each of the segment's windows.
+    """
+
+    length = (chunk - 1) * step + window
+    buffer = None
+    buffer_timestamps = None
+    # The index of the buffer's first sample in the session
+    offset = 0
+    zi = None
+
+    def cut(n_windows):
+        ends = np.arange(n_windows) * step + window - 1
+        times = ends + offset if buffer_timestamps is None else buffer_timestamps[ends]
+        return buffer[:(n_windows - 1) * step + window], times
+
+    for piece, piece_timestamps in pieces:
+        piece = np.asarray(piece, dtype=np.float64)
+        if notch:
+            b, a = design.butter(*NOTCH)
+            if zi is None:
+                zi = np.tile(design.butter_zi(*NOTCH), (piece.shape[1], 1)).T
+            piece, zi = lfilter(b, a, piece, axis=0, zi=zi)
+
+        if buffer is None:
+            buffer, buffer_timestamps = piece, piece_timestamps
+        else:
+            buffer = np.concatenate([buffer, piece])
+            if buffer_timestamps is not None:
+                buffer_timestamps = np.concatenate([buffer_timestamps, piece_timestamps])
+
+        # Consecutive segments overlap by `window - step` samples, so that
+        # every window lies entirely within one segment
+        while len(buffer) >= length:
+            yield cut(chunk)
+            buffer = buffer[chunk * step:]
+            if buffer_timestamps is not None:
+                buffer_timestamps = buffer_timestamps[chunk * step:]
+            offset += chunk * step
+
+    if buffer is not None and len(buffer) >= window:
+        yield cut((len(buffer) - window) // step + 1)
+
+
+def _chunk_features(segment, window, step, names, bands=BAND_EDGES):
+    """
+    Computes the features of every window of a segment.
+
+    segment: array of shape [samples, channels].
+    window: Number of samples per window.
+    step: Number of samples between the starts of two windows.
+    names: The names of the features to compute.
+    bands: The edges of the bands, like `BAND_EDGES`.
+
+    Returns a dict of feature name to an array of shape [windows, channels].
+    """
+
+    # [windows, channels, samples], a view into `segment`
+    windows = sliding_window_view(segment, window, axis=0)[::step]
+
+    centered = windows - windows.mean(axis=-1, keepdims=True)
+    centered *= design.window("hamming", window)
+
+    nfft = _nextpow2(window)
+    y = np.fft.rfft(centered, n=nfft, axis=-1) / window
+    psd = 2 * np.abs(y[..., :nfft // 2])
+
+    # Frequencies first, as `_features_from_spectrum` reduces over axis 0
+    return _features_from_spectrum(nfft, np.moveaxis(psd, -1, 0), names, bands)
+
+
+def compute_features(data, timestamps=None, features=BANDS,
+                     window=SAMPLING_FREQUENCY, step=SAMPLING_FREQUENCY,
+                     notch=True, chunk=4096, workers=None, bands=BAND_EDGES):
+    """
+    Computes sliding window features over a whole session.
+
+    data: A `Recording`, or an array of shape [samples, channels]. Only the
+        `get_features` channels (TP9, AF7, AF8, TP10) of a recording are used.
+    timestamps: The timestamps of the samples of an array, if known.
+    features: The names of the features to compute, from `FEATURES`.
+    window: Number of samples per window.
+    step: Number of samples between the starts of two windows. With the
+        defaults, windows line up with the ones `get_features` yields.
+    notch: Whether to notch filter out line noise first.
+    chunk: Maximum number of windows to transform at once, which bounds the
+        memory used by the FFTs.
+    workers: Number of processes to spread the chunks over, or None to
+        compute them in this process. At most twice as many chunks as
+        workers are held in memory at once.
+    bands: The edges of the bands, like `BAND_EDGES`.
+
+    Returns a tuple of (times, features), where times holds the timestamp
+    (or index, without timestamps) of the last sample of each window, and
+    features is a dict of feature name to an array of shape
+    [windows, channels].
+    """
+
+    features = tuple(features)
+    unknown = set(features) - set(FEATURES)
+    if unknown:
+        raise(ValueError("Unknown features: {}".format(", ".join(sorted(unknown)))))
+
+    n_channels = len(CHANNEL_INDICES) if isinstance(data, Recording) else np.shape(data)[1]
+    bands = tuple(bands)
+    segments = _segments(_pieces(data, timestamps, chunk * step), window, step, chunk, notch)
+
+    times = []
+    results = []
+    if workers:
+        with ProcessPoolExecutor(workers) as executor:
+            running = deque()
+            for segment, segment_times in segments:
+                times.append(segment_times)
+                running.append(executor.submit(_chunk_features, segment, window, step, features, bands))
+                if len(running) >= 2 * workers:
+                    results.append(running.popleft().result())
+            results.extend(future.result() for future in running)
+    else:
+        for segment, segment_times in segments:
+            times.append(segment_times)
+            results.append(_chunk_features(segment, window, step, features, bands))
+
+    if not results:
+        return np.zeros(0), {name: np.zeros((0, n_channels)) for name in features}
+
+    return np.concatenate(times), {name: np.concatenate([r[name] for r in results]) for name in features}
@@ -0,0 +1,85 @@
+"""
+The channel layouts of the headset presets.
+
+The preset a headset is put in decides which EEG channels it streams: the
+four scalp electrodes, and with `p20` the AUX one too. The layout of the
+selected preset is worked out up front and goes along with the data, so
+`Muse` only subscribes to and decodes the channels that are streamed, and the
+LSL outlet, recordings and websocket streams only carry those. Every layout
+starts with the scalp channels, in the same order.
+"""
+
+import re
+
+EEG_CHANNELS = ("TP9", "AF7", "AF8", "TP10")
+AUX_CHANNEL = "AUX"
+SAMPLING_FREQUENCY = 256
+
+# The presets that stream more than the scalp channels. Any other preset,
+# and the headset's default, streams just those.
+PRESET_CHANNELS = {
+    "p20": EEG_CHANNELS + (AUX_CHANNEL,),
+}
+
+
+class Layout:
+    """What a session streams: the EEG channels, their rate and the other
+    sensors"""
+
+    def __init__(self, preset=None, channels=EEG_CHANNELS, sfreq=SAMPLING_FREQUENCY, sensors=()):
+        """
+        preset: The name of the preset, e.g. "p21", or None for the headset's
+            default.
+        channels: The names of the EEG channels, in the order of the samples.
+        sfreq: The EEG sampling frequency.
+        sensors: The auxiliary sensors that are streamed, among "acc", "gyro"
+            and "ppg".
+        """
+
+        self.preset = preset
+        self.channels = tuple(channels)
+        self.sfreq = sfreq
+        self.sensors = tuple(sensors)
+
+    @property
+    def n_channels(self):
+        return len(self.channels)
+
+    @property
+    def eeg_indices(self):
+        """The indices of the scalp channels in the samples"""
+        return [i for i, name in enumerate(self.channels) if name in EEG_CHANNELS]
+
+
+def normalize(preset):
+    """Gets the canonical name of a preset, e.g. "p21" for "21". Raises
+    ValueError if it isn't one."""
+    preset = str(preset).strip().lower()
+    if not re.match(r"^p?\d+$", preset):
+        raise(ValueError("must be a number, like p21 or p50"))
+    return preset if preset.startswith("p") else "p" + preset
+
+
+def get_layout(preset=None, sensors=()):
+    """
+    Gets the layout of a preset.
+
+    preset: The preset, e.g. "p21" or "21", or None for the headset's
+        default.
+    sensors: The auxiliary sensors enabled alongside, among "acc", "gyro"
+        and "ppg".
+    """
+
+    if preset is not None:
+        preset = normalize(preset)
+    return Layout(preset, PRESET_CHANNELS.get(preset, EEG_CHANNELS), sensors=sensors)
+
+
+def layout_for_channels(n_channels, sfreq=SAMPLING_FREQUENCY):
+    """Gets the layout of EEG recorded with `n_channels` channels, e.g. of a
+    recording or an LSL stream"""
+    channels = EEG_CHANNELS + (AUX_CHANNEL,)
+    if not len(EEG_CHANNELS) <= n_channels <= len(channels):
+        raise(ValueError("Expected {} or {} EEG channels, got {}".format(
+            len(EEG_CHANNELS), len(channels), n_channels)))
+    return Layout(channels=channels[:n_channels], sfreq=sfreq)
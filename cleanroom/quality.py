@@ -0,0 +1,73 @@
+"""
+Per-electrode signal quality.
+
+Quality is tracked with exponentially decaying running sums that are updated
+once per block, so nothing is ever recomputed over a window and the state is a
+few numbers per channel.
+"""
+
+import numpy as np
+
+from .models import Quality
+
+GOOD = 1.0
+NOISY = 0.5
+BAD = 0.0
+
+
+class SignalQuality:
+    """Rolling variance, line noise ratio and flatline detection per channel"""
+
+    def __init__(self, n_channels=4, sfreq=256, window=2.0, flat=1.0,
+                 max_std=150.0, max_line_ratio=0.3):
+        """
+        n_channels: Number of channels.
+        sfreq: Sampling frequency.
+        window: Time constant of the running sums, in seconds.
+        flat: Standard deviation, in uV, below which a channel is flat.
+        max_std: Standard deviation, in uV, above which a channel is
+            considered off the skin.
+        max_line_ratio: Fraction of the power removed by the notch filter
+            above which a channel is considered noisy.
+        """
+
+        self.sfreq = sfreq
+        self.window = window
+        self.flat = flat
+        self.max_std = max_std
+        self.max_line_ratio = max_line_ratio
+
+        self._weight = 0.0
+        self._sum = np.zeros(n_channels)
+        self._sum_squares = np.zeros(n_channels)
+        self._line_squares = np.zeros(n_channels)
+
+    def update(self, raw, filtered, timestamp):
+        """
+        Folds a block into the running sums.
+
+        raw: array of shape [samples, channels], before the notch filter.
+        filtered: the same block after the notch filter.
+        timestamp: The timestamp of the block's last sample.
+
+        Returns the `Quality` as of this block.
+        """
+
+        decay = np.exp(-len(raw) / (self.window * self.sfreq))
+        self._weight = self._weight * decay + len(raw)
+        self._sum = self._sum * decay + raw.sum(axis=0)
+        self._sum_squares = self._sum_squares * decay + np.einsum("ij,ij->j", raw, raw)
+        line = raw - filtered
+        self._line_squares = self._line_squares * decay + np.einsum("ij,ij->j", line, line)
+
+        mean = self._sum / self._weight
+        variance = np.maximum(self._sum_squares / self._weight - mean ** 2, 0)
+        std = np.sqrt(variance)
+        line_ratio = self._line_squares / np.maximum(variance * self._weight, 1e-12)
+
+        flat = std < self.flat
+        score = np.full(len(std), GOOD)
+        score[line_ratio > self.max_line_ratio] = NOISY
+        score[flat | (std > self.max_std)] = BAD
+
+        return Quality(timestamp, score, std, line_ratio, flat)
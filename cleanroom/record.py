@@ -0,0 +1,312 @@
+"""
+On-disk session recording.
+
+A recording is an append-only binary file made of a fixed-size header
+followed by fixed-size records. Every record holds one 12-sample block: the
+float64 timestamps and the float32 channel data. Telemetry and gap events use
+the same record layout with a different `kind`, and are stamped with the time
+of the last EEG block so the timestamp column stays sorted. This lets a
+`Recording` memory-map the file and binary search any time range without
+reading the rest of it.
+"""
+
+import os
+import struct
+from bisect import bisect_left, bisect_right
+from time import monotonic, time
+
+import numpy as np
+
+MAGIC = b"CLNREC\x00\x01"
+VERSION = 1
+HEADER_FORMAT = "<8sHHHxxdd"
+HEADER_SIZE = 64
+BLOCK_SIZE = 12
+
+KIND_EEG = 0
+KIND_TELEMETRY = 1
+KIND_GAP = 2
+
+
+def record_dtype(n_channels, block_size=BLOCK_SIZE):
+    """The numpy dtype of a single record"""
+    return np.dtype([
+        ("kind", "<u4"),
+        ("n", "<u4"),
+        ("timestamps", "<f8", (block_size,)),
+        ("data", "<f4", (n_channels, block_size)),
+    ])
+
+
+def _pack_header(n_channels, block_size, sfreq, created):
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, n_channels, block_size,
+                         sfreq, created)
+    return header.ljust(HEADER_SIZE, b"\x00")
+
+
+def _unpack_header(raw):
+    if len(raw) < HEADER_SIZE:
+        raise ValueError("Not a cleanroom recording: header is truncated")
+
+    magic, version, n_channels, block_size, sfreq, created = struct.unpack_from(
+        HEADER_FORMAT, raw)
+
+    if magic != MAGIC:
+        raise ValueError("Not a cleanroom recording: bad magic")
+    if version != VERSION:
+        raise ValueError("Unsupported recording version %d" % version)
+
+    return n_channels, block_size, sfreq, created
+
+
+class Recorder:
+    """Appends EEG blocks, telemetry and gap events to a recording file"""
+
+    def __init__(self, path, n_channels=5, sfreq=256, fsync_interval=5.0,
+                 block_size=BLOCK_SIZE, time_func=monotonic):
+        """
+        Opens (or creates) a recording.
+
+        path: Path of the recording file. Existing recordings with the same
+            layout and sampling frequency are appended to, after dropping any
+            partial record left by a crash.
+        n_channels: Number of EEG channels in each block.
+        sfreq: The nominal sampling frequency, stored in the header.
+        fsync_interval: Seconds between calls to `os.fsync`. Data is always
+            flushed to the OS on each write, this only bounds how much can be
+            lost on power failure.
+        """
+
+        self.path = path
+        self.n_channels = n_channels
+        self.block_size = block_size
+        self.fsync_interval = fsync_interval
+        self.time_func = time_func
+        self.last_timestamp = 0.0
+
+        # A single preallocated record, reused for every write
+        self._record = np.zeros(1, dtype=record_dtype(n_channels, block_size))
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                existing = _unpack_header(f.read(HEADER_SIZE))
+            if existing[:2] != (n_channels, block_size):
+                raise ValueError("Recording %s has a different channel layout" % path)
+            if existing[2] != sfreq:
+                raise ValueError("Recording %s has a different sampling frequency" % path)
+
+            # Drop a partial last record, which would misalign every record
+            # appended after it
+            itemsize = self._record.dtype.itemsize
+            n_records = (os.path.getsize(path) - HEADER_SIZE) // itemsize
+            self._file = open(path, "r+b")
+            self._file.truncate(HEADER_SIZE + n_records * itemsize)
+            self._file.seek(0, os.SEEK_END)
+
+            # Keep stamping events after the blocks already recorded
+            if n_records > 0:
+                self._file.seek(HEADER_SIZE + (n_records - 1) * itemsize)
+                last = np.frombuffer(self._file.read(itemsize), dtype=self._record.dtype)[0]
+                self.last_timestamp = float(last["timestamps"][-1])
+                self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, "wb")
+            self._file.write(_pack_header(n_channels, block_size, sfreq,
+                                          time()))
+            self._file.flush()
+
+        self._last_fsync = self.time_func()
+
+    def record_eeg(self, data, timestamps):
+        """
+        Appends a block of EEG data. The signature matches the Muse
+        `callback_eeg` callback, so a recorder can be subscribed directly.
+
+        data: array of shape [channels, samples].
+        timestamps: array of shape [samples].
+        """
+
+        record = self._record[0]
+        n = len(timestamps)
+        record["kind"] = KIND_EEG
+        record["n"] = n
+        record["timestamps"][:n] = timestamps
+        record["timestamps"][n:] = timestamps[-1]
+        record["data"][:, :n] = data[:self.n_channels]
+        record["data"][:, n:] = 0
+        self.last_timestamp = timestamps[-1]
+        self._write()
+
+    def record_telemetry(self, values):
+        """
+        Appends a telemetry event.
+
+        values: a sequence of telemetry values (battery, fuel gauge, ADC
+            voltage, temperature, ...).
+        """
+
+        self._write_event(KIND_TELEMETRY, values)
+
+    def record_gap(self, tm, last_tm):
+        """
+        Appends a gap event, for when packets were lost.
+
+        tm: The packet counter that was received.
+        last_tm: The previous packet counter.
+        """
+
+        self._write_event(KIND_GAP, (tm, last_tm))
+
+    def _write_event(self, kind, values):
+        record = self._record[0]
+        flat = record["data"].reshape(-1)
+        n = min(len(values), flat.shape[0])
+        record["kind"] = kind
+        record["n"] = n
+        record["timestamps"][:] = self.last_timestamp
+        flat[:] = 0
+        flat[:n] = values[:n]
+        self._write()
+
+    def _write(self):
+        self._file.write(self._record.tobytes())
+        self._file.flush()
+
+        now = self.time_func()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def close(self):
+        """Flushes and closes the file"""
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Recording:
+    """A read-only, memory-mapped view of a recording file"""
+
+    def __init__(self, path):
+        """
+        Opens a recording. Nothing but the header is read; the records are
+        memory-mapped and paged in on access.
+
+        path: Path of the recording file.
+        """
+
+        self.path = path
+
+        with open(path, "rb") as f:
+            header = _unpack_header(f.read(HEADER_SIZE))
+
+        self.n_channels, self.block_size, self.sfreq, self.created = header
+        self.dtype = record_dtype(self.n_channels, self.block_size)
+
+        # A recording that is still being written may end on a partial record
+        n_records = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+
+        if n_records > 0:
+            self.records = np.memmap(path, dtype=self.dtype, mode="r",
+                                     offset=HEADER_SIZE, shape=(n_records,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    @property
+    def start(self):
+        """The first timestamp in the recording"""
+        return float(self.records["timestamps"][0, 0]) if len(self) else None
+
+    @property
+    def stop(self):
+        """The last timestamp in the recording"""
+        return float(self.records["timestamps"][-1, -1]) if len(self) else None
+
+    def blocks(self, start=None, stop=None):
+        """
+        Gets the records overlapping a time range, as a memory-mapped slice.
+
+        start: The (inclusive) start timestamp, or None for the beginning.
+        stop: The (exclusive) stop timestamp, or None for the end.
+        """
+
+        timestamps = self.records["timestamps"]
+        # `bisect` only touches O(log n) records, where `np.searchsorted`
+        # would copy the whole (strided) column first
+        i0 = 0 if start is None else bisect_left(timestamps[:, -1], start)
+        i1 = len(self) if stop is None else bisect_right(timestamps[:, 0], stop)
+        return self.records[i0:max(i0, i1)]
+
+    def eeg(self, start=None, stop=None):
+        """
+        Gets the EEG data in a time range.
+
+        Returns a tuple of (data, timestamps), where data has the shape
+        [samples, channels].
+        """
+
+        return self._eeg_of(self.blocks(start, stop), start, stop)
+
+    def iter_eeg(self, start=None, stop=None, chunk=256):
+        """
+        Iterates over the EEG data in a time range, `chunk` records at a
+        time, so that long sessions can be processed in bounded memory.
+
+        Yields tuples of (data, timestamps), like `eeg`.
+        """
+
+        blocks = self.blocks(start, stop)
+        for i in range(0, len(blocks), chunk):
+            yield self._eeg_of(blocks[i:i + chunk], start, stop)
+
+    def _eeg_of(self, blocks, start=None, stop=None):
+        blocks = blocks[blocks["kind"] == KIND_EEG]
+
+        data = blocks["data"].transpose(0, 2, 1).reshape(-1, self.n_channels)
+        timestamps = blocks["timestamps"].reshape(-1)
+
+        # Drop the padding of partial blocks, and trim to the exact range
+        mask = np.repeat(np.arange(self.block_size)[None, :], len(blocks), axis=0)
+        mask = (mask < blocks["n"][:, None]).reshape(-1)
+        if start is not None:
+            mask &= timestamps >= start
+        if stop is not None:
+            mask &= timestamps < stop
+
+        return np.asarray(data[mask]), np.asarray(timestamps[mask])
+
+    def _events(self, kind, start=None, stop=None):
+        blocks = self.blocks(start, stop)
+        blocks = blocks[blocks["kind"] == kind]
+        # An explicit width, as -1 can't be inferred when there are none
+        values = blocks["data"].reshape(len(blocks), self.n_channels * self.block_size)
+        return np.asarray(blocks["timestamps"][:, 0]), np.asarray(values)
+
+    def telemetry(self, start=None, stop=None):
+        """
+        Gets the telemetry events in a time range, as a tuple of
+        (timestamps, values).
+        """
+
+        timestamps, values = self._events(KIND_TELEMETRY, start, stop)
+        return timestamps, values[:, :4]
+
+    def gaps(self, start=None, stop=None):
+        """
+        Gets the gap events in a time range, as a tuple of (timestamps,
+        packet counters) where each row of the counters is (tm, last_tm).
+        """
+
+        timestamps, values = self._events(KIND_GAP, start, stop)
+        return timestamps, values[:, :2].astype(np.int64)
@@ -0,0 +1,121 @@
+"""
+Sources that stand in for a headset: playback of recordings, and synthetic
+EEG. Both yield `Sample`s exactly like `get_raw`, so anything downstream of it
+can be driven without a Muse or a BLE adapter.
+"""
+
+import time
+
+import numpy as np
+
+from .models import Sample
+from .record import Recording
+
+# Default band content of synthetic EEG, as {frequency (Hz): amplitude (uV)}
+DEFAULT_BANDS = {2: 10.0, 6: 8.0, 10: 20.0, 20: 5.0}
+
+
+def synthesize(n_channels=5, sfreq=256, bands=None, noise=5.0, block_size=12,
+               loss=0.0, duration=None, start=0.0, seed=None):
+    """
+    Generates blocks of synthetic EEG.
+
+    n_channels: Number of channels.
+    sfreq: Sampling frequency.
+    bands: A dict of {frequency: amplitude} sinusoids to mix in. Each channel
+        gets a different phase. Defaults to `DEFAULT_BANDS`.
+    noise: Standard deviation of the added white noise, in microvolts.
+    block_size: Number of samples per block, 12 for a Muse packet.
+    loss: Probability of dropping a block, simulating packet loss. Time keeps
+        advancing over dropped blocks.
+    duration: Seconds of data to generate, or None to generate forever.
+    start: Timestamp of the first sample.
+    seed: Seed for the random number generator.
+
+    Yields tuples of (data, timestamps), where data has the shape
+    [channels, samples].
+    """
+
+    rng = np.random.default_rng(seed)
+    bands = DEFAULT_BANDS if bands is None else bands
+
+    freqs = np.array(list(bands.keys()), dtype=float)
+    amplitudes = np.array(list(bands.values()), dtype=float)
+    phases = rng.uniform(0, 2 * np.pi, (n_channels, len(freqs), 1))
+    offsets = np.arange(block_size) / sfreq
+
+    n_blocks = None if duration is None else int(duration * sfreq / block_size)
+    i = 0
+
+    while n_blocks is None or i < n_blocks:
+        t = i * block_size / sfreq + offsets
+        i += 1
+
+        if loss and rng.random() < loss:
+            continue
+
+        waves = np.sin(2 * np.pi * freqs[None, :, None] * t + phases)
+        data = np.einsum("f,cfs->cs", amplitudes, waves)
+        if noise:
+            data += rng.normal(0, noise, data.shape)
+
+        yield data, start + t
+
+
+def _recorded_blocks(recording, start=None, stop=None):
+    # Reads the recording a chunk at a time, so that playing back a long
+    # session doesn't load it into memory
+    n = recording.block_size
+
+    for data, timestamps in recording.iter_eeg(start, stop):
+        for i in range(0, len(timestamps), n):
+            yield data[i:i + n].T, timestamps[i:i + n]
+
+
+def _paced(blocks, speed):
+    """
+    Yields the samples of `blocks`, sleeping so that they come out at `speed`
+    times real time. A speed of None (or 0) yields as fast as possible.
+    """
+
+    origin = None
+
+    for data, timestamps in blocks:
+        if speed:
+            if origin is None:
+                origin = (timestamps[0], time.monotonic())
+            delay = (timestamps[-1] - origin[0]) / speed - (time.monotonic() - origin[1])
+            if delay > 0:
+                time.sleep(delay)
+
+        for i in range(len(timestamps)):
+            yield Sample(timestamps[i], data[:, i])
+
+
+def get_replay(path, speed=1.0, start=None, stop=None):
+    """
+    Plays back a recording with the same iterator API as `get_raw`.
+
+    path: Path of the recording.
+    speed: Playback speed relative to real time, or None for as fast as
+        possible.
+    start: Timestamp to start playing from, or None for the beginning.
+    stop: Timestamp to stop playing at, or None for the end.
+    """
+
+    recording = Recording(path)
+    return _paced(_recorded_blocks(recording, start, stop), speed)
+
+
+def get_synthetic(speed=1.0, **kwargs):
+    """
+    Yields synthetic EEG with the same iterator API as `get_raw`. Timestamps
+    start at the current time.
+
+    speed: Playback speed relative to real time, or None for as fast as
+        possible.
+    kwargs: Passed on to `synthesize`.
+    """
+
+    kwargs.setdefault("start", time.time())
+    return _paced(synthesize(**kwargs), speed)
@@ -0,0 +1,181 @@
+"""
+Streaming resampling onto a common time grid.
+
+Each headset stamps its samples with its own dejittered clock, at a rate a
+little off 256 Hz. To line several headsets up sample for sample, each one's
+samples are interpolated at the times of a grid shared by all of them. Only
+the samples the next grid times can still need are kept, so memory and
+latency stay bounded however long the stream runs.
+"""
+
+import numpy as np
+
+
+def interpolate(timestamps, data, grid, method="linear", max_gap=None):
+    """
+    Evaluates a sampled signal at other times, vectorized over channels.
+
+    timestamps: Increasing array of the samples' timestamps.
+    data: array of shape [samples, channels].
+    grid: array of the times to evaluate the signal at.
+    method: "linear" to interpolate between the samples on either side of
+        each time, or "nearest" to take the closest one.
+    max_gap: Maximum seconds between the samples on either side of a time
+        for it to be interpolated, or None for no limit.
+
+    Returns an array of shape [len(grid), channels], NaN at times outside the
+    samples or in gaps.
+    """
+
+    result = np.full((len(grid), data.shape[1]), np.nan)
+    n = len(timestamps)
+    if n < 2 or not len(grid):
+        return result
+
+    # The samples on either side of each time
+    right = np.clip(np.searchsorted(timestamps, grid, side="right"), 1, n - 1)
+    left = right - 1
+
+    t0 = timestamps[left]
+    t1 = timestamps[right]
+    span = t1 - t0
+    inside = (grid >= timestamps[0]) & (grid <= timestamps[-1])
+    if max_gap is not None:
+        inside &= span <= max_gap
+
+    if method == "nearest":
+        index = np.where(grid - t0 <= t1 - grid, left, right)
+        result[inside] = data[index[inside]]
+    elif method == "linear":
+        weight = np.divide(grid - t0, span, out=np.zeros(len(grid)), where=span > 0)[:, None]
+        values = data[left] * (1 - weight) + data[right] * weight
+        result[inside] = values[inside]
+    else:
+        raise(ValueError("Unknown method: {}".format(method)))
+
+    return result
+
+
+class Resampler:
+    """Buffers one device's samples and interpolates them on a grid"""
+
+    def __init__(self, n_channels, method="linear", max_gap=None):
+        """
+        n_channels: Number of channels.
+        method: "linear" or "nearest", see `interpolate`.
+        max_gap: Maximum seconds between two samples to interpolate
+            between, or None for no limit. Longer gaps come out as NaN.
+        """
+
+        self.method = method
+        self.max_gap = max_gap
+        self.timestamps = np.zeros(0)
+        self.data = np.zeros((0, n_channels))
+
+    @property
+    def first(self):
+        """The earliest buffered timestamp, or None"""
+        return float(self.timestamps[0]) if len(self.timestamps) else None
+
+    @property
+    def latest(self):
+        """The latest buffered timestamp, or None"""
+        return float(self.timestamps[-1]) if len(self.timestamps) else None
+
+    def push(self, timestamps, data):
+        """
+        Adds samples. Samples older than the latest one already pushed are
+        dropped, as the grid may have moved past them.
+
+        timestamps: array of the samples' timestamps.
+        data: array of shape [samples, channels].
+        """
+
+        if len(self.timestamps):
+            new = timestamps > self.timestamps[-1]
+            timestamps, data = timestamps[new], data[new]
+
+        self.timestamps = np.concatenate((self.timestamps, timestamps))
+        self.data = np.concatenate((self.data, data))
+
+    def resample(self, grid):
+        """
+        Gets the signal at each time of `grid`, an array of shape
+        [len(grid), channels]. Each call's grid must start after the
+        previous one's, as the samples before it are discarded.
+        """
+
+        values = interpolate(self.timestamps, self.data, grid, self.method, self.max_gap)
+
+        if len(grid):
+            # Keep the last sample before the end of the grid, which the next
+            # grid times still interpolate from
+            keep = max(0, np.searchsorted(self.timestamps, grid[-1]) - 1)
+            self.timestamps = self.timestamps[keep:]
+            self.data = self.data[keep:]
+
+        return values
+
+
+class Aligner:
+    """
+    Resamples several devices onto one grid, and hands out blocks of shape
+    [devices, channels, samples] as soon as every live device has data for
+    them.
+    """
+
+    def __init__(self, n_devices, n_channels, sfreq=256, method="linear",
+                 max_gap=None, max_delay=1.0):
+        """
+        n_devices: Number of devices.
+        n_channels: Number of channels of each device.
+        sfreq: The frequency of the grid.
+        method: "linear" or "nearest", see `interpolate`.
+        max_gap: See `Resampler`.
+        max_delay: Seconds a device may lag behind the most advanced one
+            before the grid moves on without it. Its samples are then NaN,
+            which bounds the latency a stalled headset adds.
+        """
+
+        self.sfreq = sfreq
+        self.max_delay = max_delay
+        self.resamplers = [Resampler(n_channels, method, max_gap) for _ in range(n_devices)]
+        # The time of the next grid point, set once data arrives
+        self.next = None
+
+    def push(self, device, timestamps, data):
+        """Adds samples of the `device`th device, see `Resampler.push`"""
+        self.resamplers[device].push(timestamps, data)
+
+    def available(self):
+        """Gets the number of grid points every live device has data for"""
+        if self.next is None:
+            started = [r.first for r in self.resamplers if r.latest is not None]
+            if not started:
+                return 0
+            # Start where every device that has started has data
+            self.next = max(started)
+
+        # A device that hasn't sent anything yet is as late as can be
+        latest = [self.next - 1.0 / self.sfreq if r.latest is None else r.latest
+                  for r in self.resamplers]
+        newest = max(latest)
+        ready = min(t for t in latest if newest - t <= self.max_delay)
+        return max(0, int(np.floor((ready - self.next) * self.sfreq + 1e-9)) + 1)
+
+    def read(self, n):
+        """
+        Takes the next `n` grid points, or fewer if they aren't available.
+
+        Returns a tuple of (data, timestamps), where data has the shape
+        [devices, channels, samples].
+        """
+
+        n = min(n, self.available())
+        if n <= 0:
+            return np.zeros((len(self.resamplers), self.resamplers[0].data.shape[1], 0)), np.zeros(0)
+
+        grid = self.next + np.arange(n) / self.sfreq
+        self.next = self.next + n / self.sfreq
+        data = np.stack([r.resample(grid).T for r in self.resamplers])
+        return data, grid
@@ -0,0 +1,146 @@
+"""
+A cache of the LSL streams on the network.
+
+Resolving streams takes seconds, as LSL has to wait for the network to
+answer. `Resolver` does that on a background thread, over and over, and keeps
+what it found, so that consumers can look streams up instantly and be told
+when they appear and disappear. `get_resolver` shares one per process.
+"""
+
+import logging
+import threading
+import time
+
+from mne_lsl.lsl import resolve_streams
+
+
+class Resolver:
+    """Watches the network for LSL streams"""
+
+    def __init__(self, interval=2.0, expire=10.0, on_added=None, on_removed=None):
+        """
+        interval: Seconds each resolution listens for, back to back.
+        expire: Seconds after which a stream that hasn't been seen again is
+            considered gone.
+        on_added: Called with the `StreamInfo` of each new stream, on the
+            resolver thread.
+        on_removed: Called with the `StreamInfo` of each stream gone.
+        """
+
+        self.interval = interval
+        self.expire = expire
+        self.on_added = on_added
+        self.on_removed = on_removed
+
+        # uid -> (StreamInfo, time last seen)
+        self._streams = {}
+        self._changed = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts watching on a daemon thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="resolver")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                found = resolve_streams(timeout=self.interval)
+            except Exception:
+                logging.error("Error resolving LSL streams", exc_info=True)
+                self._stopped.wait(self.interval)
+                continue
+
+            self.update(found)
+
+    def update(self, found, now=None):
+        """Folds the result of a resolution into the cache"""
+        now = time.monotonic() if now is None else now
+        added = []
+        removed = []
+
+        with self._changed:
+            for info in found:
+                if info.uid not in self._streams:
+                    added.append(info)
+                self._streams[info.uid] = (info, now)
+
+            for uid, (info, seen) in list(self._streams.items()):
+                if now - seen > self.expire:
+                    del self._streams[uid]
+                    removed.append(info)
+
+            self._changed.notify_all()
+
+        for info in added:
+            if self.on_added:
+                self.on_added(info)
+        for info in removed:
+            if self.on_removed:
+                self.on_removed(info)
+
+    def streams(self, name=None, stype=None, source_id=None, prefix=None):
+        """
+        Gets the known streams matching all of the given properties, without
+        waiting.
+
+        name: Name of the streams.
+        stype: Type of the streams.
+        source_id: Source ID of the streams.
+        prefix: Prefix of the source IDs, e.g. "Muse_" for every headset.
+        """
+
+        with self._changed:
+            infos = [info for info, _ in self._streams.values()]
+
+        return sorted(
+            (info for info in infos
+             if (name is None or info.name == name)
+             and (stype is None or info.stype == stype)
+             and (source_id is None or info.source_id == source_id)
+             and (prefix is None or info.source_id.startswith(prefix))),
+            key=lambda info: info.source_id)
+
+    def wait(self, timeout=None, minimum=1, **kwargs):
+        """
+        Waits for at least `minimum` streams matching `kwargs`, the
+        properties `streams` takes, to be known. Returns the matching
+        streams, which may be fewer if the timeout expired.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._changed:
+            while True:
+                infos = self.streams(**kwargs)
+                if len(infos) >= minimum:
+                    return infos
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return infos
+                self._changed.wait(remaining)
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """Gets the process wide `Resolver`, starting it on first use"""
+    global _resolver
+
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = Resolver().start()
+        return _resolver
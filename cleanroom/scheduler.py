@@ -0,0 +1,171 @@
+"""
+Periodic per-device tasks on a single thread.
+
+`Scheduler` is a hashed timer wheel: timers are bucketed by the tick they're
+due on, so scheduling, cancelling and firing are O(1) however many headsets
+are being supervised. Its default tick is one EEG packet interval (12 samples
+at 256 Hz), which bounds how late any task runs, including the stall watchdog.
+"""
+
+import logging
+import threading
+from math import ceil
+from time import monotonic
+
+# The time between two EEG packets
+PACKET_INTERVAL = 12 / 256
+
+
+class Timer:
+    """A scheduled call, returned so that it can be cancelled"""
+
+    __slots__ = ("func", "period", "deadline", "tick", "cancelled")
+
+    def __init__(self, func, deadline, period=None):
+        self.func = func
+        self.deadline = deadline
+        self.period = period
+        self.tick = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """A timer wheel running its timers on one background thread"""
+
+    def __init__(self, tick=PACKET_INTERVAL, slots=256, time_func=monotonic):
+        """
+        tick: The resolution of the wheel, in seconds.
+        slots: Number of buckets. Timers further than `tick * slots` away
+            wait for the wheel to come around.
+        time_func: The clock to use.
+        """
+
+        self.tick = tick
+        self.time_func = time_func
+        self._slots = [[] for _ in range(slots)]
+        self._origin = time_func()
+        self._current = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def call_later(self, delay, func):
+        """Calls `func()` once, after `delay` seconds"""
+        return self._add(Timer(func, self.time_func() + delay))
+
+    def call_every(self, period, func, delay=None):
+        """Calls `func()` every `period` seconds, the first time after
+        `delay` seconds (defaulting to `period`)"""
+        delay = period if delay is None else delay
+        return self._add(Timer(func, self.time_func() + delay, period))
+
+    def _add(self, timer):
+        with self._lock:
+            self._insert(timer)
+        return timer
+
+    def _insert(self, timer):
+        tick = ceil((timer.deadline - self._origin) / self.tick)
+        timer.tick = max(tick, self._current)
+        self._slots[timer.tick % len(self._slots)].append(timer)
+
+    def advance(self, now=None):
+        """Runs every timer due by `now`. Returns the time of the next tick."""
+        now = self.time_func() if now is None else now
+        target = int((now - self._origin) / self.tick)
+
+        while self._current <= target:
+            with self._lock:
+                slot = self._slots[self._current % len(self._slots)]
+                due = [t for t in slot if t.tick <= self._current and not t.cancelled]
+                slot[:] = [t for t in slot if t.tick > self._current and not t.cancelled]
+                self._current += 1
+
+            for timer in due:
+                try:
+                    timer.func()
+                except Exception:
+                    logging.error("Error running scheduled task", exc_info=True)
+
+                if timer.period is not None and not timer.cancelled:
+                    # Skip missed periods rather than bursting to catch up
+                    timer.deadline += timer.period * max(1, ceil((now - timer.deadline) / timer.period))
+                    with self._lock:
+                        self._insert(timer)
+
+        return self._origin + self._current * self.tick
+
+    def run(self):
+        """Runs timers until `stop` is called"""
+        while not self._stopped.is_set():
+            next_tick = self.advance()
+            self._stopped.wait(max(0, next_tick - self.time_func()))
+
+    def start(self):
+        """Runs timers on a daemon thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+
+class DeviceTasks:
+    """The periodic tasks that keep a headset streaming"""
+
+    def __init__(self, scheduler, muse, keep_alive=1.0, poll=30.0,
+                 stall_timeout=10.0, on_stall=None):
+        """
+        scheduler: The `Scheduler` to run on, shared between headsets.
+        muse: The `Muse` to supervise.
+        keep_alive: Seconds between keep-alive commands, or None.
+        poll: Seconds between device status requests, or None.
+        stall_timeout: Seconds without an EEG packet after which the headset
+            is considered stalled. Checked every tick.
+        on_stall: Called with the `Muse` once, when it stalls.
+        """
+
+        self.muse = muse
+        self.stall_timeout = stall_timeout
+        self.on_stall = on_stall
+        self.stalled = False
+        self.timers = []
+        # The response to the latest status request
+        self._poll_future = None
+
+        if keep_alive:
+            self.timers.append(scheduler.call_every(keep_alive, muse.keep_alive))
+        if poll:
+            self.timers.append(scheduler.call_every(poll, self._poll))
+        if stall_timeout:
+            self.timers.append(scheduler.call_every(scheduler.tick, self._watchdog))
+
+    def _poll(self):
+        # A request the headset never answered would otherwise wait forever,
+        # and take the response to a later one. Cancelled requests are
+        # skipped when responses are handed out.
+        if self._poll_future is not None:
+            self._poll_future.cancel()
+        self._poll_future = self.muse.ask_control()
+
+    def _watchdog(self):
+        if self.stalled:
+            return
+        if monotonic() - self.muse.last_packet_time > self.stall_timeout:
+            self.stalled = True
+            if self.on_stall:
+                self.on_stall(self.muse)
+
+    def cancel(self):
+        for timer in self.timers:
+            timer.cancel()
+        if self._poll_future is not None:
+            self._poll_future.cancel()
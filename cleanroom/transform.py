@@ -3,85 +3,162 @@ Module for computing frequency bands from raw EEG data. All of the interesting
 math here comes from https://github.com/NeuroTechX/bci-workshop
 """
 
+import threading
+
 import numpy as np
+from . import design, metrics
 from .models import Sample
-from scipy.signal import butter, lfilter, lfilter_zi
+from .presets import SAMPLING_FREQUENCY, get_layout
 import itertools
 
-NOTCH_B, NOTCH_A = butter(4, np.array([55, 65]) / (256 / 2), btype='bandstop')
-CHANNEL_INDICES = [0, 1, 2, 3]
-SAMPLING_FREQUENCY = 256
-
-def _update_buffer(data_buffer, new_data, notch=False, filter_state=None):
-    """
-    Concatenates "new_data" into "data_buffer", and returns an array with
-    the same size as "data_buffer"
-    """
-    if new_data.ndim == 1:
-        new_data = new_data.reshape(-1, data_buffer.shape[1])
-
-    if notch:
-        if filter_state is None:
-            filter_state = np.tile(lfilter_zi(NOTCH_B, NOTCH_A),
-                                   (data_buffer.shape[1], 1)).T
-        new_data, filter_state = lfilter(NOTCH_B, NOTCH_A, new_data, axis=0,
-                                         zi=filter_state)
+# The scalp channels, which come first in the samples of every preset, see
+# `presets`. The others, like AUX, are left out of the features.
+CHANNEL_INDICES = get_layout().eeg_indices
 
-    new_buffer = np.concatenate((data_buffer, new_data), axis=0)
-    new_buffer = new_buffer[new_data.shape[0]:, :]
+# The line noise filter, as the arguments of `design.butter`
+NOTCH = (4, (55, 65), "bandstop", SAMPLING_FREQUENCY)
 
-    return new_buffer, filter_state
+BANDS = ("delta", "theta", "alpha", "beta")
+# The frequencies of each band, in Hz, from the lower edge up to but not
+# including the upper one
+BAND_EDGES = (("delta", 0, 4), ("theta", 4, 8), ("alpha", 8, 12), ("beta", 12, 30))
+# Band power ratios, as (numerator, denominator)
+RATIOS = {
+    "theta_beta": ("theta", "beta"),
+    "alpha_theta": ("alpha", "theta"),
+}
+# Every feature `get_features` can compute
+FEATURES = BANDS + tuple("relative_" + band for band in BANDS) + (
+    "total_power", "spectral_edge", "peak_alpha") + tuple(RATIOS)
+# The fraction of power below the spectral edge frequency
+SPECTRAL_EDGE = 0.95
 
-def _compute_feature_vector(eeg_data):
+def _spectrum(eeg_data, taper="hamming"):
     """
-    Extract the features from the EEG.
+    Computes the magnitude spectrum of a window of EEG.
 
     Args:
         eeg_data (numpy.ndarray): array of dimension [number of samples,
                 number of channels]
+        taper (str): the window function, from `design.WINDOWS`
 
     Returns:
-        (numpy.ndarray): feature matrix of shape [number of feature points,
-            number of different features]
+        (int, numpy.ndarray): the FFT length, and the spectrum of shape
+            [number of frequencies, number of channels]
     """
-    
-    # Compute the PSD
+
     win_sample_length, _ = eeg_data.shape
 
-    # Apply Hamming window
-    w = np.hamming(win_sample_length)
+    # Apply the window function
+    w = design.window(taper, win_sample_length)
     data_win_centered = eeg_data - np.mean(eeg_data, axis=0)  # Remove offset
     data_win_centered_ham = (data_win_centered.T * w).T
 
     nfft = _nextpow2(win_sample_length)
     y = np.fft.fft(data_win_centered_ham, n=nfft, axis=0) / win_sample_length
     psd = 2 * np.abs(y[0 : int(nfft / 2), :])
-    f = SAMPLING_FREQUENCY / 2 * np.linspace(0, 1, int(nfft / 2))
+    return nfft, psd
+
+@design.memoize()
+def _frequencies(nfft):
+    """Gets the frequencies of the first half of an `nfft` point FFT"""
+    return SAMPLING_FREQUENCY / 2 * np.linspace(0, 1, int(nfft / 2))
 
-    # SPECTRAL FEATURES
-    # Average of band powers
-    # Delta <4
-    ind_delta, = np.where(f < 4)
-    mean_delta = np.mean(psd[ind_delta, :], axis=0)
+@design.memoize()
+def _band_indices(nfft, bands=BAND_EDGES):
+    """Gets the indices of the frequencies of an `nfft` point FFT in each
+    band of `bands`, a tuple like `BAND_EDGES`"""
+    f = _frequencies(nfft)
+    return {name: np.where((f >= low) & (f < high))[0] for name, low, high in bands}
 
-    # Theta 4-8
-    ind_theta, = np.where((f >= 4) & (f <= 8))
-    mean_theta = np.mean(psd[ind_theta, :], axis=0)
+def _compute_features(eeg_data, names=BANDS, bands=BAND_EDGES):
+    """
+    Extract the requested features from the EEG, from a single FFT.
 
-    # Alpha 8-12
-    ind_alpha, = np.where((f >= 8) & (f <= 12))
-    mean_alpha = np.mean(psd[ind_alpha, :], axis=0)
+    Args:
+        eeg_data (numpy.ndarray): array of dimension [number of samples,
+                number of channels]
+        names (iterable): the names of the features to compute, from
+                `FEATURES`
+        bands (tuple): the band edges, like `BAND_EDGES`
 
-    # Beta 12-30
-    ind_beta, = np.where((f >= 12) & (f < 30))
-    mean_beta = np.mean(psd[ind_beta, :], axis=0)
+    Returns:
+        (dict): feature name to an array with a value per channel
+    """
 
-    feature_vector = np.concatenate((mean_delta, mean_theta, mean_alpha,
-                                     mean_beta), axis=0)
+    nfft, psd = _spectrum(eeg_data)
+    return _features_from_spectrum(nfft, psd, names, bands)
 
-    feature_vector = np.log10(feature_vector)
+def _features_from_spectrum(nfft, psd, names=BANDS, bands=BAND_EDGES):
+    """
+    Extract the requested features from a magnitude spectrum.
+
+    Args:
+        nfft (int): the length of the FFT the spectrum comes from
+        psd (numpy.ndarray): the spectrum, with the frequencies along the
+                first axis, e.g. [number of frequencies, number of channels]
+        names (iterable): the names of the features to compute
+        bands (tuple): the band edges, like `BAND_EDGES`
+
+    Returns:
+        (dict): feature name to an array of the shape of `psd` without its
+            first axis
+    """
+
+    return _features_from_bands(nfft, psd, names, _band_indices(nfft, bands))
+
+def _features_from_bands(nfft, psd, names, bands):
+    """
+    Extract the requested features from a magnitude spectrum, given the
+    indices of the frequencies in each band, see `_features_from_spectrum`.
+    """
+
+    f = _frequencies(nfft)
+    power = psd ** 2
+    features = {}
+
+    for name in names:
+        if name in bands:
+            # Log10 of the average magnitude in the band
+            features[name] = np.log10(np.mean(psd[bands[name], :], axis=0))
+        elif name.startswith("relative_"):
+            # The band's share of the power across the whole spectrum
+            band_power = np.sum(power[bands[name[9:]], :], axis=0)
+            features[name] = band_power / np.sum(power, axis=0)
+        elif name == "total_power":
+            features[name] = np.log10(np.sum(power, axis=0))
+        elif name == "spectral_edge":
+            # The frequency below which SPECTRAL_EDGE of the power lies
+            cumulative = np.cumsum(power, axis=0)
+            edge = np.argmax(cumulative >= SPECTRAL_EDGE * cumulative[-1], axis=0)
+            features[name] = f[edge]
+        elif name == "peak_alpha":
+            ind_alpha = bands["alpha"]
+            features[name] = f[ind_alpha][np.argmax(power[ind_alpha, :], axis=0)]
+        elif name in RATIOS:
+            numerator, denominator = RATIOS[name]
+            features[name] = (np.mean(power[bands[numerator], :], axis=0) /
+                              np.mean(power[bands[denominator], :], axis=0))
+        else:
+            raise(ValueError("Unknown feature: {}".format(name)))
+
+    return features
+
+def _compute_feature_vector(eeg_data):
+    """
+    Extract the features from the EEG.
+
+    Args:
+        eeg_data (numpy.ndarray): array of dimension [number of samples,
+                number of channels]
+
+    Returns:
+        (numpy.ndarray): feature matrix of shape [number of feature points,
+            number of different features]
+    """
 
-    return feature_vector
+    features = _compute_features(eeg_data, BANDS)
+    return np.concatenate([features[band] for band in BANDS], axis=0)
 
 def _nextpow2(i):
     """
@@ -92,10 +169,175 @@ def _nextpow2(i):
         n *= 2
     return n
 
-def get_waves(raw_data, chunk_size=SAMPLING_FREQUENCY):
-    last_timestamp = None
-    eeg_buffer = np.zeros((int(SAMPLING_FREQUENCY), len(CHANNEL_INDICES)))
-    filter_state = None
+def _check_features(features):
+    features = tuple(features)
+    unknown = set(features) - set(FEATURES)
+    if unknown:
+        raise(ValueError("Unknown features: {}".format(", ".join(sorted(unknown)))))
+    return features
+
+class FeatureEngine:
+    """
+    The state of feature computation for one headset: the window, the notch
+    filter and any artifact and quality trackers. Engines are plain picklable
+    objects, so that the work can be moved to another process between chunks.
+    """
+
+    def __init__(self, features=BANDS, artifacts=None, reject=False, quality=None,
+                 notch=NOTCH, bands=BAND_EDGES, graph=None):
+        """
+        features: The names of the features to compute, from `FEATURES`. They
+            all come from the same FFT.
+        artifacts: An optional `ArtifactDetector` to check each chunk with.
+        reject: Whether to skip the features of chunks with artifacts,
+            rather than only reporting them.
+        quality: An optional `SignalQuality` to update with each chunk.
+        notch: The arguments of `design.butter` for the line noise filter,
+            e.g. `(4, (45, 55), "bandstop", 256)` where the mains are at
+            50 Hz, or None for no filter. Designs are cached, so changing it
+            doesn't redesign a filter another headset already uses.
+        bands: The edges of the bands, like `BAND_EDGES`.
+        graph: A `graph.Graph` to compute the features with, instead of the
+            one `graph.build_graph` makes of `features`, `notch` and `bands`.
+        """
+
+        # The graph is made of this module's functions, so it's imported
+        # once this module is loaded
+        from .graph import build_graph
+
+        self.artifacts = artifacts
+        self.reject = reject
+        self.quality = quality
+        self.graph = graph or build_graph(_check_features(features), notch, bands)
+        self.last_timestamp = None
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, and only guard this process's threads
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def configure(self, **params):
+        """
+        Changes parameters from the next chunk on, without losing the window
+        or, if it's unchanged, the filter state. It's safe to call from
+        another thread than the one processing.
+
+        params: `artifacts` and `reject`, and either `graph` to swap in a new
+            `graph.Graph`, or any of `features`, `notch` and `bands` to build
+            one, see `__init__`.
+        """
+
+        from .graph import build_graph
+
+        unknown = set(params) - {"features", "artifacts", "reject", "notch", "bands", "graph"}
+        if unknown:
+            raise(ValueError("Unknown parameters: {}".format(", ".join(sorted(unknown)))))
+
+        dsp = {name: params.pop(name) for name in ("features", "notch", "bands") if name in params}
+        if "features" in dsp:
+            dsp["features"] = _check_features(dsp["features"])
+
+        # The processing thread takes the pending changes under the same
+        # lock, so none are lost or applied halfway
+        with self._lock:
+            if dsp:
+                # What isn't given stays as it is in the latest graph
+                latest = (self._pending or {}).get("graph", self.graph)
+                params["graph"] = build_graph(**dict(latest.settings(), **dsp))
+
+            self._pending = dict(self._pending or {}, **params)
+
+    def _apply_pending(self):
+        # Under the lock, so that `configure` builds on the graph in use
+        with self._lock:
+            params, self._pending = self._pending, None
+            if not params:
+                return
+
+            if "graph" in params:
+                # Swapped in between chunks, so no chunk sees half of each graph
+                params["graph"].adopt(self.graph)
+            for name, value in params.items():
+                setattr(self, name, value)
+
+    def process(self, timestamps, data):
+        """
+        Adds a chunk of samples and computes the features of the window
+        ending with it.
+
+        timestamps: array of the samples' timestamps.
+        data: array of shape [samples, channels], at least the 4 EEG channels.
+
+        Returns a tuple of (features, quality, artifact): a dict of feature
+        name to `Sample`, or None if there are no new samples or the chunk
+        was rejected, and the `Quality` and `Artifact` found, if any.
+        """
+
+        if self._pending:
+            self._apply_pending()
+
+        # Remove any samples we've already processed
+        if self.last_timestamp is not None:
+            new = timestamps > self.last_timestamp
+            timestamps, data = timestamps[new], data[new]
+
+        if not len(timestamps):
+            return None, None, None
+
+        ch_data = np.asarray(data)[:, :len(CHANNEL_INDICES)]
+        last_timestamp = self.last_timestamp = float(timestamps[-1])
+        reading = artifact = None
+
+        if self.artifacts is not None:
+            artifact = self.artifacts.detect(ch_data, last_timestamp)
+
+        # The filter and window are still updated for a rejected chunk, so
+        # the next clean window picks up where this one left off
+        rejected = artifact is not None and self.reject
+        frame = self.graph.process(ch_data, complete=not rejected)
+
+        if self.quality is not None:
+            reading = self.quality.update(ch_data, frame.get("filtered", ch_data), last_timestamp)
+
+        if rejected or "features" not in frame:
+            return None, reading, artifact
+
+        values = {name: Sample(last_timestamp, value) for name, value in frame["features"].items()}
+        return values, reading, artifact
+
+def get_features(raw_data, features=BANDS, chunk_size=SAMPLING_FREQUENCY,
+                 artifacts=None, reject=False, on_artifact=None, quality=None,
+                 on_quality=None, notch=NOTCH, bands=BAND_EDGES, engine=None):
+    """
+    Computes spectral features of raw EEG, one window per chunk. Yields a
+    dict of feature name to `Sample` for each window.
+
+    raw_data: An iterator of raw `Sample`s, e.g. from `get_raw`.
+    features: The names of the features to compute, from `FEATURES`. They
+        all come from the same FFT.
+    chunk_size: Number of samples per chunk.
+    artifacts: An optional `ArtifactDetector` to check each chunk with.
+    reject: Whether to skip the band powers of chunks with artifacts,
+        rather than only reporting them.
+    on_artifact: Called with each `Artifact` found.
+    quality: An optional `SignalQuality` to update with each chunk.
+    on_quality: Called with the `Quality` after each chunk.
+    notch: The line noise filter, see `FeatureEngine`.
+    bands: The edges of the bands, like `BAND_EDGES`.
+    engine: A `FeatureEngine` to use instead of one made of the arguments
+        above, e.g. to `configure` it while streaming.
+    """
+
+    if engine is None:
+        engine = FeatureEngine(features, artifacts=artifacts, reject=reject,
+                               quality=quality, notch=notch, bands=bands)
 
     while True:
         samples = list(itertools.islice(raw_data, chunk_size))
@@ -103,26 +345,38 @@ def get_waves(raw_data, chunk_size=SAMPLING_FREQUENCY):
         if not samples:
             break
 
-        # Remove any samples we've already processed
-        if last_timestamp is not None:
-            samples = [s for s in samples if s.timestamp > last_timestamp]
+        if metrics.ENABLED:
+            started = metrics.stamp()
 
-        if not samples:
+        timestamps, data = samples_to_arrays(samples)
+        values, reading, artifact = engine.process(timestamps, data)
+
+        if reading is not None and on_quality:
+            on_quality(reading)
+        if artifact is not None and on_artifact:
+            on_artifact(artifact)
+        if values is None:
             continue
 
-        timestamps = np.array([s.timestamp for s in samples])
-        ch_data = np.array([s.data[:4] for s in samples])
-        eeg_buffer, filter_state = _update_buffer(eeg_buffer, ch_data, notch=True, filter_state=filter_state)
+        if metrics.ENABLED:
+            metrics.stage("bands").observe(metrics.stamp() - started)
+
+        yield values
 
-        last_timestamp = samples[-1].timestamp
+def samples_to_arrays(samples):
+    """Gets the timestamps and [samples, channels] data of a list of `Sample`s"""
+    timestamps = np.array([s.timestamp for s in samples])
+    data = np.array([s.data[:len(CHANNEL_INDICES)] for s in samples])
+    return timestamps, data
 
-        # calculate feature vector, then split it up to its respective bands
-        feat_vector = _compute_feature_vector(eeg_buffer)
-        delta_vector, theta_vector, alpha_vector, beta_vector = np.split(feat_vector, 4)
+def get_waves(raw_data, **kwargs):
+    """
+    Computes the band powers of raw EEG, one window per chunk. Yields a tuple
+    of delta, theta, alpha and beta `Sample`s for each window.
+
+    raw_data: An iterator of raw `Sample`s, e.g. from `get_raw`.
+    kwargs: Passed on to `get_features`.
+    """
 
-        yield (
-            Sample(last_timestamp, delta_vector),
-            Sample(last_timestamp, theta_vector),
-            Sample(last_timestamp, alpha_vector),
-            Sample(last_timestamp, beta_vector),
-        )
+    for features in get_features(raw_data, features=BANDS, **kwargs):
+        yield tuple(features[band] for band in BANDS)
@@ -0,0 +1,636 @@
+import cleanroom
+from cleanroom import metrics
+from time import sleep
+from argparse import ArgumentParser, ArgumentTypeError
+import os
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+import threading
+import logging
+import multiprocessing
+import signal
+import sys
+import itertools
+import json
+
+from cleanroom.cli import add_config_argument, add_headset_arguments, headset_kwargs, parse_args
+
+class MainHandler(tornado.web.RequestHandler):
+    """The main request handler - just renders a template"""
+
+    def get(self):
+        self.render("index.html")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Exposes the pipeline metrics in the Prometheus text format"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.exposition())
+
+class GraphHandler(tornado.web.RequestHandler):
+    """
+    Gets the DSP graph's spec, or swaps in a new graph from the spec in the
+    request body, see `cleanroom.graph.graph_from_spec`
+    """
+
+    def initialize(self, control):
+        self.control = control
+
+    def get(self):
+        self.write(self.control.graph.spec())
+
+    def put(self):
+        try:
+            graph = cleanroom.graph.graph_from_spec(json.loads(self.request.body or b"null"))
+        except ValueError as e:
+            # Includes invalid JSON
+            self.set_status(400)
+            self.write({"error": str(e)})
+            return
+
+        self.control.swap(graph)
+        self.write(graph.spec())
+
+    post = put
+
+class StreamHandler(tornado.websocket.WebSocketHandler):
+    """Abstract class for handlers that stream sample data via websockets."""
+
+    # The most messages to hold between flushes, beyond which the oldest are
+    # dropped, or None for no limit
+    max_queue = None
+
+    @classmethod
+    def message_queue(cls):
+        """
+        Gets a queue of messages that are waiting to be flushed to the
+        websocket
+        """
+
+        if not hasattr(cls, "_message_queue"):
+            cls._message_queue = []
+        return cls._message_queue
+
+    @classmethod
+    def listeners(cls):
+        """
+        Gets a set of request handler instances currently subscribed to
+        messages
+        """
+
+        if not hasattr(cls, "_listeners"):
+            cls._listeners = set()
+        return cls._listeners
+
+    def open(self):
+        self.listeners().add(self)
+
+    def on_close(self):
+        try:
+            self.listeners().remove(self)
+        except:
+            # Listener may have already been removed
+            pass
+
+    @classmethod
+    def enqueue_message(cls, message):
+        """
+        Adds a new message
+
+        message: A string of the message contents
+        """
+
+        queue = cls.message_queue()
+        queue.append(message)
+        if cls.max_queue is not None and len(queue) > cls.max_queue:
+            del queue[:len(queue) - cls.max_queue]
+
+    @classmethod
+    def flush_message_queue(cls):
+        """Flushes any enqueued messages"""
+
+        queue = cls.message_queue()
+
+        if not len(queue):
+            return
+
+        removable = set()
+        message = "\n".join(queue) + "\n"
+        queue.clear()
+
+        for listener in cls.listeners():
+            try:
+                listener.write_message(message)
+            except tornado.iostream.StreamClosedError:
+                # `on_close` should capture most dropped listeners, but not
+                # all. This will remove any remaining dropped listeners.
+                removable.add(listener)
+            except:
+                logging.error("Error sending message", exc_info=True)
+
+        if len(removable):
+            cls.listeners().difference_update(removable)
+
+class RawStreamHandler(StreamHandler):
+    pass
+
+class TelemetryStreamHandler(StreamHandler):
+    """Streams telemetry, starting with the latest reading on connect"""
+
+    latest = None
+
+    def open(self):
+        super().open()
+        if self.latest is not None:
+            self.write_message(self.latest + "\n")
+
+    @classmethod
+    def enqueue_message(cls, message):
+        cls.latest = message
+        super().enqueue_message(message)
+
+class AccStreamHandler(StreamHandler):
+    pass
+
+class GyroStreamHandler(StreamHandler):
+    pass
+
+class PpgStreamHandler(StreamHandler):
+    pass
+
+class ArtifactStreamHandler(StreamHandler):
+    pass
+
+class QualityStreamHandler(StreamHandler):
+    pass
+
+class DeltaStreamHandler(StreamHandler):
+    pass
+
+class ThetaStreamHandler(StreamHandler):
+    pass
+
+class AlphaStreamHandler(StreamHandler):
+    pass
+
+class BetaStreamHandler(StreamHandler):
+    pass
+
+# The extra features that can be streamed, each from its own handler class so
+# that it gets its own message queue and listeners
+FEATURE_HANDLERS = {
+    name: type("{}StreamHandler".format(name.title().replace("_", "")), (StreamHandler,), {})
+    for name in cleanroom.transform.FEATURES if name not in cleanroom.transform.BANDS
+}
+
+STREAM_HANDLERS = {
+    "raw": RawStreamHandler,
+    "delta": DeltaStreamHandler,
+    "theta": ThetaStreamHandler,
+    "alpha": AlphaStreamHandler,
+    "beta": BetaStreamHandler,
+    "telemetry": TelemetryStreamHandler,
+    "acc": AccStreamHandler,
+    "gyro": GyroStreamHandler,
+    "ppg": PpgStreamHandler,
+    "artifacts": ArtifactStreamHandler,
+    "quality": QualityStreamHandler,
+}
+STREAM_HANDLERS.update(FEATURE_HANDLERS)
+
+def flush_message_queues():
+    """Flushes all message queues"""
+    if metrics.ENABLED:
+        started = metrics.stamp()
+
+    RawStreamHandler.flush_message_queue()
+    DeltaStreamHandler.flush_message_queue()
+    ThetaStreamHandler.flush_message_queue()
+    AlphaStreamHandler.flush_message_queue()
+    BetaStreamHandler.flush_message_queue()
+    TelemetryStreamHandler.flush_message_queue()
+    AccStreamHandler.flush_message_queue()
+    GyroStreamHandler.flush_message_queue()
+    PpgStreamHandler.flush_message_queue()
+    ArtifactStreamHandler.flush_message_queue()
+    QualityStreamHandler.flush_message_queue()
+
+    for handler in FEATURE_HANDLERS.values():
+        handler.flush_message_queue()
+
+    if metrics.ENABLED:
+        metrics.stage("flush").observe(metrics.stamp() - started)
+
+def register_metrics():
+    """Registers the metrics computed from the web server's state"""
+    metrics.counter("cleanroom_dropped_packets", "EEG packets lost")
+
+    for name, handler in STREAM_HANDLERS.items():
+        metrics.gauge("cleanroom_queue_depth", "Items waiting in a queue",
+                      {"queue": name}, func=lambda h=handler: len(h.message_queue()))
+        metrics.gauge("cleanroom_listeners", "Websocket listeners per stream",
+                      {"stream": name}, func=lambda h=handler: len(h.listeners()))
+
+    for name in cleanroom.design.cache_info():
+        metrics.gauge("cleanroom_design_cache_hits", "Filter and window design cache hits",
+                      {"cache": name}, func=lambda n=name: cleanroom.design.cache_info()[n].hits)
+        metrics.gauge("cleanroom_design_cache_misses", "Filter and window design cache misses",
+                      {"cache": name}, func=lambda n=name: cleanroom.design.cache_info()[n].misses)
+
+def enqueue(stream, message):
+    """Adds a message to the queue of the stream named `stream`"""
+    STREAM_HANDLERS[stream].enqueue_message(message)
+
+class FrameWriter:
+    """
+    Batches the messages of the DSP process into frames, one every
+    `interval` seconds, and sends them to the web process. A frame maps each
+    stream to its messages already joined, so that the web process only has
+    to fan them out.
+    """
+
+    def __init__(self, conn, interval=0.1):
+        """
+        conn: The sending end of a `multiprocessing.Pipe`.
+        interval: Seconds between frames.
+        """
+
+        self.conn = conn
+        self.interval = interval
+        self._messages = {}
+        self._lock = threading.Lock()
+
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def send(self, stream, message):
+        with self._lock:
+            self._messages.setdefault(stream, []).append(message)
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+
+            with self._lock:
+                messages, self._messages = self._messages, {}
+
+            if not messages:
+                continue
+
+            frame = {stream: "\n".join(queue) for stream, queue in messages.items()}
+            try:
+                self.conn.send(frame)
+            except (BrokenPipeError, EOFError, OSError):
+                # The web process is gone, so there's nobody left to stream to
+                os._exit(0)
+
+class DSPControl:
+    """
+    The web server's handle on the DSP settings, wherever the DSP runs. It
+    keeps the graph last asked for, and hands changes to the DSP once it's
+    attached.
+    """
+
+    def __init__(self, options):
+        """
+        options: The app's command line options, which the DSP starts with.
+        """
+
+        self.graph = cleanroom.graph.build_graph(
+            cleanroom.transform.BANDS + tuple(options.features), options.notch, options.bands)
+        self.artifacts = options.artifacts
+        self._configure = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def attach(self, configure):
+        """Sends the changes on to `configure`, e.g. `FeatureEngine.configure`,
+        from now on, starting with those made so far"""
+        with self._lock:
+            self._configure = configure
+            pending, self._pending = self._pending, {}
+            if pending:
+                configure(**pending)
+
+    def _send(self, **params):
+        with self._lock:
+            if self._configure is None:
+                self._pending.update(params)
+            else:
+                self._configure(**params)
+
+    def swap(self, graph):
+        """Swaps in a new `cleanroom.graph.Graph`"""
+        self.graph = graph
+        self._send(graph=graph)
+
+    def reload(self, config):
+        """Applies the DSP settings of a reloaded `cleanroom.config.Config`.
+        They replace any graph swapped in since."""
+        params = config.dsp_params()
+        graph = cleanroom.graph.build_graph(params.pop("features"), params.pop("notch"), params.pop("bands"))
+
+        mode = config["dsp"]["artifacts"]
+        mode = None if mode == "off" else mode
+        if (mode is None) != (self.artifacts is None):
+            params["artifacts"] = None if mode is None else cleanroom.ArtifactDetector()
+        self.artifacts = mode
+
+        self.graph = graph
+        self._send(graph=graph, **params)
+
+def receive_control(conn, configure):
+    """Applies the changes the web process sends over `conn`, on a daemon
+    thread"""
+
+    def run():
+        while True:
+            try:
+                params = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                configure(**params)
+            except ValueError:
+                logging.error("Invalid DSP settings", exc_info=True)
+
+    thread = threading.Thread(target=run, name="control")
+    thread.daemon = True
+    thread.start()
+
+def dsp_process(options, conn, control_conn):
+    """
+    The target of the `--split` DSP process, which runs the background
+    worker and sends its messages to the web process over `conn`, and
+    receives the changes of the DSP settings over `control_conn`.
+    """
+
+    # Exit cleanly when the web process terminates us, so that the
+    # acquisition process gets stopped too
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    background_worker(options, send=FrameWriter(conn, options.flush_interval).send,
+                      control=lambda configure: receive_control(control_conn, configure))
+
+def read_frames(conn):
+    """Returns an IOLoop handler that fans out the frames arriving on `conn`"""
+
+    def on_readable(fd, events):
+        try:
+            while conn.poll():
+                for stream, text in conn.recv().items():
+                    enqueue(stream, text)
+        except EOFError:
+            logging.error("The DSP process exited")
+            tornado.ioloop.IOLoop.current().remove_handler(fd)
+
+        # Frames are already batched, so send them on without waiting for the
+        # next periodic flush
+        flush_message_queues()
+
+    return on_readable
+
+def background_worker(options, io_loop=None, send=enqueue, control=None):
+    """
+    The background thread target.
+
+    options: The app's command line options.
+    io_loop: The web server's `IOLoop`, which results computed on the
+        `--workers` process pool are handed back to. If None, they're sent
+        from the pool's callback thread.
+    send: Called with the name of a stream and a message for it.
+    control: Called with the function that changes the DSP settings, like
+        `FeatureEngine.configure`, once it's running, e.g.
+        `DSPControl.attach`.
+    """
+
+    def send_features(values):
+        # Sends the band powers and any extra features of a window
+        for name, value in values.items():
+            send(name, value.to_json())
+
+    def send_quality(quality):
+        send("quality", quality.to_json())
+
+    def send_artifact(artifact):
+        send("artifacts", artifact.to_json())
+
+    def send_result(future):
+        # Runs with a chunk processed by the pool
+        try:
+            values, quality, artifact = future.result()
+        except:
+            logging.error("Error computing features", exc_info=True)
+            return
+
+        if quality is not None:
+            send_quality(quality)
+        if artifact is not None:
+            send_artifact(artifact)
+        if values is not None:
+            send_features(values)
+
+    def send_sensor_data(block):
+        # Auxiliary sensors skip the band processing, straight to their streams
+        for sample in block.samples():
+            send(block.sensor, sample.to_json())
+
+    def forward_raw(raw):
+        # Sends each raw sample as it is pulled in for processing
+        for sample in raw:
+            send("raw", sample.to_json())
+            yield sample
+
+    # This will fork a process that will discover Muse headsets and yield raw
+    # EEG data, unless we're replaying a recording or synthesizing data.
+    speed = options.speed or None
+    if options.replay:
+        raw = cleanroom.get_replay(options.replay, speed=speed)
+    elif options.synthetic:
+        # Shaped like the selected preset's samples
+        layout = cleanroom.presets.get_layout(options.preset)
+        raw = cleanroom.get_synthetic(speed=speed, n_channels=layout.n_channels)
+    elif options.lsl:
+        raw = cleanroom.get_lsl(name=options.lsl)
+    else:
+        raw = cleanroom.get_raw(
+            timeout=options.timeout,
+            record=options.record,
+            lsl_chunk_size=options.lsl_chunk_size,
+            on_telemetry=lambda telemetry: send("telemetry", telemetry.to_json()),
+            on_sensor=send_sensor_data,
+            **headset_kwargs(options)
+        )
+
+    engine = cleanroom.FeatureEngine(
+        cleanroom.transform.BANDS + tuple(options.features),
+        artifacts=cleanroom.ArtifactDetector() if options.artifacts else None,
+        reject=options.artifacts == "reject",
+        quality=cleanroom.SignalQuality(),
+        notch=options.notch,
+        bands=options.bands
+    )
+
+    if options.workers:
+        # Compute the features on a worker process, so that the DSP doesn't
+        # compete with the web server for the GIL. The engine stays there,
+        # and only the chunks are sent over
+        executor = cleanroom.FeatureExecutor(options.workers)
+        executor.add("eeg", engine)
+        configure = lambda **params: executor.configure("eeg", **params)
+    else:
+        configure = engine.configure
+
+    if control is not None:
+        control(configure)
+
+    if options.workers:
+        if io_loop is not None:
+            on_done = lambda future: io_loop.add_callback(send_result, future)
+        else:
+            on_done = send_result
+
+        while True:
+            samples = list(itertools.islice(forward_raw(raw), options.chunk_size))
+            if not samples:
+                break
+
+            timestamps, data = cleanroom.transform.samples_to_arrays(samples)
+            executor.submit("eeg", timestamps, data).add_done_callback(on_done)
+
+        return
+
+    # Get brain wave data, along with any extra features requested
+    feature_data = cleanroom.get_features(
+        forward_raw(raw),
+        chunk_size=options.chunk_size,
+        on_artifact=send_artifact,
+        on_quality=send_quality,
+        engine=engine
+    )
+
+    for values in feature_data:
+        send_features(values)
+
+def parse_features(value):
+    """Parses the comma separated names of `--features`"""
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    if names == ["all"]:
+        names = list(FEATURE_HANDLERS)
+    for name in names:
+        if name not in FEATURE_HANDLERS:
+            raise ArgumentTypeError("unknown feature: {}".format(name))
+    return names
+
+def main(argv=None):
+    parser = ArgumentParser(prog="cleanroom serve", description="Serve the EEG dashboard")
+    add_headset_arguments(parser)
+    parser.add_argument("--artifacts",
+                        dest="artifacts", choices=["flag", "reject"], default=None,
+                        help="Detect blinks, jaw clenches and saturation, and either `flag` them on `/stream/artifacts` or also `reject` the affected windows.")
+    parser.add_argument("--features",
+                        dest="features", type=parse_features, default=[],
+                        help="Comma separated extra features to stream on `/stream/<feature>`, or `all`: {}.".format(", ".join(FEATURE_HANDLERS)))
+    parser.add_argument("-w", "--workers",
+                        dest="workers", type=int, default=0,
+                        help="Number of processes to compute the features on, instead of the background thread. A headset's features are computed on one process, so more only help with several headsets.")
+    parser.add_argument("-s", "--split",
+                        dest="split", action="store_true", default=False,
+                        help="Read and transform EEG data in a separate process, leaving this one to serve websockets. Metrics then only cover the web server.")
+    parser.add_argument("-r", "--record",
+                        dest="record", default=None,
+                        help="Path of a file to record the session to.")
+    parser.add_argument("--replay",
+                        dest="replay", default=None,
+                        help="Play back a recording instead of connecting to a headset.")
+    parser.add_argument("--synthetic",
+                        dest="synthetic", action="store_true", default=False,
+                        help="Stream synthetic EEG instead of connecting to a headset.")
+    parser.add_argument("--lsl",
+                        dest="lsl", default=None,
+                        help="Read EEG from the LSL stream of this name, e.g. `Muse`, instead of connecting to a headset.")
+    parser.add_argument("--speed",
+                        dest="speed", type=float, default=1.0,
+                        help="Speed of --replay and --synthetic relative to real time, 0 for as fast as possible. Defaults to `1`.")
+    parser.add_argument("-m", "--metrics",
+                        dest="metrics", action="store_true", default=False,
+                        help="Instrument the pipeline and expose the measurements at `/metrics`.")
+    parser.add_argument("-p", "--port",
+                        dest="port", type=int, default=8888,
+                        help="Port to run the HTTP server on. Defaults to `8888`.")
+
+    add_config_argument(parser)
+
+    options = parse_args(parser, argv)
+    StreamHandler.max_queue = options.max_queue or None
+
+    # This needs to happen before the acquisition process is started, so that
+    # it inherits the setting
+    if options.metrics:
+        metrics.enable()
+        register_metrics()
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    control = DSPControl(options)
+
+    if options.config:
+        # Apply the DSP settings of the file as it's edited, without
+        # reconnecting the headset
+        cleanroom.config.ConfigWatcher(options.config, control.reload).start()
+
+    if options.split:
+        # Read/transform EEG data in a separate process, which sends frames
+        # of encoded messages for this one to fan out. It can't be daemonic,
+        # as it starts the acquisition process, so it's terminated below.
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        child_control, control_conn = multiprocessing.Pipe(duplex=False)
+        dsp = multiprocessing.Process(target=dsp_process, args=(options, child_conn, child_control))
+        dsp.start()
+        child_conn.close()
+        child_control.close()
+        control.attach(lambda **params: control_conn.send(params))
+        io_loop.add_handler(conn.fileno(), read_frames(conn), tornado.ioloop.IOLoop.READ)
+    else:
+        # Start the background worker thread, which will read/transform EEG data
+        dsp = None
+        t = threading.Thread(target=background_worker, args=(options, io_loop),
+                             kwargs={"control": control.attach})
+        t.daemon = True
+        t.start()
+
+    # Start the application
+    handlers = [
+        (r"/", MainHandler),
+        (r"/stream/raw", RawStreamHandler),
+        (r"/stream/delta", DeltaStreamHandler),
+        (r"/stream/theta", ThetaStreamHandler),
+        (r"/stream/alpha", AlphaStreamHandler),
+        (r"/stream/beta", BetaStreamHandler),
+        (r"/stream/telemetry", TelemetryStreamHandler),
+        (r"/stream/acc", AccStreamHandler),
+        (r"/stream/gyro", GyroStreamHandler),
+        (r"/stream/ppg", PpgStreamHandler),
+        (r"/stream/artifacts", ArtifactStreamHandler),
+        (r"/stream/quality", QualityStreamHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/control/graph", GraphHandler, {"control": control}),
+    ]
+    handlers += [(r"/stream/" + name, handler) for name, handler in FEATURE_HANDLERS.items()]
+
+    app = tornado.web.Application(handlers, template_path=os.path.join(os.path.dirname(__file__), "templates"))
+    app.listen(options.port)
+    
+    callback = tornado.ioloop.PeriodicCallback(flush_message_queues, options.flush_interval * 1000)
+    callback.start()
+    
+    try:
+        io_loop.start()
+    finally:
+        if dsp is not None:
+            dsp.terminate()
+            dsp.join()
+
+if __name__ == "__main__":
+    main()